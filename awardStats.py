@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Unit-wide award statistics. One pass over every trooper's awards and service record builds small, pre-aggregated
+# tables in a SQLite file: awards issued per award, roster and month, time from eligibility to award, and troopers
+# missing awards they qualify for. A dashboard reads the tables instead of crawling profiles.
+#
+# Example: python awardStats.py --db awardStats.db
+#          python awardStats.py --db awardStats.db --issued "Combat Infantry Badge" 2020-07 2020-09
+
+import argparse
+import datetime
+import os
+import sqlite3
+import statistics
+
+import cavMetrics
+import milpacScraper
+import milpacsAuditor
+
+log = cavMetrics.getLogger("awardStats")
+
+# Audit name to a function taking a service record and returning {award name: date str the trooper qualified}.
+RULES = {
+    "eibcib": lambda serviceRecord: dict(milpacsAuditor.EIBCIB().eligibleSince(serviceRecord).values())
+}
+
+SCHEMA = """
+CREATE TABLE award_counts (award TEXT, month TEXT, rosterID INTEGER, count INTEGER,
+    PRIMARY KEY (award, month, rosterID)) WITHOUT ROWID;
+CREATE TABLE award_latency (award TEXT PRIMARY KEY, rule TEXT, count INTEGER, median REAL, mean REAL, min INTEGER, max INTEGER);
+CREATE TABLE missing_awards (milpacID INTEGER, rosterID INTEGER, rule TEXT, award TEXT, eligibleSince TEXT, daysWaiting INTEGER,
+    PRIMARY KEY (award, milpacID)) WITHOUT ROWID;
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def month(date):
+    return f"{date.year}-{date.month:02d}"
+
+
+def toDate(text):
+    try:
+        return milpacScraper.parseDate(text)
+    except ValueError: # Blank or unusual dates are left out rather than failing the build.
+        return None
+
+
+class stats:
+    '''
+    Award rollups for many troopers.
+
+    Input:
+        asOf (date) [OPTIONAL]: Date days waiting for missing awards are counted to. Default: today.
+        rules (dict) [OPTIONAL]: Audit rules to check. Default: RULES
+    '''
+    def __init__(self, asOf=False, rules=False):
+        self.asOf = asOf or datetime.date.today()
+        self.rules = rules or RULES
+        self.counts = {} # (award, month, roster ID) to awards issued.
+        self.latency = {} # Award to (rule, [days from eligible to awarded]).
+        self.missing = [] # (milpac ID, roster ID, rule, award, eligible since, days waiting).
+        self.troopers = 0
+
+    def add(self, milpacID, rosterID, serviceRecord, awards):
+        '''
+        Add one trooper.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            rosterID (int): Roster the trooper is on.
+            serviceRecord (list): Output of milpacScraper.trooper().serviceRecord().
+            awards (list): Output of milpacScraper.trooper().awards().
+        '''
+        self.troopers += 1
+        first = {} # Award name to the date it was first given.
+        for date, award, details in awards:
+            d = toDate(date)
+            if d is None:
+                continue
+            key = (award, month(d), int(rosterID))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if award not in first or d < first[award]:
+                first[award] = d
+
+        for rule, eligible in self.rules.items():
+            for award, date in eligible(serviceRecord).items():
+                since = toDate(date)
+                if since is None:
+                    continue
+                if award in first:
+                    self.latency.setdefault(award, (rule, []))[1].append((first[award] - since).days)
+                else:
+                    self.missing.append((int(milpacID), int(rosterID), rule, award, since.isoformat(), (self.asOf - since).days))
+
+    @classmethod
+    def build(cls, records, asOf=False):
+        '''
+        Build stats from many troopers.
+
+        Inputs:
+            records (iterable): (milpac ID, roster ID, service record, awards) tuples.
+            asOf (date) [OPTIONAL]: See stats.
+
+        Output (stats): Built stats.
+        '''
+        s = cls(asOf)
+        with cavMetrics.timer("audit", "awardStats"):
+            for milpacID, rosterID, serviceRecord, awards in records:
+                s.add(milpacID, rosterID, serviceRecord, awards)
+        return s
+
+    @classmethod
+    def fromUnit(cls, rosterIDs=False, workers=8, asOf=False):
+        '''
+        Build stats for every trooper on the rosters, fetching their profiles concurrently.
+
+        Inputs:
+            rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+            workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+            asOf (date) [OPTIONAL]: See stats.
+
+        Output (stats): Built stats.
+        '''
+        rosterOf = {} # Milpac ID to roster ID. Troopers listed on more than one roster count on the first.
+        for rosterID in (rosterIDs or milpacScraper.roster().getRosters()):
+            for ID in milpacScraper.roster(rosterID).getIDs():
+                rosterOf.setdefault(ID, rosterID)
+        s = cls.build(((ID, rosterOf[ID], t.serviceRecord(), t.awards()) for ID, t in milpacScraper.troopers(rosterOf, workers)), asOf)
+        log.info(f"Built award stats for {s.troopers} troopers", extra={"troopers": s.troopers})
+        return s
+
+    def awardsPerMonth(self, award=False):
+        '''
+        Count awards issued per month, across every roster.
+
+        Inputs:
+            award (str) [OPTIONAL]: Only count this award. Default: all awards.
+
+        Output (dict): Month (Ex: "2020-11") to count, in order.
+        '''
+        months = {}
+        for (a, m, rosterID), count in self.counts.items():
+            if award == False or a == award:
+                months[m] = months.get(m, 0) + count
+        return dict(sorted(months.items()))
+
+    def latencies(self):
+        '''
+        Output (dict): Award to a dict of rule, count, median, mean, min and max days from eligible to awarded.
+        '''
+        return {award: {
+            "rule": rule,
+            "count": len(days),
+            "median": statistics.median(days),
+            "mean": statistics.mean(days),
+            "min": min(days),
+            "max": max(days)
+        } for award, (rule, days) in sorted(self.latency.items())}
+
+    def save(self, path):
+        '''
+        Write the tables to a SQLite file, replacing any earlier build. Readers see the old or new file, never half of one.
+        '''
+        tmp = f"{path}.{os.getpid()}.tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        with cavMetrics.timer("write", "sqlite"):
+            db = sqlite3.connect(tmp)
+            try:
+                db.executescript(SCHEMA)
+                db.executemany("INSERT INTO award_counts VALUES (?, ?, ?, ?)", [k + (v,) for k, v in self.counts.items()])
+                db.executemany("INSERT INTO award_latency VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(a, l["rule"], l["count"], l["median"], l["mean"], l["min"], l["max"]) for a, l in self.latencies().items()])
+                db.executemany("INSERT OR REPLACE INTO missing_awards VALUES (?, ?, ?, ?, ?, ?)", self.missing)
+                db.executemany("INSERT INTO meta VALUES (?, ?)", [
+                    ("asOf", self.asOf.isoformat()),
+                    ("built", datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")),
+                    ("troopers", str(self.troopers))
+                ])
+                db.commit()
+            finally:
+                db.close()
+        os.replace(tmp, path)
+        log.info(f"Saved award stats to {path}", extra={"file": path})
+
+
+def issued(path, award=False, start=False, end=False, rosterID=False):
+    '''
+    Count awards issued, from a saved stats file.
+
+    Inputs:
+        path (str): SQLite file written by stats().save().
+        award (str) [OPTIONAL]: Award name. Default: all awards.
+        start (str) [OPTIONAL]: First month counted. (Ex: 2020-07) Default: no limit.
+        end (str) [OPTIONAL]: Last month counted. (Ex: 2020-09) Default: no limit.
+        rosterID (int) [OPTIONAL]: Only count this roster. Default: every roster.
+
+    Output (int): Awards issued.
+    '''
+    query, values = "SELECT COALESCE(SUM(count), 0) FROM award_counts WHERE 1", []
+    for column, test, value in (("award", "=", award), ("month", ">=", start), ("month", "<=", end), ("rosterID", "=", rosterID)):
+        if value != False:
+            query += f" AND {column} {test} ?"
+            values.append(value)
+    with sqlite3.connect(path) as db:
+        return db.execute(query, values).fetchone()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build award statistics for the unit.")
+    parser.add_argument("--db", default="awardStats.db", help="SQLite file to write or read. Default: awardStats.db")
+    parser.add_argument("--roster", nargs="+", default=False, help="Roster IDs. Default: every roster.")
+    parser.add_argument("--workers", type=int, default=8, help="Profiles fetched at once. Default: 8")
+    parser.add_argument("--issued", nargs="+", metavar=("AWARD", "MONTH"),
+        help="Don't build. Print how many of an award were issued, optionally between two months. (Ex: \"Combat Infantry Badge\" 2020-07 2020-09)")
+    args = parser.parse_args()
+
+    if args.issued:
+        print(issued(args.db, *args.issued[:3]))
+    else:
+        stats.fromUnit(args.roster, args.workers).save(args.db)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the fetch, parse and audit stages, run against synthetic fixture pages.
+#
+# Example: python benchmark.py --sizes 10,100,1000,10000 --repeat 5 --output bench.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cavConfig
+import cavMetrics
+import cavSession
+import fixturePages
+import forumScraper
+import milpacsAuditor
+import milpacScraper
+import standInServer
+
+scenarios = {} # Scenario name to (setup function, maximum size, unit timed).
+
+
+def scenario(name, maxSize=None, unit="item"):
+    '''
+    Register a benchmark scenario. The decorated function is the setup, and takes the size and returns
+        (run function, state). run(state, times) does the measured work, adds the seconds each unit took to the
+        times list, and returns the amount of items processed.
+
+    Inputs:
+        name (str): Name of scenario, as used with --only.
+        maxSize (int) [OPTIONAL]: Largest size this scenario will run at. Default: no limit.
+        unit (str) [OPTIONAL]: What one latency time covers. (Ex: profile) Default: item
+    '''
+    def register(setup):
+        scenarios[name] = (setup, maxSize, unit)
+        return setup
+    return register
+
+
+def timedEach(items, function, times):
+    '''
+    Call function on each item, adding the seconds each call took to times.
+
+    Output (list): Results of function, in order.
+    '''
+    results = []
+    for item in items:
+        start = time.perf_counter()
+        results.append(function(item))
+        times.append(time.perf_counter() - start)
+    return results
+
+
+def timedYields(iterable, times):
+    '''
+    Output (generator): Items of iterable. The seconds spent producing each are added to times.
+    '''
+    start = time.perf_counter()
+    for item in iterable:
+        times.append(time.perf_counter() - start)
+        yield item
+        start = time.perf_counter()
+
+
+def profiles(n):
+    ranks = fixturePages.loadRanks()
+    return [fixturePages.profilePage(fixturePages.syntheticTrooper(i, seed=1, ranks=ranks)) for i in range(1, n + 1)]
+
+
+@scenario("roster.getInfo", unit="page")
+def rosterGetInfo(n):
+    html = fixturePages.rosterPage(1, fixturePages.syntheticUnit(1, n, seed=1)[1])
+    # The page's rows are parsed together, so only the whole page can be timed: one latency per run.
+    return (lambda html, times: sum(len(r) for r in timedEach([html], lambda h: milpacScraper.roster(1, h).getInfo(), times))), html
+
+
+@scenario("roster.scanIDs", unit="ID")
+def rosterScanIDs(n):
+    html = fixturePages.rosterPage(1, fixturePages.syntheticUnit(1, n, seed=1)[1]).encode("utf-8")
+    chunks = [html[i:i + 65536] for i in range(0, len(html), 65536)] # As streamed from the site.
+    return (lambda c, times: sum(1 for _ in timedYields(milpacScraper.scanIDs(c), times))), chunks
+
+
+@scenario("stripRank", unit="row")
+def stripRankRows(n):
+    rows = milpacScraper.roster(1, fixturePages.rosterPage(1, fixturePages.syntheticUnit(1, n, seed=1)[1])).getInfo()
+    return (lambda rows, times: len(timedEach(rows, lambda r: milpacScraper.stripRank(r[2], r[1]), times))), rows
+
+
+@scenario("trooper.information", unit="profile")
+def trooperInformation(n):
+    return (lambda pages, times: len(timedEach(pages, lambda p: milpacScraper.trooper(0, p).information(), times))), profiles(n)
+
+
+@scenario("trooper.serviceRecord", unit="profile")
+def trooperServiceRecord(n):
+    def run(pages, times):
+        return sum(len(r) for r in timedEach(pages, lambda p: milpacScraper.trooper(0, p).serviceRecord(dateTime=True), times))
+    return run, profiles(n)
+
+
+@scenario("trooper.awards", unit="profile")
+def trooperAwards(n):
+    def run(pages, times):
+        return sum(len(r) for r in timedEach(pages, lambda p: milpacScraper.trooper(0, p).awards(dateTime=True), times))
+    return run, profiles(n)
+
+
+def recordDates(n):
+    return [d for p in profiles(n) for d, _ in milpacScraper.trooper(0, p).serviceRecord()]
+
+
+@scenario("dates.strptime", unit="date")
+def datesStrptime(n):
+    return (lambda dates, times: len(timedEach(dates, lambda d: datetime.datetime.strptime(d, "%b %d, %Y").date(), times))), recordDates(n)
+
+
+@scenario("dates.parseDate", unit="date")
+def datesParseDate(n):
+    def run(dates, times):
+        milpacScraper.parseDate.cache_clear() # Each run starts cold, and warms as dates repeat across troopers.
+        return len(timedEach(dates, milpacScraper.parseDate, times))
+    return run, recordDates(n)
+
+
+@scenario("forum.posts", unit="page")
+def forumPosts(n):
+    perPage = 20
+    pages = [fixturePages.messagePage("post", fixturePages.syntheticMessages("post", 1, p, perPage, seed=1))
+        for p in range(1, max(1, n // perPage) + 1)]
+    return (lambda pages, times: sum(len(r) for r in timedEach(pages, forumScraper.parsePostList, times))), pages
+
+
+# What a short cron job does before its first request: import the tools and create them.
+STARTUP = "import forumScraper, milpacEditor, milpacsAuditor; forumScraper.forum(); forumScraper.conversations(); milpacEditor.add()"
+
+
+@scenario("startup", maxSize=10, unit="process")
+def startup(n):
+    # Fresh interpreters, one per item. The base URL is a closed port, so a login at construction fails the run.
+    env = dict(os.environ, CAV_BASE_URL="http://127.0.0.1:9")
+    def start(i):
+        subprocess.run([sys.executable, "-c", STARTUP], env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return (lambda env, times: len(timedEach(range(n), start, times))), env
+
+
+def auditSetup(n, audit, perTrooper):
+    site = standInServer.standIn(rosters=1, troopersPerRoster=n, seed=1)
+    server = standInServer.serve(site)
+    def run(state, times):
+        a = audit()
+        check = getattr(a, perTrooper)
+        setattr(a, perTrooper, lambda ID: timedEach([ID], check, times)[0]) # Each trooper's fetch and check.
+        a.checkRoster(1)
+        return n
+    return run, server
+
+
+@scenario("EIBCIB.checkRoster", maxSize=10000, unit="trooper")
+def eibcibAudit(n):
+    return auditSetup(n, milpacsAuditor.EIBCIB, "checkTrooper")
+
+
+@scenario("NCOA.checkRoster", maxSize=10000, unit="trooper")
+def ncoaAudit(n):
+    return auditSetup(n, milpacsAuditor.NCOA, "checkGraduating")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def measure(name, size, repeat=5):
+    '''
+    Run one scenario at one size.
+
+    Inputs:
+        name (str): Scenario name.
+        size (int): Amount of troopers/posts to generate.
+        repeat (int) [OPTIONAL]: Timed runs. Default: 5
+
+    Output (dict): Result, with items, per-unit latency percentiles over every run, run times, throughput and peak
+        traced memory.
+    '''
+    setup, maxSize, unit = scenarios[name]
+    run, state = setup(size)
+
+    server = state if isinstance(state, standInServer.ThreadingHTTPServer) else None
+    initURL = cavConfig.baseURL()
+    if server:
+        cavConfig.setBaseURL(f"http://127.0.0.1:{server.server_address[1]}")
+
+    try:
+        times = [] # Whole runs.
+        latency = [] # Each unit, across every run.
+        for _ in range(repeat):
+            start = time.perf_counter()
+            items = run(state, latency)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        run(state, [])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        if server:
+            server.shutdown()
+            cavConfig.setBaseURL(initURL)
+
+    median = statistics.median(times)
+    return {
+        "scenario": name,
+        "size": size,
+        "items": items,
+        "runs": repeat,
+        "unit": unit,
+        "latency": { # Seconds per unit.
+            "count": len(latency),
+            "p50": percentile(latency, 50),
+            "p95": percentile(latency, 95),
+            "p99": percentile(latency, 99),
+            "max": max(latency)
+        },
+        "seconds": { # Whole runs.
+            "min": min(times),
+            "median": median,
+            "max": max(times)
+        },
+        "itemsPerSecond": items / median if median else None,
+        "peakMemoryBytes": peak
+    }
+
+
+def runAll(sizes=(10, 100, 1000), repeat=5, only=None):
+    '''
+    Run every scenario (or those in only) at every size.
+
+    Output (dict): Report with run metadata and a list of results from measure().
+    '''
+    results = []
+    initDir = os.getcwd()
+    packageDir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (setup, maxSize, unit) in scenarios.items():
+            if only and name not in only:
+                continue
+            for size in sizes:
+                if maxSize and size > maxSize:
+                    continue
+                # Audits write their reports to the working directory.
+                os.chdir(tmp if name.endswith("checkRoster") else packageDir)
+                try:
+                    results.append(measure(name, size, repeat))
+                finally:
+                    os.chdir(initDir)
+                r = results[-1]
+                l = r["latency"]
+                print(f"{name:24} n={size:<6} run={r['seconds']['median']:.4f}s  {r['itemsPerSecond']:.0f} items/s  "
+                    f"{unit} p50/p95/p99={l['p50'] * 1e6:.0f}/{l['p95'] * 1e6:.0f}/{l['p99'] * 1e6:.0f}us  peak={r['peakMemoryBytes'] / 1e6:.1f}MB")
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sizes": list(sizes),
+            "repeat": repeat
+        },
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the fetch, parse and audit stages.")
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma separated trooper/post counts.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per scenario and size.")
+    parser.add_argument("--only", default="", help="Comma separated scenario names. Default: all.")
+    parser.add_argument("--output", default="benchmark.json", help="Where to write the JSON report.")
+    parser.add_argument("--list", action="store_true", help="List scenarios and exit.")
+    args = parser.parse_args()
+
+    cavMetrics.configureLogging("ERROR") # Keep per-trooper audit logging out of the report.
+    cavSession.setMemoTTL(0) # Repeated runs must fetch and parse again, not reuse the last run's results.
+    if args.list:
+        print("\n".join(scenarios))
+    else:
+        report = runAll([int(s) for s in args.sizes.split(",")], args.repeat, [o for o in args.only.split(",") if o])
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+        print(f"Saved report to {args.output}")
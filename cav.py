@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Command line interface for every tool, for scheduled and scripted runs. Tool modules are only imported by the
+# command that needs them, so startup stays fast.
+#
+# Examples:
+#   python cav.py roster --output roster.csv --format csv
+#   python cav.py --workers 8 --shard 0/4 --resume --output ncoa-0.jsonl audit ncoa --roster 1 2
+#   python cav.py import awards awards.csv --resume --output awards-ledger.jsonl
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+
+def shardType(value):
+    '''
+    argparse type for --shard. (Ex: "0/4" is the first of four shards)
+    '''
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like 0/4, not {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 0 and {count - 1}")
+    return index, count
+
+
+def inShard(milpacID, shard):
+    return shard is None or int(milpacID) % shard[1] == shard[0]
+
+
+class output:
+    '''
+    Writes result records as JSON lines, a JSON list or CSV, to a file or stdout.
+
+    Inputs:
+        path (str): File to write. "-" for stdout.
+        format (str): jsonl, json or csv.
+        append (bool) [OPTIONAL]: Add to the file instead of replacing it. Only for jsonl. Default: False
+    '''
+    def __init__(self, path, format, append=False):
+        self.format = format
+        self.file = sys.stdout if path == "-" else open(path, "a" if append else "w", newline="", encoding="utf-8")
+        self.records = [] # Held for json, which is written on close.
+        self.writer = None
+
+    def write(self, record):
+        if self.format == "jsonl":
+            self.file.write(json.dumps(record, default=str) + "\n")
+            self.file.flush() # So a killed run can resume from what was written.
+        elif self.format == "json":
+            self.records.append(record)
+        else:
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, list(record))
+                self.writer.writeheader()
+            self.writer.writerow({k: json.dumps(v, default=str) if isinstance(v, (list, dict)) else v for k, v in record.items()})
+
+    def close(self):
+        if self.format == "json":
+            json.dump(self.records, self.file, indent=4, default=str)
+            self.file.write("\n")
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def finished(path, key):
+    '''
+    Read the values of key from a JSON lines output file, for --resume. Records with an "error" are left out,
+        so they are retried.
+
+    Output (set): Values, as strings.
+    '''
+    done = set()
+    if path != "-" and os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    r = json.loads(line)
+                    if not r.get("error"):
+                        done.add(str(r[key]))
+    return done
+
+
+def runJobs(function, items, workers):
+    '''
+    Run function on every item from a pool of threads.
+
+    Output (generator): (item, result, error) tuples, in the same order as items. error is None if it succeeded.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def job(item):
+        try:
+            return item, function(item), None
+        except Exception as e:
+            return item, None, repr(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        yield from pool.map(job, items)
+
+
+def rosterIDs(args):
+    import milpacScraper
+    return args.roster or milpacScraper.roster().getRosters()
+
+
+def milpacIDs(args):
+    '''
+    Milpac IDs a command should work on: those given, or everyone on the rosters, less other shards and those
+        already finished when resuming.
+    '''
+    import milpacScraper
+    if args.ids:
+        IDs = args.ids
+    else:
+        IDs = []
+        for rosterID, r, error in runJobs(milpacScraper.roster, rosterIDs(args), args.workers):
+            if error: # A missing roster would silently drop its troopers from every shard.
+                raise SystemExit(f"Could not fetch roster {rosterID}: {error}")
+            IDs += r.getIDs()
+    IDs = [i for i in dict.fromkeys(str(i) for i in IDs) if inShard(i, args.shard)]
+    if args.resume:
+        done = finished(args.output, "milpacID")
+        IDs = [i for i in IDs if i not in done]
+    return IDs
+
+
+def rosterCommand(args, out):
+    import milpacScraper
+    for rosterID, rows, error in runJobs(lambda r: milpacScraper.roster(r).getInfo(shaveRank=True), rosterIDs(args), args.workers):
+        if error:
+            out.write({"rosterID": rosterID, "error": error})
+            continue
+        for r in rows:
+            if inShard(r[0], args.shard):
+                out.write({"milpacID": r[0], "rank": r[1], "name": r[2], "enlisted": r[3], "promoted": r[4], "position": r[5], "rosterID": rosterID})
+
+
+def profileCommand(args, out):
+    if args.processes:
+        import cavPipeline
+        stats = cavPipeline.pipeline(args.workers, args.processes).profiles(milpacIDs(args),
+            lambda ID, result: out.write(dict({"milpacID": ID}, **result)))
+        for ID, stage, error in stats["errors"]:
+            out.write({"milpacID": ID, "error": error})
+        return
+
+    import milpacScraper
+    def profile(ID):
+        t = milpacScraper.trooper(ID)
+        return dict(t.information(), serviceRecord=t.serviceRecord(), awards=t.awards())
+    for ID, result, error in runJobs(profile, milpacIDs(args), args.workers):
+        out.write(dict({"milpacID": ID}, **result) if error is None else {"milpacID": ID, "error": error})
+
+
+def auditCommand(args, out):
+    import milpacsAuditor
+    gcm = milpacsAuditor.GCM()
+    audits = {
+        "eibcib": milpacsAuditor.EIBCIB().checkTrooper,
+        "ncoa": milpacsAuditor.NCOA().checkGraduating,
+        "eloa": lambda ID: gcm.compileELOA(ID, toJSON=False), # Results go to --output, not one shared GCAudit.json.
+        "rank": milpacsAuditor.rankHistory().checkTrooper
+    }
+    for ID, result, error in runJobs(audits[args.audit], milpacIDs(args), args.workers):
+        out.write({"milpacID": ID, "result": result} if error is None else {"milpacID": ID, "error": error})
+
+
+def importCommand(args, out):
+    import milpacEditor
+    editor = milpacEditor.add(args.credentials)
+    calls = { # Import type to (row lengths allowed, function adding one row).
+        "service-records": ((4, 5), lambda r: editor.serviceRecord(*r)),
+        "awards": ((5, 6), lambda r: editor.award(r[0], r[1], r[2], r[3], r[4] or False, *r[5:])),
+        "uniforms": ((3,), lambda r: editor.uniform(*r))
+    }
+    lengths, function = calls[args.kind]
+
+    with open(args.csv, newline="") as file:
+        rows = [(n, r) for n, r in enumerate(csv.reader(file), 1) if r]
+    done = finished(args.output, "row") if args.resume else set()
+    rows = [(n, r) for n, r in rows if str(n) not in done and inShard(r[0], args.shard)]
+    for n, r in rows:
+        assert len(r) in lengths, f"Row {n} is wrong length, needs to be {' or '.join(str(l) for l in lengths)}. Current length: {len(r)}. Row contents:\n{r}"
+    column = {"service-records": 4, "awards": 4, "uniforms": 2}[args.kind] # Citation or uniform file.
+    paths = [r[column] if len(r) > column else None for n, r in rows]
+    position = {n: i for i, (n, r) in enumerate(rows)}
+
+    def job(row):
+        i = position[row[0]] + args.workers # Rows before this one are already being uploaded.
+        editor.prefetch(paths[i:i + milpacEditor.PREFETCH]) # Read in the background, a few rows ahead.
+        return function(row[1])
+
+    with editor.files:
+        for (n, r), ok, error in runJobs(job, rows, args.workers):
+            if error is None and ok == False:
+                error = "Rejected by milpacs"
+            out.write({"row": n, "milpacID": r[0], "error": error})
+
+
+def exportCommand(args, out):
+    import columnarExport
+    if args.kind == "roster":
+        rows = {"roster": columnarExport.exportRosters(args.path, args.roster, args.columnar, args.workers)}
+    else:
+        os.makedirs(args.path, exist_ok=True)
+        paths = {table: os.path.join(args.path, f"{table}.{args.columnar}") for table in ("troopers", "serviceRecords", "awards")}
+        rows = columnarExport.exportTroopers(paths, milpacIDs(args), args.columnar, args.workers)
+    out.write({"path": args.path, "rows": rows})
+
+
+def options(p, defaults=True):
+    '''
+    Add the options every command takes. Subcommands get them too, without defaults, so they can be given
+        before or after the command.
+    '''
+    d = (lambda v: v) if defaults else (lambda v: argparse.SUPPRESS)
+    p.add_argument("--workers", type=int, default=d(4), help="Troopers/rows processed at once. Default: 4")
+    p.add_argument("--output", default=d("-"), help="Where to write results. Default: stdout")
+    p.add_argument("--format", choices=("jsonl", "json", "csv"), default=d("jsonl"), help="Output format. Default: jsonl")
+    p.add_argument("--resume", action="store_true", default=d(False), help="Skip troopers/rows already in --output (jsonl only), and append to it.")
+    p.add_argument("--shard", type=shardType, default=d(None), help="Only work on shard i of n, split by milpac ID. (Ex: 0/4)")
+    p.add_argument("--cookie-dir", default=d(None), help="Folder to keep the login cookie jar (cookies.json) in.")
+    p.add_argument("--archive-dir", default=d(None), help="Keep a compressed copy of every fetched page here. See pageArchive.py.")
+    p.add_argument("--credentials", default=d(False), help="Location of credentials.json.")
+    p.add_argument("--base-url", default=d(None), help="Site to use instead of https://7cav.us.")
+    p.add_argument("--log-level", default=d(None), help="DEBUG, INFO, WARNING or ERROR. Default: INFO")
+    p.add_argument("--profile", default=d(None), help="Profile the run into this JSON report. See cavProfiler.py.")
+    p.add_argument("--log-json", action="store_true", default=d(False), help="Log as JSON lines.")
+
+
+def parser():
+    p = argparse.ArgumentParser(prog="cav.py", description="Cav Scrapers command line.")
+    options(p)
+    common = argparse.ArgumentParser(add_help=False)
+    options(common, defaults=False)
+    commands = p.add_subparsers(dest="command", required=True)
+
+    def targets(c):
+        c.add_argument("ids", nargs="*", help="Milpac IDs. Default: everyone on --roster.")
+        c.add_argument("--roster", nargs="+", default=None, help="Roster IDs. Default: every roster.")
+
+    c = commands.add_parser("roster", parents=[common], help="Scrape rosters.")
+    c.add_argument("--roster", nargs="+", default=None, help="Roster IDs. Default: every roster.")
+    c.set_defaults(run=rosterCommand)
+
+    c = commands.add_parser("profile", parents=[common], help="Fetch trooper information, service records and awards.")
+    targets(c)
+    c.add_argument("--processes", type=int, default=0, help="Parse in this many processes, with --workers threads fetching. Default: parse while fetching.")
+    c.set_defaults(run=profileCommand)
+
+    c = commands.add_parser("audit", parents=[common], help="Audit troopers.")
+    c.add_argument("audit", choices=("eibcib", "ncoa", "eloa", "rank"))
+    targets(c)
+    c.set_defaults(run=auditCommand)
+
+    c = commands.add_parser("export", parents=[common], help="Export rosters or profiles to typed Parquet/Arrow files. Needs pyarrow.")
+    c.add_argument("kind", choices=("roster", "profile"))
+    c.add_argument("path", help="File for roster, folder for profile (troopers, serviceRecords and awards files).")
+    targets(c)
+    c.add_argument("--columnar", choices=("parquet", "arrow"), default="parquet", help="File format. Default: parquet")
+    c.set_defaults(run=exportCommand)
+
+    c = commands.add_parser("import", parents=[common], help="Bulk add to milpacs from a .csv file. See milpacEditor.bulkAdd for row formats.")
+    c.add_argument("kind", choices=("service-records", "awards", "uniforms"))
+    c.add_argument("csv", help="Path to .csv file.")
+    c.set_defaults(run=importCommand)
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.resume and args.format != "jsonl":
+        parser().error("--resume needs --format jsonl")
+    if args.resume and args.output == "-":
+        parser().error("--resume needs --output set to a file, to read finished troopers/rows from")
+
+    if args.cookie_dir:
+        os.makedirs(args.cookie_dir, exist_ok=True)
+        os.environ["CAV_COOKIE_FILE"] = os.path.join(args.cookie_dir, "cookies.json")
+    if args.archive_dir:
+        os.environ["CAV_ARCHIVE_DIR"] = args.archive_dir
+    if args.base_url:
+        import cavConfig
+        cavConfig.setBaseURL(args.base_url)
+
+    import cavMetrics
+    cavMetrics.configureLogging(args.log_level, True if args.log_json else None)
+
+    run = args.run
+    if args.profile:
+        import cavProfiler
+        cavProfiler.enable(args.profile)
+        run = cavProfiler.profiled(f"cav.{args.command}")(run)
+
+    out = output(args.output, args.format, args.resume)
+    try:
+        run(args, out)
+    finally:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
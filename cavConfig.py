@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Shared configuration for all Cav Scrapers tools.
+
+import json
+import os
+
+_baseURL = os.environ.get("CAV_BASE_URL", "https://7cav.us").rstrip("/")
+_ranks = None # Entries of ranks.json. Loaded once, by ranks().
+
+
+def baseURL():
+    '''
+    Get the site every tool talks to. Defaults to https://7cav.us, can be overridden with the
+        CAV_BASE_URL environment variable or setBaseURL() (Ex: to point at standInServer.py).
+
+    Output (str): Base URL, without a trailing slash.
+    '''
+    return _baseURL
+
+
+def setBaseURL(url):
+    '''
+    Point every tool at a different site.
+
+    Inputs:
+        url (str): New base URL. (Ex: http://127.0.0.1:8077)
+    '''
+    global _baseURL
+    _baseURL = url.rstrip("/")
+
+
+def ranks():
+    '''
+    Get the rank table. ranks.json is read on first use and shared by every caller after, so don't modify it.
+
+    Output (list): Rank entries from ranks.json, lowest to highest. Each a dict of short, long, paygrade and milpacImage.
+    '''
+    global _ranks
+    if _ranks is None:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ranks.json")) as file:
+            _ranks = json.load(file)
+    return _ranks
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Opt-in request/stage instrumentation and structured logging for all Cav Scrapers tools.
+#
+# Metrics are off unless enabled with enable() or the CAV_METRICS environment variable.
+# With CAV_METRICS_JSON and/or CAV_METRICS_PROM set to file paths, a JSON summary and/or
+# Prometheus text file is written when the process exits. CAV_METRICS_PORT serves /metrics.
+
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# URL path patterns, in order, to the page type they are reported as.
+PAGE_TYPES = [
+    (re.compile(r"^/rosters/?$"), "roster"),
+    (re.compile(r"^/rosters/profile"), "profile"),
+    (re.compile(r"^/rosters/.*(add|uniform)"), "form"),
+    (re.compile(r"^/rosters/.*save"), "save"),
+    (re.compile(r"^/forums/"), "forum"),
+    (re.compile(r"^/threads/"), "thread"),
+    (re.compile(r"^/conversations/(add|insert)"), "form"),
+    (re.compile(r"^/conversations/"), "conversation"),
+    (re.compile(r"^/login/"), "login"),
+    (re.compile(r"^/account/"), "account")
+]
+
+_enabled = bool(os.environ.get("CAV_METRICS"))
+_lock = threading.Lock()
+_counters = {} # (metric name, labels tuple) to value.
+_histograms = {} # (metric name, labels tuple) to [bucket counts..., sum, count].
+_nullTimer = contextlib.nullcontext()
+
+
+def enable(on=True):
+    '''
+    Turn metric collection on or off.
+    '''
+    global _enabled
+    _enabled = on
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    Forget every recorded metric.
+    '''
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def pageType(url):
+    '''
+    Classify a URL by the kind of page it is.
+
+    Inputs:
+        url (str): Full URL.
+
+    Output (str): Page type. (Ex: roster, profile, forum, thread, conversation, form, save, login, other)
+    '''
+    path = urllib.parse.urlsplit(url).path
+    for pattern, name in PAGE_TYPES:
+        if pattern.search(path):
+            return name
+    return "other"
+
+
+def count(name, labels=(), value=1):
+    '''
+    Add to a counter.
+
+    Inputs:
+        name (str): Metric name.
+        labels (tuple) [OPTIONAL]: (label, value) pairs.
+        value (float) [OPTIONAL]: Amount to add. Default: 1
+    '''
+    if not _enabled:
+        return
+    key = (name, tuple(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, labels, seconds):
+    '''
+    Record a duration in a histogram.
+
+    Inputs:
+        name (str): Metric name.
+        labels (tuple): (label, value) pairs.
+        seconds (float): Observed duration.
+    '''
+    if not _enabled:
+        return
+    key = (name, tuple(labels))
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b:
+                h[i] += 1
+                break
+        h[-2] += seconds # Sum.
+        h[-1] += 1 # Count. Durations over the last bucket are only counted here, as +Inf.
+
+
+def cache(name, hit):
+    '''
+    Record a cache lookup.
+
+    Inputs:
+        name (str): Cache name.
+        hit (bool): True if the lookup was served from the cache.
+    '''
+    count("cav_cache_requests_total", (("cache", name), ("result", "hit" if hit else "miss")))
+
+
+@contextlib.contextmanager
+def _timer(stage, page):
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        observe("cav_stage_seconds", (("stage", stage), ("page", page)), time.perf_counter() - start)
+        observe("cav_stage_cpu_seconds", (("stage", stage), ("page", page)), time.thread_time() - cpu) # Less than wall means waiting.
+
+
+def timer(stage, page="none"):
+    '''
+    Time a block of work. Does nothing when metrics are disabled.
+
+    Inputs:
+        stage (str): Stage of work. (Ex: parse, audit, write)
+        page (str) [OPTIONAL]: Page type or item the work is about. (Ex: roster, profile)
+
+    Output: Context manager.
+    '''
+    return _timer(stage, page) if _enabled else _nullTimer
+
+
+def timed(stage, page="none"):
+    '''
+    Decorator version of timer(). Only costs a flag check per call when metrics are disabled.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _timer(stage, page):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def recordResponse(r, *args, **kwargs):
+    '''
+    requests response hook. Records request count, status, bytes and latency per page type.
+    '''
+    if not _enabled:
+        return
+    page = pageType(r.url)
+    count("cav_http_requests_total", (("method", r.request.method), ("page", page), ("status", str(r.status_code))))
+    size = int(r.headers.get("Content-Length", 0)) if kwargs.get("stream") else len(r.content) # Reading a streamed body here would download it all.
+    count("cav_http_response_bytes_total", (("page", page),), size)
+    observe("cav_http_request_seconds", (("page", page),), r.elapsed.total_seconds())
+
+
+def instrument(s):
+    '''
+    Attach the metrics hook to a requests session.
+
+    Inputs:
+        s (requests.Session): Session to instrument.
+
+    Output (requests.Session): The same session.
+    '''
+    if recordResponse not in s.hooks["response"]:
+        s.hooks["response"].append(recordResponse)
+    return s
+
+
+def summary():
+    '''
+    Output (dict): Every metric, for JSON export. Histograms include bucket counts, count, sum and mean. Bucket
+        counts are cumulative, as in Prometheus: each is the observations at or under it, and +Inf is all of them.
+    '''
+    with _lock:
+        counters = [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(_counters.items())]
+        histograms = []
+        for (n, l), h in sorted(_histograms.items()):
+            buckets, cumulative = {}, 0
+            for i, b in enumerate(BUCKETS):
+                cumulative += h[i]
+                buckets[str(b)] = cumulative
+            buckets["+Inf"] = h[-1] # Slots are the buckets, then sum, then count. Over 10s is only in +Inf.
+            histograms.append({
+                "name": n,
+                "labels": dict(l),
+                "buckets": buckets,
+                "count": h[-1],
+                "sum": h[-2],
+                "mean": h[-2] / h[-1] if h[-1] else None
+            })
+
+    hits = {}
+    for c in counters:
+        if c["name"] == "cav_cache_requests_total":
+            hits.setdefault(c["labels"]["cache"], {"hit": 0, "miss": 0})[c["labels"]["result"]] += c["value"]
+
+    return {
+        "counters": counters,
+        "histograms": histograms,
+        "cacheHitRate": {k: v["hit"] / (v["hit"] + v["miss"]) for k, v in hits.items()}
+    }
+
+
+def formatLabels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+
+def prometheus():
+    '''
+    Output (str): Every metric in Prometheus text exposition format.
+    '''
+    lines = []
+    with _lock:
+        seen = set()
+        for (n, l), v in sorted(_counters.items()):
+            if n not in seen:
+                lines.append(f"# TYPE {n} counter")
+                seen.add(n)
+            lines.append(f"{n}{formatLabels(l)} {v}")
+        for (n, l), h in sorted(_histograms.items()):
+            if n not in seen:
+                lines.append(f"# TYPE {n} histogram")
+                seen.add(n)
+            cumulative = 0
+            for i, b in enumerate(BUCKETS):
+                cumulative += h[i]
+                lines.append(f"{n}_bucket{formatLabels(l + (('le', str(b)),))} {cumulative}")
+            lines.append(f"{n}_bucket{formatLabels(l + (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{n}_sum{formatLabels(l)} {h[-2]}")
+            lines.append(f"{n}_count{formatLabels(l)} {h[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def writeJSON(path):
+    with open(path, "w") as file:
+        json.dump(summary(), file, indent=4)
+
+
+def writePrometheus(path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as file:
+        file.write(prometheus())
+    os.replace(tmp, path) # Atomic, for node_exporter's textfile collector.
+
+
+def serve(port=9108, host="127.0.0.1"):
+    '''
+    Serve metrics at http://host:port/metrics from a background thread.
+
+    Output (ThreadingHTTPServer): Running server.
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Only needed when serving, so not on import.
+
+    class handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            data = (json.dumps(summary()) if self.path.startswith("/metrics.json") else prometheus()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class jsonFormatter(logging.Formatter):
+    '''
+    Log formatter writing one JSON object per line, including any fields passed with extra={}.
+    '''
+    reserved = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self.reserved})
+        return json.dumps(entry, default=str)
+
+
+def configureLogging(level=None, jsonFormat=None):
+    '''
+    Configure the "cav" logger every tool logs to. By default, messages are printed to stdout as plain text,
+        the same as the old print() calls.
+
+    Inputs:
+        level (str) [OPTIONAL]: Log level. Default: CAV_LOG_LEVEL environment variable, or INFO.
+        jsonFormat (bool) [OPTIONAL]: Write structured JSON lines. Default: True if CAV_LOG_FORMAT is "json".
+    '''
+    level = level or os.environ.get("CAV_LOG_LEVEL", "INFO")
+    if jsonFormat is None:
+        jsonFormat = os.environ.get("CAV_LOG_FORMAT", "").lower() == "json"
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(jsonFormatter() if jsonFormat else logging.Formatter("%(message)s"))
+
+    root = logging.getLogger("cav")
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+
+
+def getLogger(name):
+    '''
+    Get a tool's logger. (Ex: getLogger("milpacScraper") logs as cav.milpacScraper)
+    '''
+    return logging.getLogger(f"cav.{name}")
+
+
+def exportAtExit():
+    if os.environ.get("CAV_METRICS_JSON"):
+        writeJSON(os.environ["CAV_METRICS_JSON"])
+    if os.environ.get("CAV_METRICS_PROM"):
+        writePrometheus(os.environ["CAV_METRICS_PROM"])
+
+
+configureLogging()
+atexit.register(exportAtExit)
+if _enabled and os.environ.get("CAV_METRICS_PORT"):
+    serve(int(os.environ["CAV_METRICS_PORT"]))
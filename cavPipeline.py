@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Staged crawl pipeline: threads fetch pages, a process pool parses them on every core, and the caller's thread
+# writes the results. Bounded queues between the stages give backpressure, so a slow stage throttles the others
+# instead of letting pages pile up in memory.
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cavConfig
+import cavMetrics
+import cavSession
+
+log = cavMetrics.getLogger("cavPipeline")
+
+_done = object() # Marks the end of a queue.
+
+
+def parseProfile(HTML):
+    '''
+    Parse stage for profile pages.
+
+    Output (dict): trooper().information(), plus serviceRecord and awards lists.
+    '''
+    import milpacScraper
+    t = milpacScraper.trooper(0, HTML)
+    return dict(t.information(), serviceRecord=t.serviceRecord(), awards=t.awards())
+
+
+def parseRoster(HTML):
+    '''
+    Parse stage for roster pages. Output (list): roster().getInfo(shaveRank=True) rows, without the roster ID.
+    '''
+    import milpacScraper
+    return [r[:6] for r in milpacScraper.roster(0, HTML).getInfo(shaveRank=True)]
+
+
+def parsePosts(HTML):
+    '''
+    Parse stage for thread pages. Output (list): forumScraper.parsePostList().
+    '''
+    import forumScraper
+    return forumScraper.parsePostList(HTML)
+
+
+def timedParse(function, HTML):
+    # Runs in the worker process. Metrics there aren't seen by the parent, so the time is sent back with the result.
+    start = time.perf_counter()
+    return function(HTML), time.perf_counter() - start
+
+
+class pipeline:
+    '''
+    Fetch, parse and write pages in three overlapping stages.
+
+    Inputs:
+        fetchWorkers (int) [OPTIONAL]: Threads fetching pages. Default: 8
+        parseWorkers (int) [OPTIONAL]: Processes parsing pages. 0 parses in a thread instead. Default: one per CPU.
+        queueSize (int) [OPTIONAL]: Most pages waiting between two stages. Default: 64
+        session (requests.Session) [OPTIONAL]: Session to fetch with. Default: cavSession.publicSession()
+    '''
+    def __init__(self, fetchWorkers=8, parseWorkers=None, queueSize=64, session=False):
+        self.fetchWorkers = max(1, fetchWorkers)
+        self.parseWorkers = (os.cpu_count() or 1) if parseWorkers is None else parseWorkers
+        self.queueSize = queueSize
+        self.s = session or cavSession.publicSession()
+
+    def run(self, jobs, parse, write):
+        '''
+        Run the pipeline until every job is written.
+
+        Inputs:
+            jobs (iterable): (key, URL) tuples. Read lazily, so it can be a generator.
+            parse (function): Takes page HTML, returns the parsed result. Must be a module level function, so it can be
+                sent to worker processes, which import its module fresh. (Ex: parseProfile)
+            write (function): Takes (key, result). Called from this thread, in the order pages finished fetching.
+
+        Output (dict): Stats with the following keys:
+            fetched, parsed, written (int): Items through each stage.
+            errors (list): (key, stage, error) tuples for items that failed. They are not written.
+            seconds (dict): Busy time of each stage. Fetch and parse are summed over their workers.
+            waited (dict): Time each stage spent blocked on a full queue, a sign it is outpacing the next stage.
+            wall (float): Total seconds.
+        '''
+        stats = {"fetched": 0, "parsed": 0, "written": 0, "errors": [],
+            "seconds": {"fetch": 0.0, "parse": 0.0, "write": 0.0}, "waited": {"fetch": 0.0, "parse": 0.0}, "wall": 0.0}
+        lock = threading.Lock()
+        fetched = queue.Queue(self.queueSize) # (key, HTML) waiting to be parsed.
+        parsing = queue.Queue(self.queueSize) # (key, future) waiting to be written, in order.
+        jobs = iter(jobs)
+        start = time.perf_counter()
+
+        def record(stage, key=None, seconds=0, error=None, waited=0):
+            with lock:
+                if error is not None:
+                    stats["errors"].append((key, stage, error))
+                    log.warning(f"{stage} failed for {key}: {error}", extra={"key": key, "stage": stage, "error": error})
+                else:
+                    stats[{"fetch": "fetched", "parse": "parsed", "write": "written"}[stage]] += 1
+                stats["seconds"][stage] += seconds
+                if waited:
+                    stats["waited"][stage] += waited
+            cavMetrics.count("cav_pipeline_items_total", (("stage", stage), ("result", "error" if error else "ok")))
+            if error is None:
+                cavMetrics.observe("cav_stage_seconds", (("stage", stage), ("page", "pipeline")), seconds)
+
+        def put(q, item):
+            t = time.perf_counter()
+            q.put(item) # Blocks while the next stage is behind.
+            return time.perf_counter() - t
+
+        def fetcher():
+            while True:
+                with lock:
+                    job = next(jobs, None)
+                if job is None:
+                    return
+                key, url = job
+                t = time.perf_counter()
+                try:
+                    r = self.s.get(url)
+                    r.raise_for_status()
+                except Exception as e:
+                    record("fetch", key, error=repr(e))
+                    continue
+                seconds = time.perf_counter() - t
+                record("fetch", key, seconds, waited=put(fetched, (key, r.text)))
+
+        def fetchers():
+            threads = [threading.Thread(target=fetcher, daemon=True) for _ in range(self.fetchWorkers)]
+            for f in threads:
+                f.start()
+            for f in threads:
+                f.join()
+            fetched.put(_done)
+
+        def dispatcher(pool):
+            while True:
+                item = fetched.get()
+                if item is _done:
+                    parsing.put(_done)
+                    return
+                key, HTML = item
+                if pool is None:
+                    future = inline(parse, HTML)
+                else:
+                    future = pool.submit(timedParse, parse, HTML)
+                waited = put(parsing, (key, future))
+                with lock:
+                    stats["waited"]["parse"] += waited
+
+        # Spawned, not forked: workers start on the dispatcher's first submit, after the fetch threads, and forking
+        # a process with threads running can copy a held lock into the child.
+        pool = None
+        if self.parseWorkers > 0:
+            pool = ProcessPoolExecutor(self.parseWorkers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            threading.Thread(target=fetchers, daemon=True).start()
+            threading.Thread(target=dispatcher, args=(pool,), daemon=True).start()
+
+            while True:
+                item = parsing.get()
+                if item is _done:
+                    break
+                key, future = item
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    record("parse", key, error=repr(e))
+                    continue
+                record("parse", key, seconds)
+
+                t = time.perf_counter()
+                try:
+                    write(key, result)
+                except Exception as e:
+                    record("write", key, error=repr(e))
+                    continue
+                record("write", key, time.perf_counter() - t)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        stats["wall"] = time.perf_counter() - start
+        log.info(f"Pipeline wrote {stats['written']} items in {stats['wall']:.1f}s, {len(stats['errors'])} errors",
+            extra={k: v for k, v in stats.items() if k != "errors"})
+        return stats
+
+    def profiles(self, milpacIDs, write, parse=parseProfile):
+        '''
+        Fetch and parse many troopers' profiles. See run() for write and the output.
+
+        Inputs:
+            milpacIDs (iterable): Milpac IDs. Used as the key passed to write.
+            write (function): Takes (milpac ID, result).
+            parse (function) [OPTIONAL]: Parse stage. Default: parseProfile
+        '''
+        return self.run(((ID, f"{cavConfig.baseURL()}/rosters/profile?uniqueid={ID}") for ID in milpacIDs), parse, write)
+
+
+class inline:
+    # Stands in for a future when parsing in-thread (parseWorkers=0).
+    def __init__(self, function, HTML):
+        try:
+            self.value, self.error = timedParse(function, HTML), None
+        except Exception as e:
+            self.value, self.error = None, e
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Opt-in profiling of long running entry points (roster scrapes, roster audits, bulk adds, thread scrapes).
+#
+# Off unless the CAV_PROFILE environment variable names a report file (or enable() is called). When on, each
+# outermost profiled call records cProfile stats, tracemalloc peak and top allocations, wall and CPU time, and
+# per-stage wall/CPU time from cavMetrics, and appends them to the JSON report. The raw cProfile stats are saved
+# next to it (report.json -> report.scrapeAllRosters.prof) for snakeviz or pstats.
+#
+# Example: CAV_PROFILE=profile.json python cav.py audit ncoa --roster 1
+
+import functools
+import json
+import os
+import threading
+import time
+
+import cavMetrics
+
+log = cavMetrics.getLogger("cavProfiler")
+
+TOP = int(os.environ.get("CAV_PROFILE_TOP", 25)) # Functions and allocations listed in the report.
+
+_report = os.environ.get("CAV_PROFILE") or None
+_active = threading.local() # Set while a profiled call runs on a thread, so nested entry points aren't profiled twice.
+_lock = threading.Lock()
+_running = 0 # Profiled calls running in the process, on any thread. tracemalloc is process-wide, so the first starts it.
+_started = False # True if tracemalloc was started here rather than by the caller, so the last run stops it.
+
+
+def enable(report):
+    '''
+    Turn profiling on.
+
+    Inputs:
+        report (str): JSON report file. Runs are appended to it.
+    '''
+    global _report
+    _report = report
+    cavMetrics.enable() # Stage times come from cavMetrics.
+
+
+def enabled():
+    return _report is not None
+
+
+def profiled(name):
+    '''
+    Decorator for entry points. Only costs a check per call when profiling is off.
+
+    Inputs:
+        name (str): Name of the entry point in the report. (Ex: NCOA.checkRoster)
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _report is None or getattr(_active, "on", False):
+                return function(*args, **kwargs)
+            return run(name, function, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run(name, function, *args, **kwargs):
+    '''
+    Call function under the profilers and add the run to the report. Memory peaks are process-wide: runs overlapping
+        on other threads share one, counted from when the first of them started.
+
+    Output: Result of function.
+    '''
+    import cProfile
+    import tracemalloc
+
+    global _running, _started
+    if not cavMetrics.enabled():
+        cavMetrics.enable()
+    before = stages()
+    with _lock:
+        if _running == 0:
+            _started = tracemalloc.is_tracing() == False
+            if _started:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        _running += 1
+
+    profiler = cProfile.Profile()
+    _active.on = True
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _active.on = False
+        with _lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            _running -= 1
+            if _running == 0 and _started:
+                tracemalloc.stop()
+        save(name, profiler, wall, cpu, peak, snapshot, before)
+
+
+def stages():
+    '''
+    Output (dict): "stage/page" to [count, wall seconds, CPU seconds], from cavMetrics stage timers so far.
+    '''
+    output = {}
+    for h in cavMetrics.summary()["histograms"]:
+        if h["name"] in ("cav_stage_seconds", "cav_stage_cpu_seconds"):
+            key = f"{h['labels'].get('stage')}/{h['labels'].get('page')}"
+            row = output.setdefault(key, [0, 0.0, 0.0])
+            if h["name"] == "cav_stage_seconds":
+                row[0], row[1] = h["count"], h["sum"]
+            else:
+                row[2] = h["sum"]
+    return output
+
+
+def save(name, profiler, wall, cpu, peak, snapshot, before):
+    import pstats
+    import tracemalloc
+
+    stats = pstats.Stats(profiler)
+    functions = []
+    for (file, line, function), (calls, primitive, total, cumulative, callers) in sorted(
+            stats.stats.items(), key=lambda s: -s[1][3])[:TOP]:
+        functions.append({
+            "function": f"{os.path.basename(file)}:{line}({function})",
+            "calls": calls,
+            "totalSeconds": round(total, 6),
+            "cumulativeSeconds": round(cumulative, 6)
+        })
+
+    allocations = [{
+        "location": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+        "bytes": s.size,
+        "count": s.count
+    } for s in snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")[:TOP]]
+
+    after = stages()
+    stageTimes = {}
+    for key, (calls, stageWall, stageCPU) in after.items():
+        old = before.get(key, [0, 0.0, 0.0])
+        if calls > old[0]:
+            stageTimes[key] = {"calls": calls - old[0], "wallSeconds": round(stageWall - old[1], 6), "cpuSeconds": round(stageCPU - old[2], 6)}
+
+    entry = {
+        "entry": name,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wallSeconds": round(wall, 6),
+        "cpuSeconds": round(cpu, 6), # Much less than wall means waiting, mostly on the network.
+        "peakMemoryBytes": peak,
+        "stages": stageTimes,
+        "functions": functions,
+        "allocations": allocations,
+        "profile": f"{os.path.splitext(_report)[0]}.{name}.prof"
+    }
+
+    with _lock:
+        stats.dump_stats(entry["profile"])
+        try:
+            with open(_report) as file:
+                report = json.load(file)
+        except (IOError, ValueError):
+            report = []
+        report.append(entry)
+        with open(_report, "w") as file:
+            json.dump(report, file, indent=4)
+    log.info(f"Profiled {name}: {wall:.2f}s wall, {cpu:.2f}s CPU, {peak / 1e6:.1f}MB peak. Saved to {_report}",
+        extra={"entry": name, "wall": wall, "cpu": cpu, "peak": peak, "file": _report})
+
+
+if _report:
+    cavMetrics.enable()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# Shared, persistent authenticated session for the 7cav.us forums.
+
+import collections
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import cavConfig
+import cavMetrics
+
+MEMO_TTL = float(os.environ.get("CAV_MEMO_TTL", 60)) # Seconds fetched pages are reused for. 0 turns reuse off.
+
+_sessions = {} # Authenticated sessions already created in this process, keyed by credentials path.
+_flights = [] # Every singleflight, for setMemoTTL().
+_public = None # Shared session for pages that don't need a login.
+_lock = threading.Lock()
+
+log = cavMetrics.getLogger("cavSession")
+
+
+class loginFailed(Exception):
+    '''
+    Raised when the forums don't accept a login.
+    '''
+
+
+def credentialsPath(credentialsJSON=False):
+    '''
+    Resolve the location of the credentials file.
+
+    Inputs:
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file.
+            If False [DEFAULT], uses credentials.json in the same folder as this script.
+
+    Output (str): Absolute path to the credentials file.
+    '''
+    if credentialsJSON == False:
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "credentials.json")
+    return os.path.abspath(credentialsJSON)
+
+
+def loadCredentials(credentialsJSON=False):
+    '''
+    Load forum credentials.
+
+    Inputs:
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+
+    Output (dict): Credentials with the following keys:
+        user (str): Forum login name.
+        pass (str): Forum password.
+    '''
+    path = credentialsPath(credentialsJSON)
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except IOError: # File cannot be opened.
+        assert False, f"credentials.json file not found at {path}"
+    except ValueError: # File cannot be parsed.
+        assert False, "Error with formatting of credentials.json file."
+
+
+def cookiePath(credentialsJSON=False):
+    '''
+    Location of the persisted cookie jar for a credentials file.
+        Can be overridden with the CAV_COOKIE_FILE environment variable.
+
+    Output (str): Path to cookie jar file. Stored next to the credentials file by default.
+    '''
+    if os.environ.get("CAV_COOKIE_FILE"):
+        return os.environ["CAV_COOKIE_FILE"]
+    return os.path.join(os.path.dirname(credentialsPath(credentialsJSON)), "cookies.json")
+
+
+def saveCookies(s, path):
+    '''
+    Persist a session's cookie jar to disk. File is written atomically, so concurrent processes never read a half written jar.
+
+    Inputs:
+        s (requests.Session): Session to save.
+        path (str): Location of cookie jar file.
+    '''
+    cookies = [{
+        "name": c.name,
+        "value": c.value,
+        "domain": c.domain,
+        "path": c.path,
+        "expires": c.expires,
+        "secure": c.secure
+    } for c in s.cookies]
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as file:
+        json.dump(cookies, file, indent=4)
+    os.replace(tmp, path)
+
+
+def forSite(domain):
+    '''
+    Output (bool): True if a cookie domain belongs to the site cavConfig.baseURL() points at.
+    '''
+    host = urllib.parse.urlsplit(cavConfig.baseURL()).hostname or ""
+    domain = domain.lstrip(".")
+    return domain in (host, f"{host}.local") or host.endswith(f".{domain}") # http.cookiejar adds .local to dotless hosts.
+
+
+def loadCookies(s, path):
+    '''
+    Load a persisted cookie jar into a session, if it is still usable. Only cookies for the current site are
+        loaded, so a jar saved against another site (Ex: standInServer.py) is never taken as a login.
+
+    Inputs:
+        s (requests.Session): Session to load cookies into.
+        path (str): Location of cookie jar file.
+
+    Output (bool): True if an unexpired login cookie was loaded, False otherwise.
+    '''
+    try:
+        with open(path) as file:
+            cookies = json.load(file)
+    except (IOError, ValueError): # No jar yet, or jar is corrupt. Either way a fresh login is needed.
+        return False
+
+    now = time.time()
+    loggedIn = False
+    for c in cookies:
+        if c["expires"] is not None and c["expires"] <= now: # Skip expired cookies.
+            continue
+        if forSite(c["domain"]) == False:
+            continue
+        s.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"], expires=c["expires"], secure=c["secure"])
+        if c["name"] == "xf_user": # XenForo's "remember me" cookie. Only present when logged in.
+            loggedIn = True
+
+    return loggedIn
+
+
+def isLoggedIn(s):
+    '''
+    Check with the server that a session is still authenticated.
+
+    Inputs:
+        s (requests.Session): Session to check.
+
+    Output (bool): True if the forums show the session as logged in.
+    '''
+    return "logout/" in s.get(f"{cavConfig.baseURL()}/account/").text
+
+
+def login(s, credentialsJSON=False):
+    '''
+    Log a session into the forums. Raises loginFailed if the forums don't redirect with a login cookie set.
+
+    Inputs:
+        s (requests.Session): Session to authenticate.
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+
+    Output (requests.Response): Response of the login request.
+    '''
+    c = loadCredentials(credentialsJSON)
+
+    auth = {
+        "login": c["user"],
+        "register": 0,
+        "password": c["pass"],
+        "remember": 1
+    }
+
+    r = s.post(f"{cavConfig.baseURL()}/login/login", data=auth, allow_redirects=False)
+    if r.status_code != 303 or "xf_user" not in r.cookies: # A wrong password shows the login form again, with a 200.
+        raise loginFailed(f"Login to {cavConfig.baseURL()} as {c['user']} failed (status {r.status_code})")
+    return r
+
+
+def getSession(credentialsJSON=False, validate=False, forceLogin=False):
+    '''
+    Get an authenticated session. Every tool should get its session from here.
+        Logs in at most once per process. The cookie jar is persisted to disk and reused by other processes until it expires,
+        so most runs start without a login round trip.
+
+    Inputs:
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+        validate (bool) [OPTIONAL]: Check with the server that a reused cookie jar is still logged in. Default: False
+        forceLogin (bool) [OPTIONAL]: Ignore any saved cookies and log in again. Default: False
+
+    Output (requests.Session): Authenticated session, shared with every other caller using the same credentials file.
+    '''
+    key = credentialsPath(credentialsJSON)
+
+    with _lock:
+        if key in _sessions and forceLogin == False:
+            s = _sessions[key]
+            if validate == False or isLoggedIn(s):
+                cavMetrics.cache("session", True)
+                return s
+        cavMetrics.cache("session", False)
+
+        import requests # Imported with the first session, so tools that don't fetch start faster.
+        s = archived(cavMetrics.instrument(requests.Session()))
+        path = cookiePath(credentialsJSON)
+
+        reused = False
+        if forceLogin == False and loadCookies(s, path):
+            reused = validate == False or isLoggedIn(s)
+        cavMetrics.cache("cookieJar", reused)
+
+        if reused == False:
+            s.cookies.clear()
+            login(s, credentialsJSON) # Raises before a failed login is saved.
+            saveCookies(s, path)
+            log.info("Logged into forums", extra={"cookieFile": path})
+
+        _sessions[key] = s
+        return s
+
+
+class deferredSession:
+    '''
+    Authenticated session that logs in on first use, not when created. Tools hold one from construction, so
+        creating a tool costs nothing, and runs that never make an authenticated request never log in.
+
+    Inputs:
+        credentialsJSON (str) [OPTIONAL]: See getSession().
+
+    Use it as a requests.Session. Attributes are those of getSession(credentialsJSON).
+    '''
+    def __init__(self, credentialsJSON=False):
+        self.credentialsJSON = credentialsJSON
+        self.session = None
+
+    def __getattr__(self, name):
+        if self.session is None:
+            self.session = getSession(self.credentialsJSON)
+        return getattr(self.session, name)
+
+
+def archived(s):
+    '''
+    Archive the pages a session fetches, if the CAV_ARCHIVE_DIR environment variable is set. See pageArchive.py.
+
+    Output (requests.Session): The same session.
+    '''
+    if os.environ.get("CAV_ARCHIVE_DIR"):
+        import pageArchive
+        pageArchive.fromEnvironment().attach(s)
+    return s
+
+
+def publicSession():
+    '''
+    Get the shared session for pages that don't need a login (rosters, profiles).
+        Reusing one session keeps connections to the site open between requests.
+
+    Output (requests.Session): Unauthenticated session.
+    '''
+    global _public
+    with _lock:
+        if _public is None:
+            import requests
+            _public = archived(cavMetrics.instrument(requests.Session()))
+        return _public
+
+
+class singleflight:
+    '''
+    Thread safe call coalescing. Concurrent calls with the same key share one call and its result, which is then
+        reused for a short while, so duplicate work within a run happens once.
+
+    Inputs:
+        ttl (float) [OPTIONAL]: Seconds a result is reused for after its call finishes. 0 only shares calls in flight.
+            Default: MEMO_TTL, and follows setMemoTTL().
+        maxsize (int) [OPTIONAL]: Most results kept. The oldest are dropped first. Default: 512
+        name (str) [OPTIONAL]: Name used in cache metrics. Default: singleflight
+    '''
+    def __init__(self, ttl=None, maxsize=512, name="singleflight"):
+        self.ttl = MEMO_TTL if ttl is None else ttl
+        self.maxsize = maxsize
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {} # Key to threading.Event of the call in flight.
+        self.memo = collections.OrderedDict() # Key to (expiry, result), oldest first.
+        if ttl is None:
+            _flights.append(self) # An explicit ttl (Ex: 0 for pages that change per user) is left alone by setMemoTTL().
+
+    def do(self, key, function, remember=None):
+        '''
+        Call function, unless a call with the same key is in flight or recently finished. Exceptions are shared with
+            callers waiting on the same call, but not remembered.
+
+        Inputs:
+            key: Hashable key of the call.
+            function (function): Called with no arguments.
+            remember (function) [OPTIONAL]: Called with the result. Only results it returns True for are reused after
+                the call finishes. Default: every result is.
+
+        Output: Result of function.
+        '''
+        with self.lock:
+            hit = self.memo.get(key)
+            if hit is not None and hit[0] > time.monotonic():
+                cavMetrics.cache(self.name, True)
+                return hit[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = threading.Event()
+                call.result, call.error = None, None
+
+        if leader == False:
+            cavMetrics.count("cav_coalesced_total", (("cache", self.name),))
+            call.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        cavMetrics.cache(self.name, False)
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call.error is None and self.ttl > 0 and (remember is None or remember(call.result)):
+                    self.memo[key] = (time.monotonic() + self.ttl, call.result)
+                    self.memo.move_to_end(key)
+                    while len(self.memo) > self.maxsize:
+                        self.memo.popitem(last=False)
+            call.set()
+        return call.result
+
+    def clear(self):
+        with self.lock:
+            self.memo.clear()
+
+
+def setMemoTTL(seconds):
+    '''
+    Change how long every singleflight using the default TTL reuses results, and forget what they hold. 0 only shares calls in flight
+        (Ex: for benchmarks, which must parse every time).
+    '''
+    for f in _flights:
+        f.ttl = seconds
+        f.clear()
+
+
+_pages = singleflight(name="page") # Public pages (rosters, profiles), reused for MEMO_TTL seconds.
+_sessionPages = singleflight(0, name="sessionPage") # Pages fetched logged in (Ex: conversations). Only shared in flight.
+
+
+def fetchText(url, s=False):
+    '''
+    Fetch a page's text. The same page requested by several threads at once is fetched once. Pages fetched with
+        publicSession() are also reused for MEMO_TTL seconds, if the site answered OK. Pages fetched with any other
+        session can change between reads (Ex: new messages), so they are never reused. Not for forms.
+
+    Inputs:
+        url (str): Page URL.
+        s (requests.Session) [OPTIONAL]: Session to fetch with. Default: publicSession()
+
+    Output (str): Page HTML.
+    '''
+    s = s or publicSession()
+    def get():
+        r = s.get(url)
+        return r.ok, r.text
+    flight = _pages if s is publicSession() else _sessionPages
+    return flight.do((id(s), url), get, remember=lambda result: result[0])[1] # Error pages (Ex: 429, 503) aren't reused.
+
+
+def fetchPages(s, urls, workers=4):
+    '''
+    Fetch pages concurrently, yielding them in the order given. Only a few pages past the one being
+        consumed are fetched ahead, so memory stays bounded on long crawls.
+
+    Inputs:
+        s (requests.Session): Session to fetch with.
+        urls (iterable): URLs to fetch.
+        workers (int) [OPTIONAL]: Concurrent requests. Default: 4
+
+    Output (generator): (url, page HTML) tuples, in the same order as urls.
+    '''
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = collections.deque()
+        for url in urls:
+            pending.append((url, pool.submit(fetchText, url, s)))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            url, future = pending.popleft()
+            nextURL = next(urls, None)
+            if nextURL is not None:
+                pending.append((nextURL, pool.submit(fetchText, nextURL, s)))
+            yield url, future.result()
+
+
+class rateLimiter:
+    '''
+    Thread safe limit on how often something happens, shared by every thread using it. Allows short bursts.
+
+    Inputs:
+        rate (float): Most events per second, on average.
+        burst (int) [OPTIONAL]: Events allowed back to back before the rate applies. Default: 1
+    '''
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate if rate else 0
+        self.burst = burst
+        self.allowance = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''
+        Block until the next event is allowed.
+        '''
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.burst, self.allowance + (now - self.last) / self.interval)
+            self.last = now
+            delay = (1 - self.allowance) * self.interval if self.allowance < 1 else 0
+            self.allowance -= 1
+        if delay:
+            time.sleep(delay)
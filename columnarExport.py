@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# Typed, columnar (Parquet or Arrow) export of rosters, trooper profiles and audit results, for loading into
+# dataframes. Needs pyarrow: pip install pyarrow
+#
+# Dates are real dates, and repeated text (rank, position, award) is dictionary encoded. Rows are written in
+# row groups as they arrive, so exporting the whole unit never holds more than one row group in memory.
+
+import json
+
+import cavConfig
+import cavMetrics
+import cavSession
+import milpacScraper
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = cavMetrics.getLogger("columnarExport")
+
+# Table name to [(column, type)]. Types: int, date, text, category (dictionary encoded text), list (list of text).
+SCHEMAS = {
+    "roster": [("milpacID", "int"), ("rank", "category"), ("name", "text"), ("enlisted", "date"), ("promoted", "date"),
+        ("position", "category"), ("rosterID", "int")],
+    "troopers": [("milpacID", "int"), ("name", "text"), ("rank", "category"), ("primary", "category"), ("secondary", "list"),
+        ("enlisted", "date"), ("promoted", "date"), ("forumName", "text"), ("forumID", "int")],
+    "serviceRecords": [("milpacID", "int"), ("date", "date"), ("entry", "text")],
+    "awards": [("milpacID", "int"), ("date", "date"), ("award", "category"), ("details", "text")],
+    "audits": [("milpacID", "int"), ("audit", "category"), ("result", "text")]
+}
+
+
+def arrowType(kind):
+    return {
+        "int": pyarrow.int64(),
+        "date": pyarrow.date32(),
+        "text": pyarrow.string(),
+        "category": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        "list": pyarrow.list_(pyarrow.string())
+    }[kind]
+
+
+def toDate(value):
+    # Roster dates can be blank or unusual. Those become nulls rather than failing the export.
+    if not value or not isinstance(value, str):
+        return value or None
+    try:
+        return milpacScraper.parseDate(value)
+    except ValueError:
+        return None
+
+
+class writer:
+    '''
+    Write rows of one table to a Parquet or Arrow file, a row group at a time.
+
+    Inputs:
+        path (str): File to write.
+        table (str): Table in SCHEMAS. (Ex: roster)
+        format (str) [OPTIONAL]: parquet or arrow (Arrow IPC file, also read as Feather). Default: parquet
+        rowGroupSize (int) [OPTIONAL]: Rows held before they are written. Default: 50000
+    '''
+    def __init__(self, path, table, format="parquet", rowGroupSize=50000):
+        if pyarrow is None:
+            raise ImportError("Columnar export needs pyarrow: pip install pyarrow")
+        self.path = path
+        self.table = table
+        self.format = format
+        self.rowGroupSize = rowGroupSize
+        self.columns = SCHEMAS[table]
+        self.schema = pyarrow.schema([(name, arrowType(kind)) for name, kind in self.columns])
+        self.buffer = {name: [] for name, kind in self.columns}
+        # Dictionaries only grow, so each row group's dictionary extends the last. Arrow files need that.
+        self.dictionaries = {name: {} for name, kind in self.columns if kind == "category"}
+        self.file = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row):
+        '''
+        Add one row.
+
+        Inputs:
+            row (dict|list): Values by column name, or in SCHEMAS order. Date strings (Ex: Nov 11, 2020) are parsed.
+        '''
+        values = row if isinstance(row, dict) else dict(zip(self.buffer, row))
+        for name, kind in self.columns:
+            v = values.get(name)
+            if kind == "int":
+                v = int(v) if v not in (None, "") else None
+            elif kind == "date":
+                v = toDate(v)
+            elif kind == "list":
+                v = list(v) if v else []
+            self.buffer[name].append(v)
+        self.rows += 1
+        if len(self.buffer[self.columns[0][0]]) >= self.rowGroupSize:
+            self.flush()
+
+    def writeMany(self, rows):
+        for r in rows:
+            self.write(r)
+
+    def flush(self):
+        '''
+        Write buffered rows as one row group.
+        '''
+        if not self.buffer[self.columns[0][0]]:
+            return
+        arrays = []
+        for name, kind in self.columns:
+            if kind == "category":
+                d = self.dictionaries[name]
+                indices = pyarrow.array([None if v is None else d.setdefault(v, len(d)) for v in self.buffer[name]], pyarrow.int32())
+                arrays.append(pyarrow.DictionaryArray.from_arrays(indices, pyarrow.array(list(d), pyarrow.string())))
+            else:
+                arrays.append(pyarrow.array(self.buffer[name], arrowType(kind)))
+        batch = pyarrow.record_batch(arrays, schema=self.schema)
+
+        with cavMetrics.timer("write", self.format):
+            self.open().write_batch(batch)
+        self.buffer = {name: [] for name in self.buffer}
+
+    def open(self):
+        if self.file is None:
+            if self.format == "parquet":
+                self.file = pyarrow.parquet.ParquetWriter(self.path, self.schema, compression="zstd")
+            else:
+                self.file = pyarrow.ipc.new_file(self.path, self.schema,
+                    options=pyarrow.ipc.IpcWriteOptions(compression="zstd", emit_dictionary_deltas=True))
+        return self.file
+
+    def close(self):
+        '''
+        Write any remaining rows and finish the file. A table with no rows still gets a file, with the schema.
+        '''
+        self.flush()
+        self.open().close()
+        log.info(f"Exported {self.rows} {self.table} rows to {self.path}", extra={"rows": self.rows, "file": self.path})
+
+
+def rosterRows(rosterID, info):
+    '''
+    Output (generator): roster table rows from roster().getInfo(shaveRank=True) rows.
+    '''
+    for r in info:
+        yield [r[0], r[1], r[2], r[3], r[4], r[5], rosterID]
+
+
+def exportRosters(path, rosterIDs=False, format="parquet", workers=4):
+    '''
+    Export every trooper on the rosters.
+
+    Inputs:
+        path (str): File to write.
+        rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+        format (str) [OPTIONAL]: parquet or arrow. Default: parquet
+        workers (int) [OPTIONAL]: Rosters fetched at once. Default: 4
+
+    Output (int): Rows written.
+    '''
+    urls = {f"{cavConfig.baseURL()}/rosters?id={ID}": ID for ID in (rosterIDs or milpacScraper.roster().getRosters())}
+    with writer(path, "roster", format) as w:
+        for url, html in cavSession.fetchPages(cavSession.publicSession(), urls, workers):
+            w.writeMany(rosterRows(urls[url], milpacScraper.roster(urls[url], html).getInfo(shaveRank=True)))
+    return w.rows
+
+
+def exportTroopers(paths, milpacIDs, format="parquet", workers=8):
+    '''
+    Export troopers' information, service records and awards, fetching their profiles concurrently.
+
+    Inputs:
+        paths (dict): File to write for each of troopers, serviceRecords and awards. Tables left out aren't written.
+        milpacIDs (iterable): Milpac IDs.
+        format (str) [OPTIONAL]: parquet or arrow. Default: parquet
+        workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+
+    Output (dict): Rows written to each table.
+    '''
+    writers = {table: writer(path, table, format) for table, path in paths.items()}
+    try:
+        for milpacID, t in milpacScraper.troopers(milpacIDs, workers):
+            rows = {} # Parsed in full first, so a profile that fails part way leaves nothing half written.
+            try:
+                if "troopers" in writers:
+                    rows["troopers"] = [dict(t.information(), milpacID=milpacID)]
+                if "serviceRecords" in writers:
+                    rows["serviceRecords"] = [(milpacID, d, e) for d, e in t.serviceRecord()]
+                if "awards" in writers:
+                    rows["awards"] = [(milpacID, d, a, details) for d, a, details in t.awards()]
+            except Exception as e: # One bad profile doesn't stop the export.
+                log.warning(f"Could not export trooper {milpacID}: {e!r}", extra={"milpacID": milpacID, "error": repr(e)})
+                continue
+            for table, w in writers.items():
+                w.writeMany(rows[table])
+    finally:
+        for w in writers.values():
+            w.close()
+    return {table: w.rows for table, w in writers.items()}
+
+
+def exportAudit(path, audit, results, format="parquet"):
+    '''
+    Export audit results. Results differ in shape between audits, so each is stored as JSON text.
+
+    Inputs:
+        path (str): File to write.
+        audit (str): Name of audit. (Ex: ncoa)
+        results (iterable): (milpac ID, result) tuples, or a dict of milpac ID to result (Ex: NCOA().checkRoster()).
+        format (str) [OPTIONAL]: parquet or arrow. Default: parquet
+
+    Output (int): Rows written.
+    '''
+    with writer(path, "audits", format) as w:
+        for milpacID, result in (results.items() if isinstance(results, dict) else results):
+            w.write((milpacID, audit, json.dumps(result, default=str)))
+    return w.rows
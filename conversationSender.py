@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Send the same notice to many troopers, one conversation each, with a resumable delivery ledger.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cavMetrics
+import cavSession
+import forumScraper
+
+log = cavMetrics.getLogger("conversationSender")
+
+
+def recipientsFor(milpacIDs, resolver):
+    '''
+    Build recipients from milpac IDs, with their roster data for personalising templates.
+
+    Inputs:
+        milpacIDs (list): Milpac IDs of troopers to message.
+        resolver (memberResolver.resolver): Resolver with the troopers' forum names.
+
+    Output (list): Recipient dicts with the keys milpacID, forumName, name, first, last and rank.
+        Troopers without a known forum name are left out.
+    '''
+    output = []
+    for ID in milpacIDs:
+        m = resolver.member(ID)
+        if m is None or m["forumName"] is None:
+            log.warning(f"No forum name known for milpacID: {ID}", extra={"milpacID": ID})
+            continue
+        name = m["name"] or ""
+        output.append({
+            "milpacID": m["milpacID"],
+            "forumName": m["forumName"],
+            "name": name,
+            "first": name.split(" ")[0],
+            "last": name.split(" ")[-1],
+            "rank": m["rank"] or ""
+        })
+    return output
+
+
+def readLedger(path):
+    '''
+    Read a delivery ledger.
+
+    Output (dict): Forum name (lowercase) to the last entry recorded for it.
+    '''
+    entries = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    e = json.loads(line)
+                    entries[e["forumName"].lower()] = e
+    return entries
+
+
+class sender:
+    '''
+    Start one conversation per recipient, concurrently and rate limited. Title and body are templates, filled
+        with each recipient's fields using str.format. (Ex: "Good evening {rank} {last},")
+
+    Every attempt is appended to the ledger, so an interrupted run can be resumed by running it again with the
+        same ledger. Recipients already marked sent are skipped, failed ones are retried.
+
+    Inputs:
+        title (str): Conversation title template.
+        body (str): First message template, in HTML.
+        ledger (str) [OPTIONAL]: Location of delivery ledger (JSON lines). If False [DEFAULT], nothing is recorded.
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+        workers (int) [OPTIONAL]: Conversations started at once. Default: 4
+        rate (float) [OPTIONAL]: Most requests per second to the forums, across all workers. Default: 2
+        leave (bool) [OPTIONAL]: Leave each conversation after starting it. Replies are still received. Default: False
+        ignoreMessages (bool) [OPTIONAL]: When leaving, also ignore further replies. Default: False
+    '''
+    def __init__(self, title, body, ledger=False, credentialsJSON=False, workers=4, rate=2, leave=False, ignoreMessages=False):
+        self.title = title
+        self.body = body
+        self.ledger = ledger
+        self.convo = forumScraper.conversations(credentialsJSON)
+        self.workers = workers
+        self.limit = cavSession.rateLimiter(rate, burst=workers)
+        self.leave = leave
+        self.ignoreMessages = ignoreMessages
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        if self.ledger == False:
+            return
+        with self.lock, open(self.ledger, "a", encoding="utf-8") as file:
+            file.write(json.dumps(entry) + "\n")
+
+    def sendOne(self, recipient):
+        '''
+        Start a conversation with one recipient.
+
+        Inputs:
+            recipient (dict): Recipient, with at least forumName and any fields the templates use.
+
+        Output (dict): Ledger entry with forumName, status (sent/failed), conversationID, error and time.
+        '''
+        entry = {"forumName": recipient["forumName"], "milpacID": recipient.get("milpacID"), "status": "failed",
+            "conversationID": None, "error": None, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        try:
+            title = self.title.format(**recipient)
+            body = self.body.format(**recipient)
+            self.limit.wait()
+            r = self.convo.insert([recipient["forumName"]], title, body)
+            entry["conversationID"] = forumScraper.conversationID(r.url)
+            if entry["conversationID"] is None:
+                entry["error"] = f"Conversation not created ({r.status_code} {r.reason})"
+            else:
+                entry["status"] = "sent"
+                if self.leave == True:
+                    self.limit.wait()
+                    self.convo.leave(entry["conversationID"], self.ignoreMessages)
+        except KeyError as e:
+            entry["error"] = f"Recipient has no {e} field for the template"
+        except Exception as e: # Network errors. Recorded so the recipient is retried on resume.
+            entry["error"] = repr(e)
+
+        self.record(entry)
+        cavMetrics.count("cav_conversations_total", (("status", entry["status"]),))
+        if entry["status"] == "sent":
+            log.info(f"Sent to {entry['forumName']}", extra=entry)
+        else:
+            log.error(f"Failed to send to {entry['forumName']}: {entry['error']}", extra=entry)
+        return entry
+
+    def send(self, recipients):
+        '''
+        Send to every recipient not already marked sent in the ledger.
+
+        Inputs:
+            recipients (list): Forum names (str), or recipient dicts with at least forumName and any fields the templates use.
+                See recipientsFor() to build them from milpac IDs.
+
+        Output (dict): Counts of sent, failed and skipped recipients.
+        '''
+        recipients = [{"forumName": r} if isinstance(r, str) else r for r in recipients]
+        done = readLedger(self.ledger) if self.ledger else {}
+        todo = [r for r in recipients if done.get(r["forumName"].lower(), {}).get("status") != "sent"]
+        log.info(f"Sending to {len(todo)} recipients, {len(recipients) - len(todo)} already sent",
+            extra={"recipients": len(todo), "skipped": len(recipients) - len(todo)})
+
+        self.convo.token() # Fetch the form token once, before the workers need it.
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            entries = list(pool.map(self.sendOne, todo))
+
+        summary = {
+            "sent": sum(1 for e in entries if e["status"] == "sent"),
+            "failed": sum(1 for e in entries if e["status"] != "sent"),
+            "skipped": len(recipients) - len(todo)
+        }
+        log.info(f"Sent {summary['sent']}, failed {summary['failed']}, skipped {summary['skipped']}", extra=summary)
+        return summary
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+# Full re-scrapes split across many worker processes, on one machine or several sharing a folder. The milpac ID
+# space (or the roster list) is split into shards in a SQLite work queue. Workers lease a shard, keep the lease
+# alive with heartbeats while they fetch and parse its profiles, and write the profiles back to the same database.
+# A shard whose worker fails or disappears is leased again once its lease runs out.
+#
+# Example: python crawlCoordinator.py plan crawl.db --range 1 60000 --size 500
+#          python crawlCoordinator.py work crawl.db --workers 8 --rate 4   (on each machine, as many as wanted)
+#          python crawlCoordinator.py status crawl.db
+#          python crawlCoordinator.py export crawl.db profiles.jsonl
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cavConfig
+import cavMetrics
+import cavSession
+import milpacScraper
+
+log = cavMetrics.getLogger("crawlCoordinator")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT, start INTEGER, end INTEGER,
+    state TEXT DEFAULT 'pending', worker TEXT, leaseUntil REAL, attempts INTEGER DEFAULT 0, -- Pending shards aren't leased before leaseUntil.
+    checked INTEGER, error TEXT, updated REAL,
+    UNIQUE (kind, start, end));
+CREATE INDEX IF NOT EXISTS shardState ON shards (state, leaseUntil);
+CREATE TABLE IF NOT EXISTS profiles (milpacID INTEGER PRIMARY KEY, shard INTEGER, found INTEGER, profile TEXT, fetched REAL);
+"""
+
+
+class leaseLost(Exception):
+    '''
+    Raised in a worker when another worker has taken over its shard.
+    '''
+
+
+class coordinator:
+    '''
+    SQLite work queue of shards. Safe to use from many threads, processes and machines at once.
+
+    Inputs:
+        path (str): Database file. For several machines, put it on storage they all mount. The default rollback
+            journal is used, as WAL doesn't work over network file systems.
+        leaseSeconds (float) [OPTIONAL]: How long a lease lasts without a heartbeat. Machines' clocks must agree to
+            well within this. Default: 300
+        maxAttempts (int) [OPTIONAL]: Leases a shard gets before it is marked failed. Default: 5
+    '''
+    def __init__(self, path, leaseSeconds=300, maxAttempts=5):
+        self.path = path
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        # A connection per call, so threads and processes never share one. Writers wait up to a minute for the lock.
+        return contextlib.closing(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    def plan(self, shards):
+        '''
+        Add shards. Shards already planned are left as they are, so planning again is safe.
+
+        Inputs:
+            shards (iterable): (kind, start, end) tuples. Kinds: ids (milpac IDs start to end) or roster (roster start).
+
+        Output (int): Shards added.
+        '''
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO shards (kind, start, end, updated) VALUES (?, ?, ?, ?)",
+                [(kind, int(start), int(end), time.time()) for kind, start, end in shards])
+            added = db.total_changes - before
+            db.execute("COMMIT")
+        log.info(f"Planned {added} shards", extra={"shards": added})
+        return added
+
+    def planRange(self, first, last, size=500):
+        '''
+        Split milpac IDs first to last (inclusive) into shards of size IDs. See plan().
+        '''
+        return self.plan(("ids", s, min(s + size - 1, last)) for s in range(first, last + 1, size))
+
+    def planRosters(self, rosterIDs):
+        '''
+        One shard per roster, holding everyone on it when the shard is worked. See plan().
+        '''
+        return self.plan(("roster", r, r) for r in rosterIDs)
+
+    def lease(self, worker):
+        '''
+        Lease the next shard that is pending (and not backing off after a failure), or whose lease ran out.
+
+        Inputs:
+            worker (str): Name of the worker taking it.
+
+        Output (dict|None): Shard, with id, kind, start, end and attempts. None if nothing can be leased now.
+        '''
+        now = time.time()
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE") # Only one worker picks at a time, so a shard goes to one worker.
+            db.execute("UPDATE shards SET state = 'failed', error = 'Lease ran out', worker = NULL, updated = ? "
+                "WHERE state = 'leased' AND leaseUntil < ? AND attempts >= ?", (now, now, self.maxAttempts))
+            row = db.execute("SELECT id, kind, start, end, attempts FROM shards "
+                "WHERE state IN ('pending', 'leased') AND (leaseUntil IS NULL OR leaseUntil < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE shards SET state = 'leased', worker = ?, leaseUntil = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (worker, now + self.leaseSeconds, now, row[0]))
+            db.execute("COMMIT")
+        if row is None:
+            return None
+        cavMetrics.count("cav_shards_total", (("result", "leased"),))
+        return {"id": row[0], "kind": row[1], "start": row[2], "end": row[3], "attempts": row[4] + 1}
+
+    def heartbeat(self, shardID, worker):
+        '''
+        Extend a lease.
+
+        Output (bool): False if the worker no longer holds the shard.
+        '''
+        now = time.time()
+        with self.connect() as db:
+            return db.execute("UPDATE shards SET leaseUntil = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (now + self.leaseSeconds, now, shardID, worker)).rowcount == 1
+
+    def complete(self, shardID, worker, checked):
+        '''
+        Mark a shard done.
+
+        Inputs:
+            shardID (int): Shard.
+            worker (str): Worker that leased it.
+            checked (int): Milpac IDs checked, found or not.
+
+        Output (bool): False if the worker no longer held the shard. Its profiles are kept either way.
+        '''
+        with self.connect() as db:
+            done = db.execute("UPDATE shards SET state = 'done', checked = ?, error = NULL, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (checked, time.time(), shardID, worker)).rowcount == 1
+        cavMetrics.count("cav_shards_total", (("result", "done" if done else "lost"),))
+        return done
+
+    def fail(self, shardID, worker, error):
+        '''
+        Give a shard back, to be leased again after a wait that doubles with each attempt (10s, 20s, 40s, ... up to
+            leaseSeconds). After maxAttempts leases it is marked failed instead.
+        '''
+        now = time.time()
+        with self.connect() as db:
+            db.execute("UPDATE shards SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, error = ?, updated = ?, "
+                "leaseUntil = ? + MIN(?, 5 << attempts) WHERE id = ? AND worker = ? AND state = 'leased'",
+                (self.maxAttempts, error, now, now, self.leaseSeconds, shardID, worker))
+        cavMetrics.count("cav_shards_total", (("result", "failed"),))
+
+    def retryFailed(self):
+        '''
+        Put failed shards back in the queue, with their attempts reset.
+
+        Output (int): Shards put back.
+        '''
+        with self.connect() as db:
+            return db.execute("UPDATE shards SET state = 'pending', attempts = 0, leaseUntil = NULL, updated = ? WHERE state = 'failed'", (time.time(),)).rowcount
+
+    def status(self):
+        '''
+        Output (dict): Shards in each state (pending, leased, done, failed), and profiles found and not found.
+        '''
+        with self.connect() as db:
+            output = {state: count for state, count in db.execute("SELECT state, COUNT(*) FROM shards GROUP BY state")}
+            for found, count in db.execute("SELECT found, COUNT(*) FROM profiles GROUP BY found"):
+                output["profiles" if found else "missing"] = count
+        return output
+
+    def stored(self, IDs):
+        '''
+        Output (set): Milpac IDs of IDs already in the profiles table. Retried shards skip them.
+        '''
+        IDs = [int(i) for i in IDs]
+        if IDs == []:
+            return set()
+        with self.connect() as db:
+            return {r[0] for r in db.execute("SELECT milpacID FROM profiles WHERE milpacID BETWEEN ? AND ?", (min(IDs), max(IDs)))} & set(IDs)
+
+    def save(self, shardID, results):
+        '''
+        Write profiles in one transaction.
+
+        Inputs:
+            shardID (int): Shard they came from.
+            results (list): (milpac ID, profile dict or None if there is no such profile) tuples.
+        '''
+        if results == []:
+            return
+        now = time.time()
+        with self.connect() as db, cavMetrics.timer("write", "sqlite"):
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?)",
+                [(int(ID), shardID, int(p is not None), json.dumps(p) if p is not None else None, now) for ID, p in results])
+            db.execute("COMMIT")
+
+    def profiles(self):
+        '''
+        Output (generator): Every profile found, as a dict with milpacID, lowest ID first.
+        '''
+        with self.connect() as db:
+            for ID, profile in db.execute("SELECT milpacID, profile FROM profiles WHERE found = 1 ORDER BY milpacID"):
+                yield dict({"milpacID": ID}, **json.loads(profile))
+
+
+class worker:
+    '''
+    Lease shards from a coordinator and scrape their profiles until none are left.
+
+    Inputs:
+        queue (coordinator): Work queue.
+        workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+        rate (float) [OPTIONAL]: Most profile loads per second for this worker. None for no limit. Default: None
+        name (str) [OPTIONAL]: Name in the queue. Default: host:process ID
+        batch (int) [OPTIONAL]: Profiles written to the database at a time. Default: 100
+        tries (int) [OPTIONAL]: Times a profile is fetched through connection errors and 429/5xx responses before
+            its shard fails. Default: 3
+    '''
+    def __init__(self, queue, workers=8, rate=None, name=False, batch=100, tries=3):
+        self.queue = queue
+        self.workers = workers
+        self.limiter = cavSession.rateLimiter(rate, burst=workers) if rate else None
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch = batch
+        self.tries = tries
+        self.s = cavSession.publicSession()
+
+    def profile(self, milpacID):
+        '''
+        Output (tuple): (milpac ID, profile dict), or (milpac ID, None) if there is no such profile.
+        '''
+        url = f"{cavConfig.baseURL()}/rosters/profile?uniqueid={milpacID}"
+        for attempt in range(self.tries):
+            if attempt:
+                time.sleep(2 ** (attempt - 1)) # 1s, 2s, 4s, ...
+            if self.limiter is not None:
+                self.limiter.wait()
+            try:
+                r = self.s.get(url)
+            except OSError: # Connection errors. Every requests exception is an OSError.
+                if attempt == self.tries - 1:
+                    raise
+                continue
+            if r.status_code not in (429, 500, 502, 503, 504):
+                break
+        if r.status_code == 404:
+            return milpacID, None
+        r.raise_for_status()
+        t = milpacScraper.trooper(milpacID, r.text)
+        try:
+            information = t.information()
+        except IndexError: # Not a profile page. IDs that were never issued, or were deleted.
+            return milpacID, None
+        return milpacID, dict(information, serviceRecord=t.serviceRecord(), awards=t.awards())
+
+    def IDs(self, shard):
+        if shard["kind"] == "roster": # streamIDs() raises if the roster page can't be fetched.
+            IDs = [int(i) for i in milpacScraper.streamIDs(shard["start"])]
+            if IDs == []: # Not a real roster page (Ex: maintenance page). Failed, so it's retried, not marked done.
+                raise ValueError(f"Roster {shard['start']} page listed no troopers")
+            return IDs
+        return list(range(shard["start"], shard["end"] + 1))
+
+    def work(self, shard, lost):
+        '''
+        Scrape one shard's profiles, skipping those an earlier attempt already saved.
+
+        Inputs:
+            shard (dict): From coordinator.lease().
+            lost (threading.Event): Set by the heartbeat if the lease is lost.
+
+        Output (int): Milpac IDs checked.
+        '''
+        IDs = self.IDs(shard)
+        done = self.queue.stored(IDs)
+        IDs = [i for i in IDs if i not in done]
+
+        results = []
+        pool = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        try:
+            for result in pool.map(self.profile, IDs):
+                if lost.is_set():
+                    raise leaseLost(f"Shard {shard['id']} was taken over")
+                results.append(result)
+                if len(results) >= self.batch:
+                    self.queue.save(shard["id"], results)
+                    results = []
+        finally:
+            self.queue.save(shard["id"], results) # Kept even if the shard fails, so the next attempt does less.
+            pool.shutdown(wait=False, cancel_futures=True)
+        return len(IDs)
+
+    def beat(self, shard, stop, lost):
+        while not stop.wait(self.queue.leaseSeconds / 3):
+            try:
+                if self.queue.heartbeat(shard["id"], self.name) == False:
+                    lost.set()
+                    return
+            except sqlite3.Error as e: # A missed beat is fine. The lease lasts for three of them.
+                log.warning(f"Heartbeat failed: {e!r}", extra={"shard": shard["id"], "error": repr(e)})
+
+    def run(self, poll=2, maxShards=None):
+        '''
+        Work shards until every shard is done or failed.
+
+        Inputs:
+            poll (float) [OPTIONAL]: Seconds to wait before checking again, while only other workers' shards
+                (whose leases may run out) or failed shards backing off are left. Each check is one small query. Default: 2
+            maxShards (int) [OPTIONAL]: Stop after this many shards. Default: no limit.
+
+        Output (dict): Shards done and failed, and milpac IDs checked, by this worker.
+        '''
+        stats = {"done": 0, "failed": 0, "checked": 0}
+        while maxShards is None or stats["done"] + stats["failed"] < maxShards:
+            shard = self.queue.lease(self.name)
+            if shard is None:
+                left = self.queue.status()
+                if left.get("leased", 0) == 0 and left.get("pending", 0) == 0:
+                    break
+                time.sleep(poll)
+                continue
+
+            stop, lost = threading.Event(), threading.Event()
+            heart = threading.Thread(target=self.beat, args=(shard, stop, lost), daemon=True)
+            heart.start()
+            try:
+                with cavMetrics.timer("crawl", "shard"):
+                    count = self.work(shard, lost)
+                self.queue.complete(shard["id"], self.name, count)
+                stats["done"] += 1
+                stats["checked"] += count
+                log.info(f"Shard {shard['id']} done: {count} IDs checked", extra={"shard": shard["id"], "checked": count})
+            except leaseLost as e:
+                log.warning(str(e), extra={"shard": shard["id"]})
+            except Exception as e:
+                self.queue.fail(shard["id"], self.name, repr(e))
+                stats["failed"] += 1
+                log.warning(f"Shard {shard['id']} failed (attempt {shard['attempts']}): {e!r}",
+                    extra={"shard": shard["id"], "attempt": shard["attempts"], "error": repr(e)})
+            finally:
+                stop.set()
+                heart.join()
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split full re-scrapes across worker processes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    c = commands.add_parser("plan", help="Add shards to the queue.")
+    c.add_argument("db", help="Queue database.")
+    c.add_argument("--range", nargs=2, type=int, metavar=("FIRST", "LAST"), help="Milpac IDs to scrape, inclusive.")
+    c.add_argument("--size", type=int, default=500, help="Milpac IDs per shard. Default: 500")
+    c.add_argument("--rosters", nargs="*", type=int, default=None, help="One shard per roster. No IDs for every roster.")
+
+    c = commands.add_parser("work", help="Work shards until none are left.")
+    c.add_argument("db", help="Queue database.")
+    c.add_argument("--workers", type=int, default=8, help="Profiles fetched at once. Default: 8")
+    c.add_argument("--rate", type=float, default=None, help="Most profile loads per second for this worker. Default: no limit.")
+    c.add_argument("--lease", type=float, default=300, help="Seconds a lease lasts without a heartbeat. Default: 300")
+
+    c = commands.add_parser("status", help="Show shard and profile counts.")
+    c.add_argument("db", help="Queue database.")
+    c.add_argument("--retry-failed", action="store_true", help="Put failed shards back in the queue first.")
+
+    c = commands.add_parser("export", help="Write every profile found to a JSON lines file.")
+    c.add_argument("db", help="Queue database.")
+    c.add_argument("output", help="File to write.")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        q = coordinator(args.db)
+        if args.range:
+            q.planRange(args.range[0], args.range[1], args.size)
+        if args.rosters is not None:
+            q.planRosters(args.rosters or milpacScraper.roster().getRosters())
+        print(json.dumps(q.status()))
+    elif args.command == "work":
+        print(json.dumps(worker(coordinator(args.db, args.lease), args.workers, args.rate).run()))
+    elif args.command == "status":
+        q = coordinator(args.db)
+        if args.retry_failed:
+            q.retryFailed()
+        print(json.dumps(q.status()))
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            for p in coordinator(args.db).profiles():
+                file.write(json.dumps(p) + "\n")
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+# Recorded and synthetic 7cav.us pages, for testing and benchmarking without touching the live site.
+
+import datetime
+import os
+import random
+import urllib.parse
+
+import requests
+
+import cavConfig
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+FIRST_NAMES = ["John", "James", "Robert", "Michael", "William", "David", "Richard", "Joseph", "Thomas", "Charles",
+    "Daniel", "Matthew", "Anthony", "Mark", "Steven", "Paul", "Andrew", "Joshua", "Kevin", "Brian", "Sean", "Ryan"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Miller", "Davis", "Wilson", "Anderson", "Taylor",
+    "Thomas", "Moore", "Martin", "Jackson", "Thompson", "White", "Harris", "Clark", "Lewis", "O'Neil", "D'Angelo", "Walker"]
+POSITIONS = ["Rifleman 1/A/1-7", "Automatic Rifleman 2/A/1-7", "Squad Leader 1/B/2-7", "Platoon Sergeant 2/C/1-7",
+    "Pilot 1/D/1-7", "Reservist IC", "S1 Clerk", "S6 Technician", "Discharged", "Retired w/Honors"]
+OPERATIONS = ["Red Dawn", "Iron Hammer", "Desert Viper", "Crimson Tide", "Silent Fox", "Broken Arrow"]
+
+
+def formatDate(date):
+    '''
+    Format a date the way milpacs displays it.
+
+    Inputs:
+        date (date): Date to format.
+
+    Output (str): Date string. (Ex: Nov 11, 2020)
+    '''
+    return f"{MONTHS[date.month - 1]} {date.day}, {date.year}"
+
+
+def loadRanks():
+    '''
+    Output (list): Rank entries from ranks.json, lowest to highest.
+    '''
+    return cavConfig.ranks()
+
+
+def syntheticTrooper(milpacID, rosterID=1, seed=0, ranks=None):
+    '''
+    Build a fake, but realistic, trooper. The same milpacID and seed always give the same trooper.
+
+    Inputs:
+        milpacID (int): Milpac ID of trooper.
+        rosterID (int) [OPTIONAL]: Roster the trooper is on. Default: 1
+        seed (int) [OPTIONAL]: Seed for the whole synthetic unit. Default: 0
+        ranks (list) [OPTIONAL]: Output of loadRanks(). Loaded if not given.
+
+    Output (dict): Trooper with the following keys:
+        milpacID (int), rosterID (int), rank (dict, entry from ranks.json), first (str), last (str),
+        enlisted (date), promoted (date), position (str), secondary (list), forumName (str), forumID (int),
+        serviceRecord (list): (date, entry) tuples, newest first.
+        awards (list): (date, title, details) tuples, newest first.
+    '''
+    ranks = ranks or loadRanks()
+    rng = random.Random(seed * 1000003 + int(milpacID))
+
+    first = rng.choice(FIRST_NAMES)
+    last = rng.choice(LAST_NAMES)
+    enlisted = datetime.date(2008, 1, 1) + datetime.timedelta(days=rng.randrange(5800))
+    today = datetime.date(2024, 12, 31)
+
+    records = [(enlisted, f"Graduated Basic Combat Training. Promoted to Private E-2")]
+    awards = []
+    day = enlisted
+    rankIndex = 2 # Private
+    topIndex = rng.choice([2, 3, 4, 4, 5, 5, 6, 6, 7, 8, 9, 13, 18, 19, 20])
+    missions = 0
+
+    while day < today:
+        day += datetime.timedelta(days=rng.randrange(20, 120))
+        if day >= today:
+            break
+        roll = rng.random()
+        if roll < 0.45:
+            missions += 1
+            records.append((day, f"Combat Mission - Operation {rng.choice(OPERATIONS)} ({missions})"))
+        elif roll < 0.6 and rankIndex < topIndex:
+            rankIndex += 1
+            r = ranks[rankIndex]
+            records.append((day, f"Promoted to {r['long']} {r['paygrade']}"))
+        elif roll < 0.65 and rankIndex >= 5:
+            records.append((day, f"Graduated NCOA Warrior Leadership Course Phase {rng.choice(['I', 'II'])}"))
+        elif roll < 0.68:
+            records.append((day, "Placed on ELOA"))
+            day += datetime.timedelta(days=rng.randrange(14, 200))
+            if day < today:
+                records.append((day, "Returned from ELOA"))
+        elif roll < 0.70:
+            records.append((day, "Discharged for inactivity"))
+            day += datetime.timedelta(days=rng.randrange(30, 700))
+            if day < today:
+                records.append((day, "Reinstated after returning from discharge"))
+        elif roll < 0.75:
+            awards.append((day, "Good Conduct Medal", f"Awarded for {rng.randrange(1, 8)} year(s) of service"))
+
+    for count, title in ((1, "Expert Infantry Badge"), (5, "Combat Infantry Badge"), (10, "Combat Infantry Badge 2nd Award")):
+        if missions >= count and rng.random() < 0.85:
+            awards.append((records[-1][0], title, f"Attended {count} combat missions"))
+
+    promoted = max([d for d, e in records if "Promoted" in e])
+    records.sort(key=lambda x: x[0], reverse=True)
+    awards.sort(key=lambda x: x[0], reverse=True)
+
+    return {
+        "milpacID": int(milpacID),
+        "rosterID": int(rosterID),
+        "rank": ranks[rankIndex],
+        "first": first,
+        "last": last,
+        "enlisted": enlisted,
+        "promoted": promoted,
+        "position": rng.choice(POSITIONS),
+        "secondary": [rng.choice(POSITIONS)] if rng.random() < 0.2 else [],
+        "forumName": f"{last.replace(chr(39), '')}.{first[0]}",
+        "forumID": 10000 + int(milpacID),
+        "serviceRecord": [(formatDate(d), e) for d, e in records],
+        "awards": [(formatDate(d), t, dt) for d, t, dt in awards]
+    }
+
+
+def syntheticUnit(rosters=3, troopersPerRoster=100, seed=0):
+    '''
+    Build a fake unit.
+
+    Inputs:
+        rosters (int) [OPTIONAL]: Amount of rosters. Default: 3
+        troopersPerRoster (int) [OPTIONAL]: Troopers on each roster. Default: 100
+        seed (int) [OPTIONAL]: Seed for the unit. Default: 0
+
+    Output (dict): Roster ID (int) to list of troopers from syntheticTrooper().
+    '''
+    ranks = loadRanks()
+    unit = {}
+    for r in range(1, rosters + 1):
+        unit[r] = [syntheticTrooper(r * 100000 + i, r, seed, ranks) for i in range(1, troopersPerRoster + 1)]
+    return unit
+
+
+def escape(text):
+    '''
+    Escape text the way the forums do. Apostrophes become &#039;, which the scrapers undo.
+    '''
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("'", "&#039;")
+
+
+def page(title, body):
+    return f'<!DOCTYPE html>\n<html>\n<head>\n<title>{title} | 7th Cavalry Gaming Regiment</title>\n</head>\n<body>\n{body}\n</body>\n</html>\n'
+
+
+def pageNav(current, total):
+    return f'<div class="PageNav"><span class="pageNavHeader">Page {current} of {total}</span></div>'
+
+
+def rosterPage(rosterID, troopers, rosterIDs=(1,)):
+    '''
+    Render a roster page, as served by /rosters?id=
+
+    Inputs:
+        rosterID (int): ID of the roster.
+        troopers (list): Troopers from syntheticTrooper().
+        rosterIDs (list) [OPTIONAL]: All roster IDs, for the roster navigation links.
+
+    Output (str): Page HTML.
+    '''
+    nav = "\n".join(f'<li><a href="rosters/?id={r}">Roster {r}</a></li>' for r in rosterIDs)
+    items = []
+    for t in troopers:
+        items.append(
+            f'<li class="rosterListItem">\n'
+            f'\t<div class="rosterRank"><img src="{t["rank"]["milpacImage"]}" /></div>\n'
+            f'\t<a href="rosters/profile?uniqueid={t["milpacID"]}">\n'
+            f'\t\t{escape(t["rank"]["long"] + " " + t["first"] + " " + t["last"])}\n'
+            f'\t</a>\n'
+            f'\t<div class="rosterEnlisted">{formatDate(t["enlisted"])}</div>\n'
+            f'\t<div class="rosterPromo">{formatDate(t["promoted"])}</div>\n'
+            f'\t<div class="rosterCustom1">{escape(t["position"])}</div>\n'
+            f'</li>'
+        )
+    return page(f"Roster {rosterID}", f'<ul class="rosterNav">\n{nav}\n</ul>\n<ol class="rosterList">\n' + "\n".join(items) + "\n</ol>")
+
+
+def profilePage(t):
+    '''
+    Render a trooper's profile page, as served by /rosters/profile?uniqueid=
+
+    Inputs:
+        t (dict): Trooper from syntheticTrooper().
+
+    Output (str): Page HTML.
+    '''
+    secondaries = "\n".join(f'\t\t<span class="username">{escape(s)}</span>' for s in t["secondary"])
+    records = "\n".join(
+        f'<tr>\n\t<td class="recordDate">{d}</td>\n\t<td class="recordDetails">{escape(e)}</td>\n</tr>' for d, e in t["serviceRecord"])
+    awards = "\n".join(
+        f'<tr>\n\t<td class="awardDate">{d}</td>\n\t<td class="awardTitle">{escape(a)}</td>\n'
+        f'\t<td class="awardImage"><img src="data/awards/{len(a)}.png" /></td>\n\t<td class="awardDetails">{escape(dt)}</td>\n</tr>'
+        for d, a, dt in t["awards"])
+    slug = t["forumName"].lower().replace(".", "-")
+
+    body = (
+        f'<div class="rosterProfile">\n<dl>\n'
+        f'\t<dt>Full Name:</dt>\n\t\t<dd>{escape(t["first"] + " " + t["last"])}</dd>\n'
+        f'\t<dt>Rank:</dt>\n\t\t<dd>{t["rank"]["long"]}</dd>\n'
+        f'\t<dt>Primary Position:</dt>\n\t\t<dd>{escape(t["position"])}</dd>\n'
+        f'\t<dt>Secondary Positions:</dt>\n\t\t<dd>\n{secondaries}\n\t\t</dd>\n'
+        f'\t<dt>Enlisted:</dt>\n\t\t<dd>{formatDate(t["enlisted"])}</dd>\n'
+        f'\t<dt>Promotion:</dt>\n\t\t<dd>{formatDate(t["promoted"])}</dd>\n'
+        f'\t<dt>Forum Account:</dt>\n\t\t<dd><a href="members/{slug}.{t["forumID"]}/">{escape(t["forumName"])}</a></dd>\n'
+        f'</dl>\n</div>\n'
+        f'<table class="serviceRecord">\n<tr>\n\t<th class="recordDate" width="10%">Date</th>\n\t<th class="recordDetails">Details</th>\n</tr>\n'
+        f'{records}\n</table>\n'
+        f'<table class="awards">\n{awards}\n</table>'
+    )
+    return page(f"{t['first']} {t['last']}", body)
+
+
+def threadListPage(forumID, threads, current=1, total=1):
+    '''
+    Render a page of a forum's thread list, as served by /forums/{forumID}/page-{n}
+
+    Inputs:
+        forumID (int): ID of forum.
+        threads (list): Dicts with the keys ID, Author, Title and Replies.
+        current (int) [OPTIONAL]: Page number. Default: 1
+        total (int) [OPTIONAL]: Total pages in forum. Default: 1
+
+    Output (str): Page HTML.
+    '''
+    items = "\n".join(
+        f'<li class="discussionListItem visible" data-author="{escape(t["Author"])}" id="thread-{t["ID"]}">\n'
+        f'\t<h3 class="title"><a class="PreviewTooltip" href="threads/thread.{t["ID"]}/">{escape(t["Title"])}</a></h3>\n'
+        f'\t<dl class="major"><dt>Replies:</dt> <dd>{t["Replies"]}</dd></dl>\n'
+        f'</li>' for t in threads)
+    return page(f"Forum {forumID}", f'{pageNav(current, total)}\n<ol class="discussionListItems">\n{items}\n</ol>')
+
+
+def messagePage(kind, messages, current=1, total=1):
+    '''
+    Render a page of a thread (kind "post") or conversation (kind "message").
+
+    Inputs:
+        kind (str): "post" or "message".
+        messages (list): Dicts with the keys ID, Author and Content (HTML).
+        current (int) [OPTIONAL]: Page number. Default: 1
+        total (int) [OPTIONAL]: Total pages. Default: 1
+
+    Output (str): Page HTML.
+    '''
+    items = "\n".join(
+        f'<li class="message" data-author="{escape(m["Author"])}" id="{kind}-{m["ID"]}">\n'
+        f'\t<div class="messageContent"><blockquote class="messageText">{m["Content"]}</blockquote></div>\n'
+        f'</li>' for m in messages)
+    token = '<input type="hidden" name="_xfToken" value="1,1600000000,standintoken" />'
+    return page(kind.title(), f'{pageNav(current, total)}\n<ol class="messageList">\n{items}\n</ol>\n<form>\n{token}\n</form>')
+
+
+def syntheticMessages(kind, ID, page=1, perPage=20, authors=None, seed=0):
+    '''
+    Build fake posts or conversation messages for one page.
+
+    Inputs:
+        kind (str): "post" or "message".
+        ID (int): Thread or conversation ID.
+        page (int) [OPTIONAL]: Page number. Default: 1
+        perPage (int) [OPTIONAL]: Messages per page. Default: 20
+        authors (list) [OPTIONAL]: Forum names to pick authors from.
+        seed (int) [OPTIONAL]: Seed. Default: 0
+
+    Output (list): Dicts with the keys ID, Author and Content.
+    '''
+    rng = random.Random(seed * 7919 + int(ID) * 31 + page)
+    authors = authors or [f"{l.replace(chr(39), '')}.{f[0]}" for f, l in zip(FIRST_NAMES, LAST_NAMES)]
+    messages = []
+    for i in range(perPage):
+        milpacID = rng.randrange(100, 50000)
+        messages.append({
+            "ID": int(ID) * 1000 + (page - 1) * perPage + i,
+            "Author": rng.choice(authors),
+            "Content": (f'Please add a service record entry for <a href="rosters/profile?uniqueid={milpacID}">{rng.choice(LAST_NAMES)}</a>.'
+                f'<br />\n\tOperation {rng.choice(OPERATIONS)} attendance confirmed.<br />\n\n' * rng.randrange(1, 4))
+        })
+    return messages
+
+
+def formPage(awards=None):
+    '''
+    Render a form page carrying the hidden _xfToken, and the award list for award forms.
+
+    Inputs:
+        awards (list) [OPTIONAL]: (ID, name) tuples for the award select list.
+
+    Output (str): Page HTML.
+    '''
+    options = "\n".join(f'<option value="{i}">{escape(a)}</option>' for i, a in (awards or []))
+    return page("Form", f'<form method="post">\n<select name="award_id">\n{options}\n</select>\n'
+        f'<input type="hidden" name="_xfToken" value="1,1600000000,standintoken" />\n</form>')
+
+
+def fixtureName(url):
+    '''
+    File name a recorded page is stored under.
+
+    Inputs:
+        url (str): Full URL, or path and query (Ex: /rosters/profile?uniqueid=371).
+
+    Output (str): File name.
+    '''
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path.rstrip("/") or "/"
+    return urllib.parse.quote(path + (f"?{parts.query}" if parts.query else ""), safe="") + ".html"
+
+
+def recordPages(paths, directory, session=None):
+    '''
+    Record live pages into a fixture directory, to be served back by standInServer.py.
+
+    Inputs:
+        paths (list): Paths and queries to record. (Ex: ["/rosters?id=1", "/rosters/profile?uniqueid=371"])
+        directory (str): Folder to save pages to.
+        session (requests.Session) [OPTIONAL]: Session to fetch with. Use cavSession.getSession() for pages that need a login.
+
+    Output (int): Amount of pages recorded.
+    '''
+    s = session or requests.Session()
+    os.makedirs(directory, exist_ok=True)
+    for p in paths:
+        with open(os.path.join(directory, fixtureName(p)), "w", encoding="utf-8") as file:
+            file.write(s.get(f"{cavConfig.baseURL()}{p}").text)
+        print(f"Recorded {p}")
+    return len(paths)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Incremental crawler over many forums. Each cycle reads the forums' thread lists, and only fetches the pages of
+# threads whose reply count moved since the last cycle. Threads with the most new replies are fetched first. Threads
+# left over by the budget, or whose fetch failed, are kept in the state file and fetched in a later cycle.
+#
+# Example: python forumCrawler.py 12 34 56 --output posts.jsonl
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cavConfig
+import cavMetrics
+import cavSession
+import forumScraper
+
+log = cavMetrics.getLogger("forumCrawler")
+
+
+class crawler:
+    '''
+    Crawl new posts from many forums.
+
+    Inputs:
+        forumIDs (list): Forums to watch.
+        statePath (str) [OPTIONAL]: File keeping each thread's last seen reply count. Default: forumCrawl.json
+        rate (float) [OPTIONAL]: Most page loads per second, across every worker. Default: 2
+        workers (int) [OPTIONAL]: Pages fetched at once. Default: 4
+        listPages (int) [OPTIONAL]: Most thread list pages read per forum. Lists are in order of last reply, so
+            reading stops early at a page with no changed threads. Default: 5
+        postsPerPage (int) [OPTIONAL]: Posts per thread page, as set on the forums. Default: 20
+        catchUp (bool) [OPTIONAL]: Fetch every post of threads in forums not crawled before. If False [DEFAULT],
+            the first crawl of a forum only records its reply counts.
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+    '''
+    def __init__(self, forumIDs, statePath="forumCrawl.json", rate=2, workers=4, listPages=5, postsPerPage=20,
+            catchUp=False, credentialsJSON=False):
+        self.forumIDs = [int(f) for f in forumIDs]
+        self.statePath = statePath
+        self.limiter = cavSession.rateLimiter(rate, burst=workers)
+        self.workers = workers
+        self.listPages = listPages
+        self.postsPerPage = postsPerPage
+        self.catchUp = catchUp
+        self.s = cavSession.deferredSession(credentialsJSON)
+        self.lock = threading.Lock()
+        self.forums = set() # Forums crawled before.
+        self.replies = {} # Thread ID to reply count at last crawl.
+        self.deferred = {} # Thread ID to thread, for changed threads not fetched yet. The list scan may not reach them again.
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.statePath) as file:
+                saved = json.load(file)
+        except (IOError, ValueError): # No state yet.
+            return
+        self.forums = set(saved["forums"])
+        self.replies = {int(k): v for k, v in saved["replies"].items()}
+        self.deferred = {int(t["ID"]): t for t in saved.get("deferred", [])}
+
+    def save(self):
+        tmp = f"{self.statePath}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump({"forums": sorted(self.forums), "replies": self.replies, "deferred": list(self.deferred.values())}, file)
+        os.replace(tmp, self.statePath)
+
+    def get(self, url):
+        self.limiter.wait() # One limit shared by every worker, however many forums are crawled.
+        r = self.s.get(url)
+        r.raise_for_status()
+        return r.text
+
+    def newCount(self, thread):
+        '''
+        Output (int): Posts in a thread since the last crawl, counting the first post of a thread not crawled before.
+        '''
+        last = self.replies.get(int(thread["ID"]))
+        return thread["Replies"] + 1 - (last + 1 if last is not None else 0)
+
+    def changedThreads(self, forumID):
+        '''
+        Read a forum's thread list until a page has no changed threads. Changed threads further down are either
+            deferred ones, re-seeded by crawl(), or get a reply later and move back to the top.
+
+        Output (list): (new posts, thread) tuples of changed threads. Thread is a dict from forumScraper.parseThreadList(),
+            with its forumID added and Replies as an int.
+        '''
+        known = forumID in self.forums
+        changed = []
+        for page in range(1, self.listPages + 1):
+            HTML = self.get(f"{cavConfig.baseURL()}/forums/{forumID}/page-{page}")
+            moved = 0
+            for t in forumScraper.parseThreadList(HTML):
+                t["forumID"], t["Replies"] = forumID, int(t["Replies"])
+                last = self.replies.get(int(t["ID"]))
+                if last == t["Replies"]:
+                    continue
+                moved += 1
+                if last is None and known == False and self.catchUp == False:
+                    with self.lock: # First sight of this forum. Record where it stands.
+                        self.replies[int(t["ID"])] = t["Replies"]
+                    continue
+                changed.append((self.newCount(t), t))
+            if moved == 0 or page >= forumScraper.pageCount(HTML):
+                break
+        with self.lock:
+            self.forums.add(forumID)
+        return changed
+
+    def newPosts(self, thread):
+        '''
+        Fetch only the pages of a thread holding posts added since the last crawl.
+
+        Output (list): New posts, from forumScraper.parsePostList().
+        '''
+        seen = self.replies.get(int(thread["ID"]), -1) + 1 # Posts already crawled, counting the first.
+        total = thread["Replies"] + 1
+        if total < seen: # Posts were deleted. Re-read the last page, to be safe.
+            seen = max(0, total - 1)
+        posts = []
+        for page in range(seen // self.postsPerPage + 1, (total - 1) // self.postsPerPage + 2):
+            pagePosts = forumScraper.parsePostList(self.get(f"{cavConfig.baseURL()}/threads/{thread['ID']}/page-{page}"))
+            first = (page - 1) * self.postsPerPage
+            posts += pagePosts[max(0, seen - first):]
+        return posts
+
+    def crawl(self, budget=None):
+        '''
+        Run one crawl cycle.
+
+        Inputs:
+            budget (int) [OPTIONAL]: Most threads fetched this cycle. The rest wait for the next cycle, busiest first.
+                Default: no limit.
+
+        Output (list): Changed threads, busiest first. Each a dict with forumID, threadID, Title, Replies and posts
+            (the new posts).
+        '''
+        frontier = [] # (-new posts, order, thread). Busiest thread first, across every forum.
+        order = itertools.count()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            threads = {ID: (self.newCount(t), t) for ID, t in self.deferred.items() if t["forumID"] in self.forumIDs}
+            for changed in pool.map(self.tryForum, self.forumIDs):
+                for new, t in changed:
+                    threads[int(t["ID"])] = (new, t) # Fresher than a deferred copy of the same thread.
+            for new, t in threads.values():
+                heapq.heappush(frontier, (-new, next(order), t))
+
+            selected = [heapq.heappop(frontier)[2] for _ in range(min(len(frontier), budget if budget is not None else len(frontier)))]
+            results = []
+            self.deferred = {ID: t for ID, t in self.deferred.items() if t["forumID"] not in self.forumIDs} # Other forums' wait.
+            self.deferred.update((int(t["ID"]), t) for new, n, t in frontier)
+            for t, posts in zip(selected, pool.map(self.tryThread, selected)):
+                if posts is None:
+                    self.deferred[int(t["ID"])] = t
+                    continue
+                with self.lock:
+                    self.replies[int(t["ID"])] = t["Replies"]
+                results.append({"forumID": t["forumID"], "threadID": t["ID"], "Title": t["Title"], "Replies": t["Replies"], "posts": posts})
+
+        self.save()
+        cavMetrics.count("cav_forum_threads_crawled_total", value=len(results))
+        log.info(f"Crawled {len(results)} changed threads, {len(self.deferred)} left for next cycle",
+            extra={"threads": len(results), "deferred": len(self.deferred)})
+        return results
+
+    def tryForum(self, forumID):
+        try:
+            return self.changedThreads(forumID)
+        except Exception as e: # One unreadable forum shouldn't stop the rest.
+            log.warning(f"Could not read forum {forumID}: {e!r}", extra={"forumID": forumID, "error": repr(e)})
+            return []
+
+    def tryThread(self, thread):
+        try:
+            return self.newPosts(thread)
+        except Exception as e: # Left at its old reply count and deferred, so it is retried next cycle.
+            log.warning(f"Could not read thread {thread['ID']}: {e!r}", extra={"threadID": thread["ID"], "error": repr(e)})
+            return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl new posts from many forums.")
+    parser.add_argument("forums", nargs="+", type=int, help="Forum IDs.")
+    parser.add_argument("--state", default="forumCrawl.json", help="Where to keep reply counts between runs.")
+    parser.add_argument("--output", default="forumPosts.jsonl", help="Append changed threads and their new posts here.")
+    parser.add_argument("--rate", type=float, default=2, help="Most page loads per second. Default: 2")
+    parser.add_argument("--workers", type=int, default=4, help="Pages fetched at once. Default: 4")
+    parser.add_argument("--budget", type=int, default=None, help="Most threads fetched this run. Default: no limit.")
+    parser.add_argument("--catch-up", action="store_true", help="Fetch every post of forums not crawled before.")
+    parser.add_argument("--credentials", default=False, help="Location of credentials.json.")
+    args = parser.parse_args()
+
+    c = crawler(args.forums, args.state, args.rate, args.workers, catchUp=args.catch_up, credentialsJSON=args.credentials)
+    with open(args.output, "a", encoding="utf-8") as file:
+        for t in c.crawl(args.budget):
+            file.write(json.dumps(t) + "\n")
@@ -5,43 +5,115 @@ import os
 import re
 import html
 
-import requests
-from bs4 import BeautifulSoup
+import cavConfig
+import cavMetrics
+import cavProfiler
+import cavSession
+
+log = cavMetrics.getLogger("forumScraper")
+
+CONVERSATION_URL = re.compile(r"conversations/(?:[^/]*\.)?(\d+)/")
+
+
+def parsePage(HTML):
+    '''
+    Output (BeautifulSoup): Parsed page. bs4 and lxml are imported on the first parse, so tools that only post
+        don't load them.
+    '''
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(HTML, features="lxml")
+
+
+@cavMetrics.timed("parse", "forum")
+def parseThreadList(HTML):
+    '''
+    Parse one page of a forum's thread list. See forum.threads() for output.
+    '''
+    soup = parsePage(HTML)
+    rawThreads = soup.find_all("li", class_="discussionListItem")
+
+    threads = []
+    for t in rawThreads:
+        info = re.findall(
+            r"data-author=\"(.*?)\".*id=\"thread-(\d+)\"", str(t))[0]
+        threads.append({
+            "ID": info[1],
+            "Author": info[0],
+            "Title": t.find("a", {"class": "PreviewTooltip"}).text,
+            "Replies": re.findall(r"Replies.*?([\d,]+)", str(t))[0].replace(",", "") # Whole count, without thousands separators.
+        })
+
+    return threads
+
+
+@cavMetrics.timed("parse", "thread")
+def parsePostList(HTML):
+    '''
+    Parse one page of a thread's posts. See forum.posts() for output.
+    '''
+    soup = parsePage(HTML)
+    rawPosts = soup.find_all("li", class_="message")
+
+    posts = []
+    for p in rawPosts:
+        info = re.findall(r"data-author=\"(.*?)\".id=\"post-(\d+)\"", str(p))[0]
+        content = p.find("blockquote")
+
+        posts.append({
+            "ID": info[1],
+            "Author": info[0],
+            "Content": content.text.replace("\n\n", "\n").replace("\t", ""),
+            "RawContent": str(content),
+            "MilpacIDs": [re.findall(r"uniqueid=(\d+)", i.get("href"))[0] for i in content.find_all("a") if "uniqueid" in i.get("href")]
+        })
+
+    return posts
+
+
+@cavMetrics.timed("parse", "conversation")
+def parseMessageList(HTML):
+    '''
+    Parse one page of a conversation's messages. See conversations.parse() for output.
+    '''
+    soup = parsePage(HTML)
+
+    messages = []
+    for m in soup.find_all("li", class_="message"):
+        content = m.find("blockquote") or m
+        messages.append({
+            "ID": m.get("id", "").replace("message-", ""),
+            "Author": m.get("data-author"),
+            "Content": content.text.replace("\n\n", "\n").replace("\t", ""),
+            "RawContent": str(content),
+            "MilpacIDs": re.findall(r"uniqueid=(\d+)", " ".join(a.get("href") for a in content.find_all("a", href=True)))
+        })
+
+    return messages
+
+
+def conversationID(url):
+    '''
+    Get the conversation ID from a conversation URL, such as the one a new conversation redirects to.
+
+    Output (int|None): Conversation ID, None if the URL isn't a conversation.
+    '''
+    m = CONVERSATION_URL.search(url)
+    return int(m.group(1)) if m else None
+
+
+def pageCount(HTML):
+    '''
+    Get the total pages of a forum, thread or conversation from its page navigation. 1 if there is no navigation.
+    '''
+    total = re.search(r"Page \d+ of (\d+)", HTML)
+    return int(total.group(1)) if total else 1
 
 
 class forum:
     def __init__(self, credentialsJSON=False):
-        self.s = requests.Session()  # Requests session.
-
-        try:
-            if credentialsJSON == False:
-                # Get current working directory at file execution.
-                initDir = os.getcwd()
-                dname = os.path.dirname(os.path.abspath(__file__))
-                # Change current working directory to this file's location
-                os.chdir(dname)
-                # External credentials file.
-                with open("credentials.json") as file:
-                    c = json.load(file)
-                os.chdir(initDir)  # Change working directory back to initDir.
-            else:
-                with open(credentialsJSON) as file:
-                    c = json.load(file)
-        except IOError:  # File cannot be opened.
-            assert False, f"credentials.json file not found in {credentialsJSON or os.getcwd()}"
-        except ValueError:  # File cannot be parsed.
-            assert False, "Error with formatting of credentials.json file."
-
-        auth = {
-            "login": c["user"],
-            "register": 0,
-            "password": c["pass"],
-            "remember": 1
-        }
-
-        self.s.post("https://7cav.us/login/login",
-                    data=auth, allow_redirects=False)
+        self.s = cavSession.deferredSession(credentialsJSON)  # Shared, authenticated requests session. Logs in on first use.
 
+    @cavProfiler.profiled("forum.threads")
     def threads(self, forumID, pages=1):
         '''
         Gets list of threads in a forum.
@@ -58,54 +130,38 @@ class forum:
             Title (str): Title of thread.
             Replies (str): Number of replies.
         '''
-        HTML = self.s.get(f"https://7cav.us/forums/{forumID}/").text
+        HTML = self.s.get(f"{cavConfig.baseURL()}/forums/{forumID}/").text
         try:
             totalPages = int(re.findall(r"Page \d+ of (\d+)", HTML)[0])
         except:
             totalPages = 1
 
-        def threadList(HTML):
-            soup = BeautifulSoup(HTML, features="lxml")
-            rawThreads = soup.find_all("li", class_="discussionListItem")
-
-            threads = []
-            for t in rawThreads:
-                info = re.findall(
-                    r"data-author=\"(.*?)\".*id=\"thread-(\d+)\"", str(t))[0]
-                threads.append({
-                    "ID": info[1],
-                    "Author": info[0],
-                    "Title": t.find("a", {"class": "PreviewTooltip"}).text,
-                    "Replies": re.findall(r"Replies.*(\d+?)", str(t))[0]
-                })
-
-            return threads
-
         output = []
         if pages == 0:  # Get all pages
-            print(f"Parsing {totalPages} pages")
+            log.info(f"Parsing {totalPages} pages", extra={"pages": totalPages})
             for p in range(1, totalPages+1):
                 HTML = self.s.get(
-                    f"https://7cav.us/forums/{forumID}/page-{p}").text
-                output += threadList(HTML)
-                print(f"Parsed page {p}")
+                    f"{cavConfig.baseURL()}/forums/{forumID}/page-{p}").text
+                output += parseThreadList(HTML)
+                log.info(f"Parsed page {p}", extra={"page": p})
         elif pages == 1:  # If getting only 1 page
-            HTML = self.s.get(f"https://7cav.us/forums/{forumID}/").text
-            output = threadList(HTML)
+            HTML = self.s.get(f"{cavConfig.baseURL()}/forums/{forumID}/").text
+            output = parseThreadList(HTML)
         else:  # If getting more then 1 page
             if pages > totalPages:
-                print(
-                    f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.")
+                log.warning(
+                    f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.", extra={"pages": totalPages})
                 return None
             else:
                 for p in range(1, pages+1):
                     HTML = self.s.get(
-                        f"https://7cav.us/forums/{forumID}/page-{p}").text
-                    output += threadList(HTML)
-                    print(f"Parsed page {p}")
+                        f"{cavConfig.baseURL()}/forums/{forumID}/page-{p}").text
+                    output += parseThreadList(HTML)
+                    log.info(f"Parsed page {p}", extra={"page": p})
 
         return output
 
+    @cavProfiler.profiled("forum.posts")
     def posts(self, threadID, pages=1):
         '''
         Gets list of posts in a thread.
@@ -126,97 +182,71 @@ class forum:
             MilpacIDs (list): List of all milpac IDs found in the post content.
         '''
 
-        HTML = self.s.get(f"https://7cav.us/threads/{threadID}/").text
+        HTML = self.s.get(f"{cavConfig.baseURL()}/threads/{threadID}/").text
         try:
             totalPages = int(re.findall(r"Page \d+ of (\d+)", HTML)[0])
         except:
             totalPages = 1
         
-        def postList(HTML):
-            soup = BeautifulSoup(HTML, features="lxml")
-            rawPosts = soup.find_all("li", class_="message")
-
-            posts = []
-            for p in rawPosts:
-                info = re.findall(r"data-author=\"(.*?)\".id=\"post-(\d+)\"", str(p))[0]
-                content = p.find("blockquote")
-
-                posts.append({
-                    "ID": info[1],
-                    "Author": info[0],
-                    "Content": content.text.replace("\n\n", "\n").replace("\t", ""),
-                    "RawContent": str(content),
-                    "MilpacIDs": [re.findall(r"uniqueid=(\d+)", i.get("href"))[0] for i in content.find_all("a") if "uniqueid" in i.get("href")]
-                })
-
-            return posts
-
         output = []
         if pages == 0:  # Get all pages
-            print(f"Parsing {totalPages} pages.")
-            output += postList(HTML)
-            print("Parsed page 1")
+            log.info(f"Parsing {totalPages} pages.", extra={"pages": totalPages})
+            output += parsePostList(HTML)
+            log.info("Parsed page 1", extra={"page": 1})
             for p in range(2, totalPages+1):
-                HTML = self.s.get(f"https://7cav.us/threads/{threadID}/page-{p}").text
-                output += postList(HTML)
-                print(f"Parsed page {p}")
+                HTML = self.s.get(f"{cavConfig.baseURL()}/threads/{threadID}/page-{p}").text
+                output += parsePostList(HTML)
+                log.info(f"Parsed page {p}", extra={"page": p})
         elif pages > 0:  # If getting more then 1 page
             if pages > totalPages:
-                print(
-                    f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.")
+                log.warning(
+                    f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.", extra={"pages": totalPages})
                 return None
             else:
-                print(f"Parsing {pages} pages.")
-                output += postList(HTML)
-                print("Parsed page 1")
+                log.info(f"Parsing {pages} pages.", extra={"pages": pages})
+                output += parsePostList(HTML)
+                log.info("Parsed page 1", extra={"page": 1})
                 for p in range(2, pages+1):
-                    HTML = self.s.get(f"https://7cav.us/threads/{threadID}/page-{p}").text
-                    output += postList(HTML)
-                    print(f"Parsed page {p}")
+                    HTML = self.s.get(f"{cavConfig.baseURL()}/threads/{threadID}/page-{p}").text
+                    output += parsePostList(HTML)
+                    log.info(f"Parsed page {p}", extra={"page": p})
         elif pages < 0:
-            print(f"Parsing last {abs(pages)} pages.")
+            log.info(f"Parsing last {abs(pages)} pages.", extra={"pages": pages})
             for p in range(1, totalPages+1)[::-1][:pages]:
-                HTML = self.s.get(f"https://7cav.us/threads/{threadID}/page-{p}").text
-                output += postList(HTML)[::-1]
-                print(f"Parsed page {p}")
+                HTML = self.s.get(f"{cavConfig.baseURL()}/threads/{threadID}/page-{p}").text
+                output += parsePostList(HTML)[::-1]
+                log.info(f"Parsed page {p}", extra={"page": p})
 
         return output
 
 class conversations:
-    # TODO: Document class methods
+    '''
+    Read, start, reply to and leave conversations.
+
+    Input:
+        credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
+    '''
     def __init__(self, credentialsJSON=False):
-        self.s = requests.Session()  # Requests session.
+        self.s = cavSession.deferredSession(credentialsJSON)  # Shared, authenticated requests session. Logs in on first use.
+        self.xfToken = None # Form token. The same for every form in a session, so fetched once.
 
-        try:
-            if credentialsJSON == False:
-                # Get current working directory at file execution.
-                initDir = os.getcwd()
-                dname = os.path.dirname(os.path.abspath(__file__))
-                # Change current working directory to this file's location
-                os.chdir(dname)
-                # External credentials file.
-                with open("credentials.json") as file:
-                    c = json.load(file)
-                os.chdir(initDir)  # Change working directory back to initDir.
-            else:
-                with open(credentialsJSON) as file:
-                    c = json.load(file)
-        except IOError:  # File cannot be opened.
-            assert False, f"credentials.json file not found in {credentialsJSON or os.getcwd()}"
-        except ValueError:  # File cannot be parsed.
-            assert False, "Error with formatting of credentials.json file."
-
-        auth = {
-            "login": c["user"],
-            "register": 0,
-            "password": c["pass"],
-            "remember": 1
-        }
+    def token(self, refresh=False):
+        '''
+        Get the hidden _xfToken forms are posted with.
 
-        self.s.post("https://7cav.us/login/login",
-                    data=auth, allow_redirects=False)
+        Inputs:
+            refresh (bool) [OPTIONAL]: Fetch a new token even if one is already known. Default: False
 
-    def parse(self, ID, pages=1):
+        Output (str): Token.
+        '''
+        if self.xfToken is None or refresh == True:
+            self.xfToken = re.findall(
+                r'_xfToken.*value..(.*)\"',
+                self.s.get(f"{cavConfig.baseURL()}/conversations/add").text
+            )[0]
+        return self.xfToken
+
+    def parse(self, ID, pages=1, workers=4):
         '''
         Gets list of messages in a conversation.
 
@@ -227,8 +257,9 @@ class conversations:
                 If value > 0, will parse all pages up to that value.
                 If value < 0, will parse __ last pages. Ex: -2 gets last 2 pages on conversation.
                     Also orders messages from newest to oldest.
+            workers (int) [OPTIONAL]: Pages fetched concurrently. Default: 4
 
-        Output: List with each index being a post (dict) with the following info:
+        Output: List with each index being a message (dict) with the following info:
             ID (str): ID number of message.
             Author (str): Author of message (forum username).
             RawContent (str): Raw message content, with HTML tags.
@@ -236,60 +267,105 @@ class conversations:
             MilpacIDs (list): List of all milpac IDs found in the message content.
         '''
 
-        HTML = self.s.get(f"https://7cav.us/conversations/{ID}/").text
-        
-        try:
-            totalPages = int(re.findall(r"Page \d+ of (\d+)", HTML)[0])
-        except:
-            totalPages = 1
+        HTML = self.s.get(f"{cavConfig.baseURL()}/conversations/{ID}/").text
+        totalPages = pageCount(HTML)
 
-        
-        # Get info on all messages in a conversation.
-        def messageList(HTML):
-            soup = BeautifulSoup(HTML, features="lxml")
-            rawPosts = soup.find_all("li", class_="message")
-
-            posts = []
-            for p in rawPosts:
-                info = re.findall(r"data-author=\"(.*?)\" id=\"message-(\d+)\"", HTML)[0]
-                posts.append({
-                    "ID": info[1],
-                    "Author": info[0],
-                    "Content": p.text.replace("\n\n", "\n").replace("\t", ""),
-                    "RawContent": str(p),
-                    "MilpacIDs": [re.findall(r"uniqueid=(\d+)", i.get("href"))[0] for i in p.find_all("a") if "uniqueid" in i.get("href")]
-                })
-
-            return rawPosts[0]
+        if pages > totalPages:
+            log.warning(
+                f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.", extra={"pages": totalPages})
+            return None
+
+        if pages < 0:
+            log.info(f"Parsing last {abs(pages)} pages.", extra={"pages": pages})
+            wanted = list(range(1, totalPages+1)[::-1][:abs(pages)])
+        else:
+            wanted = list(range(1, (pages or totalPages)+1))
+            log.info(f"Parsing {len(wanted)} pages.", extra={"pages": len(wanted)})
 
         output = []
-        if pages == 0:  # Get all pages
-            print(f"Parsing {totalPages} pages.")
-            output += messageList(HTML)
-            print("Parsed page 1")
-            for p in range(2, totalPages+1):
-                HTML = self.s.get(f"https://7cav.us/conversations/{ID}/page-{p}").text
-                output += messageList(HTML)
-                print(f"Parsed page {p}")
-        elif pages > 0:  # If getting more then 1 page
-            if pages > totalPages:
-                print(
-                    f"There aren't this many pages in the forum. Actual total: {totalPages}\nExiting.")
-                return None
+        for p, page in self.pages(ID, wanted, HTML, workers):
+            output += page if pages >= 0 else page[::-1]
+            log.info(f"Parsed page {p}", extra={"page": p})
+
+        return output
+
+    def pages(self, ID, wanted, firstPage=False, workers=4):
+        '''
+        Fetch and parse pages of a conversation concurrently, in the order given.
+
+        Inputs:
+            ID (int): ID number of conversation.
+            wanted (list): Page numbers to fetch.
+            firstPage (str) [OPTIONAL]: Already downloaded HTML of page 1.
+            workers (int) [OPTIONAL]: Pages fetched concurrently. Default: 4
+
+        Output (generator): (page number, list of messages from parseMessageList()) tuples.
+        '''
+        urls = {f"{cavConfig.baseURL()}/conversations/{ID}/page-{p}": p for p in wanted if not (p == 1 and firstPage)}
+        fetched = cavSession.fetchPages(self.s, urls, workers)
+        for p in wanted:
+            if p == 1 and firstPage:
+                yield 1, parseMessageList(firstPage)
             else:
-                print(f"Parsing {pages} pages.")
-                output += messageList(HTML)
-                print("Parsed page 1")
-                for p in range(2, pages+1):
-                    HTML = self.s.get(f"https://7cav.us/conversations/{ID}/page-{p}").text
-                    output += messageList(HTML)
-                    print(f"Parsed page {p}")
-        elif pages < 0:
-            print(f"Parsing last {abs(pages)} pages.")
-            for p in range(1, totalPages+1)[::-1][:pages]:
-                HTML = self.s.get(f"https://7cav.us/conversations/{ID}/page-{p}").text
-                output += messageList(HTML)[::-1]
-                print(f"Parsed page {p}")
+                yield p, parseMessageList(next(fetched)[1])
+
+    def messages(self, ID, sinceID=False, workers=4):
+        '''
+        Stream every message in a conversation, oldest first, without holding the whole conversation in memory.
+
+        Inputs:
+            ID (int): ID number of conversation.
+            sinceID (int) [OPTIONAL]: Only get messages newer than this message ID. Pages are read newest first,
+                and reading stops at the page containing sinceID, so syncing a long conversation only loads the new pages.
+                If False [DEFAULT], gets every message.
+            workers (int) [OPTIONAL]: Pages fetched concurrently. Default: 4
+
+        Output (generator): Messages, see parse() for format.
+        '''
+        HTML = self.s.get(f"{cavConfig.baseURL()}/conversations/{ID}/").text
+        totalPages = pageCount(HTML)
+
+        if sinceID == False:
+            for p, page in self.pages(ID, range(1, totalPages+1), HTML, workers):
+                yield from page
+            return
+
+        newPages = []
+        for p, page in self.pages(ID, range(totalPages, 0, -1), HTML, workers):
+            newPages.append([m for m in page if int(m["ID"]) > int(sinceID)])
+            if len(newPages[-1]) < len(page): # Page reaches back to sinceID. Nothing older is needed.
+                break
+
+        for page in newPages[::-1]:
+            yield from page
+
+    def archive(self, ID, path, workers=4):
+        '''
+        Archive a conversation to a JSON lines file (one message per line). If the file already exists,
+            only messages newer than the last one in the file are fetched and appended.
+
+        Inputs:
+            ID (int): ID number of conversation.
+            path (str): Location of archive file.
+            workers (int) [OPTIONAL]: Pages fetched concurrently. Default: 4
+
+        Output (int): Amount of new messages archived.
+        '''
+        lastID = False
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        lastID = json.loads(line)["ID"]
+
+        count = 0
+        with open(path, "a", encoding="utf-8") as file:
+            for m in self.messages(ID, lastID, workers):
+                file.write(json.dumps(m) + "\n")
+                count += 1
+
+        log.info(f"Archived {count} new messages from conversation {ID}", extra={"conversationID": ID, "messages": count, "file": path})
+        return count
 
     def start(self, members, title, body, allowInvite=True, lockConvo=False, stickyConvo=False, leave=False):
         '''
@@ -308,32 +384,38 @@ class conversations:
             stickyConvo (bool) [OPTIONAL]: Sticky conversation.
                 If True: Stickies conversation in your convo queue.
                 If False [DEFAULT]: Does NOT sticky convo in your queue.
-            leave (bool) [OPTIONAL]: Leave conversation on start. TODO: Implement.
+            leave (bool) [OPTIONAL]: Leave conversation on start.
                 If True: Leaves conversation, accepts further replies.
                 If False [DEFAULT]: Does not leave conversation.
 
         Output (str): Response code of conversation start. Code 200 is normal.
         '''
+        r = self.insert(members, title, body, allowInvite, lockConvo, stickyConvo)
+        if leave == True and conversationID(r.url) is not None:
+            self.leave(conversationID(r.url))
+        return r.reason
+
+    def insert(self, members, title, body, allowInvite=True, lockConvo=False, stickyConvo=False):
+        '''
+        Start a new conversation. Same as start(), but returns the response, whose URL is the new conversation.
+            conversationID(response.url) gives its ID, or None if it wasn't created.
+
+        Output (requests.Response): Response, after redirects.
+        '''
 
         # Handle convo attirbutes
         allowInvite = 0 if allowInvite == False else 1 # Allow anyone in convo to invite others.
         lockConvo = 0 if lockConvo == False else 1 # Lock conversation.
         stickyConvo = 0 if stickyConvo == False else 1 # Sticky conversation.
         
-        # Get, and set hidden token.
-        hiddenToken = re.findall(
-            r'_xfToken.*value..(.*)\"',
-            self.s.get(f"https://7cav.us/conversations/add").text
-        )[0]
-
         payload = {
             "recipients": ", ".join(members),
             "title": title,
             "message_html": f"<p>{body}</p>",
-            "_xfToken": hiddenToken
+            "_xfToken": self.token()
         }
 
-        return self.s.post("https://7cav.us/conversations/insert", data=payload).reason
+        return self.s.post(f"{cavConfig.baseURL()}/conversations/insert", data=payload)
 
     def reply(self, ID, body):
         '''
@@ -346,18 +428,12 @@ class conversations:
         Output (str): Response code to convo response. 200 is normal.
         '''
 
-        # Reply to a conversation.
-        hiddenToken = re.findall(
-            r'_xfToken.*value..(.*)\"', 
-            self.s.get(f"https://7cav.us/conversations/{ID}/").text
-        )[0]
-
         payload = {
             "message_html": f"<p>{body}</p>",
-            "_xfToken": hiddenToken
+            "_xfToken": self.token()
         }
 
-        return self.s.post(f"https://7cav.us/conversations/{ID}/insert-reply", data=payload).reason
+        return self.s.post(f"{cavConfig.baseURL()}/conversations/{ID}/insert-reply", data=payload).reason
 
     def leave(self, ID, ignoreMessages=False):
         '''
@@ -372,16 +448,10 @@ class conversations:
         Output (str): Response code of conversation leave request. Normal is 303.
         '''
 
-        # Leave a conversation
-        hiddenToken = re.findall(
-            r'_xfToken.*value..(.*)\"', 
-            self.s.get(f"https://7cav.us/conversations/{ID}/leave").text
-        )[0]
-
         payload = {
             "delete_type": "delete_ignore" if ignoreMessages == True else "delete",
             "_xfConfirm": 1,
-            "_xfToken": hiddenToken
+            "_xfToken": self.token()
         }
 
-        return self.s.post(f"https://7cav.us/conversations/{ID}/leave", data=payload).reason
\ No newline at end of file
+        return self.s.post(f"{cavConfig.baseURL()}/conversations/{ID}/leave", data=payload).reason
\ No newline at end of file
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Loader, cleaner and indexes for the historical ghettopacks roster exports (ghettopacks.csv, ghettopacks_clean.csv).
+
+import bisect
+import csv
+import html
+import pathlib
+import re
+import sqlite3
+
+# Misspellings found in the exports, to their correct spelling.
+RANK_FIXES = {
+    "lieutenenat": "Lieutenant"
+}
+LOWERCASE_WORDS = ("of", "the")
+FIELDS = ("uid", "rank", "name", "position", "status", "statusDate")
+
+STATUSES = [
+    (re.compile(r"dishonorabl[ey] discharged?", re.I), "Dishonorably Discharged"),
+    (re.compile(r"honorabl[ey] discharged?", re.I), "Honorably Discharged"),
+    (re.compile(r"general discharged?", re.I), "General Discharge"),
+    (re.compile(r"discharged?", re.I), "Discharged"),
+    (re.compile(r"retired", re.I), "Retired")
+]
+DATE = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+def readRows(path):
+    '''
+    Stream rows out of a ghettopacks export. Handles the raw export's trailing empty column.
+
+    Inputs:
+        path (str): Path to .csv file.
+
+    Output (generator): Rows, as lists of [UID, Rank, User, Position].
+    '''
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        next(reader, None) # Header.
+        for row in reader:
+            yield (row + ["", "", "", ""])[:4]
+
+
+def normaliseRank(rank):
+    '''
+    Fix spelling and capitalisation of a rank. Unknown ranks ("0" or blank) become "".
+    '''
+    rank = rank.strip()
+    if rank in ("", "0"):
+        return ""
+    words = []
+    for w in rank.lower().split():
+        words.append(RANK_FIXES.get(w, w if w in LOWERCASE_WORDS else w.capitalize()))
+    return " ".join(words)
+
+
+def nameKey(name):
+    '''
+    Lookup key for a name: lowercase, punctuation removed, "Last, First" reordered to "first last".
+
+    Output (str): Key. (Ex: "Burchianti, Tony" gives "tony burchianti")
+    '''
+    if "," in name:
+        last, first = name.split(",", 1)
+        name = f"{first} {last}"
+    return " ".join(re.sub(r"[^\w\s]", "", name.lower()).split())
+
+
+def normaliseRow(row):
+    '''
+    Clean one export row.
+
+    Inputs:
+        row (list): [UID, Rank, User, Position], from readRows().
+
+    Output (dict|None): None for rows without a UID or name. Otherwise a dict with the following keys:
+        uid (int): Milpac ID.
+        rank (str): Rank, spelling fixed. "" if unknown.
+        name (str): Name as exported, whitespace and HTML entities cleaned. (Ex: "Burchianti, Tony")
+        position (str): Position as exported.
+        status (str): Discharged, Honorably Discharged, Dishonorably Discharged, General Discharge, Retired or "" (none found).
+        statusDate (str): Date found in the position (Ex: "2012-11-06"), "" if none.
+    '''
+    uid, rank, name, position = [html.unescape(c).strip() for c in row]
+    name = " ".join(name.split())
+    if uid.isdigit() == False or name == "":
+        return None
+
+    status = ""
+    for pattern, value in STATUSES:
+        if pattern.search(position) or pattern.search(rank):
+            status = value
+            break
+    date = DATE.search(position)
+
+    return {
+        "uid": int(uid),
+        "rank": normaliseRank(rank),
+        "name": name,
+        "position": " ".join(position.split()),
+        "status": status,
+        "statusDate": date.group(1) if date else ""
+    }
+
+
+def completeness(t):
+    return sum(1 for k in ("rank", "name", "position", "statusDate") if t[k])
+
+
+class membership:
+    '''
+    Indexed, de-duplicated historical membership.
+
+    Input:
+        troopers (iterable) [OPTIONAL]: Cleaned rows from normaliseRow(). When a UID appears more than once,
+            the most complete row is kept (the later one on a tie).
+    '''
+    def __init__(self, troopers=()):
+        self.troopers = {} # UID to trooper.
+        for t in troopers:
+            if t is None:
+                continue
+            old = self.troopers.get(t["uid"])
+            if old is None or completeness(t) >= completeness(old):
+                self.troopers[t["uid"]] = t
+        self.index()
+
+    def index(self):
+        self.indexRanks()
+        names = []
+        for uid in sorted(self.troopers):
+            t = self.troopers[uid]
+            key = nameKey(t["name"])
+            names.append((key, uid))
+            if " " in key: # Also find "Last, First" names by their last name.
+                names.append((key.split(" ", 1)[1] + " " + key.split(" ", 1)[0], uid))
+        names.sort()
+        self.nameKeys = [n[0] for n in names]
+        self.nameUIDs = [n[1] for n in names]
+
+    def indexRanks(self):
+        self.ranks = {} # Rank to sorted list of UIDs.
+        for uid in sorted(self.troopers):
+            self.ranks.setdefault(self.troopers[uid]["rank"], []).append(uid)
+
+    @classmethod
+    def fromCSV(cls, *paths):
+        '''
+        Build membership from one or more exports. Later files win UID ties.
+
+        Inputs:
+            paths (str): Paths to ghettopacks .csv files.
+        '''
+        return cls(normaliseRow(r) for p in paths for r in readRows(p))
+
+    def __len__(self):
+        return len(self.troopers)
+
+    def byUID(self, uid):
+        '''
+        Output (dict|None): Trooper with this milpac ID, None if not found.
+        '''
+        return self.troopers.get(int(uid))
+
+    def byRank(self, rank):
+        '''
+        Output (list): Troopers last holding this rank. Rank spelling is normalised, so "First Lieutenenat" works.
+        '''
+        return [self.troopers[u] for u in self.ranks.get(normaliseRank(rank), [])]
+
+    def byNamePrefix(self, prefix, limit=None):
+        '''
+        Find troopers by the start of their name. Matches "First Last" and "Last First" order, case and punctuation insensitive.
+
+        Inputs:
+            prefix (str): Start of name. (Ex: "burch", "Tony B")
+            limit (int) [OPTIONAL]: Most results to return.
+
+        Output (list): Matching troopers, in name order.
+        '''
+        key = " ".join(re.sub(r"[^\w\s]", "", prefix.lower()).split())
+        found = []
+        seen = set()
+        for i in range(bisect.bisect_left(self.nameKeys, key), len(self.nameKeys)):
+            if self.nameKeys[i].startswith(key) == False:
+                break
+            if self.nameUIDs[i] not in seen:
+                seen.add(self.nameUIDs[i])
+                found.append(self.troopers[self.nameUIDs[i]])
+                if limit and len(found) >= limit:
+                    break
+        return found
+
+    def toCSV(self, path):
+        '''
+        Write the cleaned membership in the same layout as ghettopacks_clean.csv.
+        '''
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            wr = csv.writer(file, lineterminator="\n")
+            wr.writerow(["UID", "Rank", "User", "Position"])
+            for uid in sorted(self.troopers):
+                t = self.troopers[uid]
+                wr.writerow([uid, t["rank"], t["name"], t["position"]])
+
+    def save(self, path):
+        '''
+        Save to a SQLite database, for reloading with load(). Troopers are saved as a queryable table, and the
+            name index as a sorted table, so loading doesn't rebuild it.
+
+        Inputs:
+            path (str): Location of database file. Replaces any saved membership in it.
+        '''
+        db = sqlite3.connect(path)
+        with db:
+            db.execute("DROP TABLE IF EXISTS troopers")
+            db.execute("DROP TABLE IF EXISTS names")
+            db.execute("DROP TABLE IF EXISTS snapshot") # Pickled indexes from older saves. Never loaded.
+            db.execute("CREATE TABLE troopers (uid INTEGER PRIMARY KEY, rank TEXT, name TEXT, position TEXT, status TEXT, statusDate TEXT)")
+            db.execute("CREATE TABLE names (key TEXT, uid INTEGER, PRIMARY KEY (key, uid)) WITHOUT ROWID")
+            db.executemany("INSERT INTO troopers VALUES (?, ?, ?, ?, ?, ?)", ([t[f] for f in FIELDS] for t in self.troopers.values()))
+            db.executemany("INSERT OR IGNORE INTO names VALUES (?, ?)", zip(self.nameKeys, self.nameUIDs)) # "Doe Doe" is listed twice.
+        db.close()
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load membership saved with save(), or from any database with a troopers table in the same layout.
+
+        Inputs:
+            path (str): Location of database file. Raises ValueError if it has no troopers table.
+        '''
+        db = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True) # Read only. A wrong path isn't created.
+        try:
+            tables = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if "troopers" not in tables:
+                raise ValueError(f"No saved membership in {path}: it has no troopers table")
+            troopers = [dict(zip(FIELDS, r)) for r in db.execute(f"SELECT {', '.join(FIELDS)} FROM troopers")]
+            if "names" not in tables: # Table was filled by something else. Rebuild indexes from it.
+                return cls(troopers)
+            m = cls.__new__(cls)
+            m.troopers = {t["uid"]: t for t in troopers}
+            m.indexRanks()
+            names = db.execute("SELECT key, uid FROM names ORDER BY key, uid").fetchall()
+            m.nameKeys = [n[0] for n in names]
+            m.nameUIDs = [n[1] for n in names]
+            return m
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    m = membership.fromCSV("ghettopacks.csv", "ghettopacks_clean.csv")
+    m.save("ghettopacks.db")
+    print(f"Saved {len(m)} troopers to ghettopacks.db")
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Bidirectional index between milpac IDs, forum accounts and names.
+
+import difflib
+import json
+import re
+
+import cavMetrics
+import ghettopacks
+import milpacScraper
+
+log = cavMetrics.getLogger("memberResolver")
+
+FORUM_NAME = re.compile(r"^\s*([^\s.]+(?:[\s'-][^\s.]+)*)\.([A-Za-z])\w*\s*$") # Ex: Doe.J
+
+
+def forumKey(forumName):
+    return forumName.strip().lower()
+
+
+class resolver:
+    '''
+    Resolve forum names, forum IDs and full names to milpac IDs, and back. Build it once from bulk data, save it,
+        and look members up without fetching their profiles.
+
+    Input:
+        members (iterable) [OPTIONAL]: Member dicts, as returned by member(). Later entries update earlier ones.
+    '''
+    def __init__(self, members=()):
+        self.members = {} # Milpac ID to member.
+        self.indexed = False # Lookup indexes are rebuilt on the first lookup after a change.
+        for m in members:
+            self.add(**m)
+
+    def add(self, milpacID, forumID=None, forumName=None, name=None, rank=None, rosterID=None):
+        '''
+        Add or update a member. Fields left as None keep any value already known.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            forumID (int) [OPTIONAL]: Forum account ID.
+            forumName (str) [OPTIONAL]: Forum account name. (Ex: Doe.J)
+            name (str) [OPTIONAL]: Full name, without rank. (Ex: John Doe)
+            rank (str) [OPTIONAL]: Full spelling of rank.
+            rosterID (int) [OPTIONAL]: Roster the member was last seen on.
+        '''
+        milpacID = int(milpacID)
+        m = self.members.setdefault(milpacID, {"milpacID": milpacID, "forumID": None, "forumName": None, "name": None, "rank": None, "rosterID": None})
+        for k, v in (("forumID", forumID), ("forumName", forumName), ("name", name), ("rank", rank), ("rosterID", rosterID)):
+            if v not in (None, ""):
+                m[k] = int(v) if k in ("forumID", "rosterID") else v
+        self.indexed = False
+
+    def addProfile(self, milpacID, information):
+        '''
+        Add a member from their profile.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            information (dict): Output of milpacScraper.trooper().information().
+        '''
+        self.add(milpacID, information["forumID"], information["forumName"], information["name"], information["rank"])
+
+    def addRoster(self, rows):
+        '''
+        Add members from a roster snapshot.
+
+        Inputs:
+            rows (list): Output of milpacScraper.roster().getInfo(shaveRank=True).
+        '''
+        for r in rows:
+            self.add(r[0], name=r[2], rank=r[1], rosterID=r[6])
+
+    def addMembership(self, membership):
+        '''
+        Add historical members, for names only. Current data already in the resolver wins.
+
+        Inputs:
+            membership (ghettopacks.membership): Historical membership.
+        '''
+        for uid, t in membership.troopers.items():
+            if uid not in self.members or self.members[uid]["name"] is None:
+                self.add(uid, name=t["name"], rank=t["rank"] or None)
+
+    def index(self):
+        self.byForumID = {}
+        self.byForumName = {}
+        self.byName = {} # Name key to list of milpac IDs. Names aren't unique.
+        self.byLastName = {} # Last name to list of milpac IDs, for Last.F style lookups.
+        for milpacID, m in self.members.items():
+            if m["forumID"] is not None:
+                self.byForumID[m["forumID"]] = milpacID
+            if m["forumName"]:
+                self.byForumName[forumKey(m["forumName"])] = milpacID
+            if m["name"]:
+                key = ghettopacks.nameKey(m["name"])
+                self.byName.setdefault(key, []).append(milpacID)
+                self.byLastName.setdefault(key.split(" ")[-1], []).append(milpacID)
+
+        self.fuzzyKeys = {} # First letter to keys, so fuzzy matching only compares plausible candidates.
+        for key in list(self.byForumName) + list(self.byName):
+            self.fuzzyKeys.setdefault(key[:1], []).append(key)
+        self.indexed = True
+
+    def ensureIndex(self):
+        if self.indexed == False:
+            self.index()
+
+    def member(self, milpacID):
+        '''
+        Output (dict|None): Member with the keys milpacID, forumID, forumName, name, rank and rosterID. None if unknown.
+        '''
+        return self.members.get(int(milpacID))
+
+    def milpacID(self, query):
+        '''
+        Exact lookup of a milpac ID.
+
+        Inputs:
+            query (str|int): Forum name (Ex: "Doe.J"), forum ID, or full name (Ex: "John Doe" or "Doe, John").
+
+        Output (int|None): Milpac ID. None if not found, or if a name matches more than one member.
+        '''
+        self.ensureIndex()
+        if isinstance(query, int) or str(query).isdigit():
+            return self.byForumID.get(int(query))
+        if forumKey(query) in self.byForumName:
+            return self.byForumName[forumKey(query)]
+        found = self.byName.get(ghettopacks.nameKey(query), [])
+        return found[0] if len(found) == 1 else None
+
+    def milpacIDs(self, queries):
+        '''
+        Exact lookup of many milpac IDs, such as the Author of every post from forumScraper.forum().posts().
+
+        Output (dict): Query to milpac ID. Queries that can't be resolved map to None.
+        '''
+        return {q: self.milpacID(q) for q in queries}
+
+    def forumName(self, milpacID):
+        '''
+        Output (str|None): Forum account name of a member.
+        '''
+        m = self.member(milpacID)
+        return m["forumName"] if m else None
+
+    def forumNames(self, milpacIDs):
+        '''
+        Forum names of many members, for forumScraper.conversations.start(). Members without a known forum name are left out.
+
+        Output (list): Forum names.
+        '''
+        return [n for n in (self.forumName(i) for i in milpacIDs) if n]
+
+    def fuzzy(self, query, limit=5, cutoff=0.7):
+        '''
+        Fuzzy lookup, for misspelled or abbreviated names.
+            "Last.F" style forum names also match members with that last name and first initial.
+
+        Inputs:
+            query (str): Forum name or full name.
+            limit (int) [OPTIONAL]: Most results to return. Default: 5
+            cutoff (float) [OPTIONAL]: Minimum similarity, 0 to 1. Default: 0.7
+
+        Output (list): (milpac ID, score) tuples, best first.
+        '''
+        self.ensureIndex()
+        exact = self.milpacID(query)
+        if exact is not None:
+            return [(exact, 1.0)]
+
+        scores = {}
+        m = FORUM_NAME.match(query)
+        if m: # Doe.J: same last name, same first initial.
+            for milpacID in self.byLastName.get(m.group(1).lower().replace("'", ""), []):
+                name = self.members[milpacID]["name"] or ""
+                if name[:1].lower() == m.group(2).lower():
+                    scores[milpacID] = 0.95
+
+        key = forumKey(query) if forumKey(query) in self.byForumName else ghettopacks.nameKey(query)
+        for k in difflib.get_close_matches(key, self.fuzzyKeys.get(key[:1], []), limit, cutoff):
+            score = difflib.SequenceMatcher(None, key, k).ratio()
+            for milpacID in ([self.byForumName[k]] if k in self.byForumName else []) + self.byName.get(k, []):
+                scores[milpacID] = max(scores.get(milpacID, 0), score)
+
+        return sorted(scores.items(), key=lambda x: -x[1])[:limit]
+
+    def save(self, path):
+        '''
+        Save to a JSON file. Reload with load().
+        '''
+        with open(path, "w") as file:
+            json.dump(list(self.members.values()), file)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a resolver saved with save().
+        '''
+        with open(path) as file:
+            return cls(json.load(file))
+
+    @classmethod
+    def fromUnit(cls, rosterIDs=False, workers=8, membership=False):
+        '''
+        Build a resolver for every trooper on the rosters, fetching their profiles concurrently.
+
+        Inputs:
+            rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+            workers (int) [OPTIONAL]: Concurrent profile fetches. Default: 8
+            membership (ghettopacks.membership) [OPTIONAL]: Historical membership to add names from.
+
+        Output (resolver): Built resolver.
+        '''
+        r = cls()
+        for rosterID in (rosterIDs or milpacScraper.roster().getRosters()):
+            r.addRoster(milpacScraper.roster(rosterID).getInfo(shaveRank=True))
+
+        for milpacID, t in milpacScraper.troopers(list(r.members), workers):
+            try:
+                r.addProfile(milpacID, t.information())
+            except (IndexError, ValueError): # Profile missing, or has no forum account.
+                log.warning(f"Could not parse profile for milpacID: {milpacID}", extra={"milpacID": milpacID})
+
+        if membership:
+            r.addMembership(membership)
+
+        log.info(f"Resolved {len(r.members)} members", extra={"members": len(r.members)})
+        return r
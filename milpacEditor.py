@@ -2,50 +2,211 @@
 
 # Tools for editing milpac information.
 
-import json
+import collections
 import csv
+import hashlib
+import mimetypes
 import os
 import re
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cavConfig
+import cavMetrics
+import cavProfiler
+import cavSession
+
+log = cavMetrics.getLogger("milpacEditor")
+
+CHUNK = 65536 # Bytes read from an upload file at a time.
+PREFETCH = 4 # Upcoming rows whose files are read in the background.
+
+
+class fileCache:
+    '''
+    Files to upload, by path. Small files are read and hashed once and kept in memory, shared by every path with
+        the same contents, so a citation used on many rows is read from disk once. Large files are never hashed,
+        only streamed from disk for each upload, so they are read once per upload and memory stays flat. Files are
+        only open while being read. Use as a context manager to stop prefetching when a job ends or fails.
+
+    Inputs:
+        keepBytes (int) [OPTIONAL]: Largest file kept in memory. Default: 1MB
+        maxBytes (int) [OPTIONAL]: Most bytes kept in memory in total. The oldest files are dropped first. Default: 64MB
+    '''
+    def __init__(self, keepBytes=1 << 20, maxBytes=64 << 20):
+        self.keepBytes = keepBytes
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.files = {} # (path, modified, size) to content hash.
+        self.blobs = collections.OrderedDict() # Content hash to bytes, for small files. Oldest first.
+        self.held = 0 # Bytes in blobs.
+        self.pool = None # Prefetch thread, started on first use.
+        self.queued = set() # Paths already given to the prefetch thread.
+        self.reading = cavSession.singleflight(0, name="uploadFileRead") # A file being prefetched is read once, not twice.
+
+    def info(self, path):
+        '''
+        Output (tuple): (size in bytes, SHA-256 hex digest) of a file. The digest is None for files over keepBytes.
+        '''
+        st = os.stat(path)
+        if st.st_size > self.keepBytes:
+            return st.st_size, None
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if key in self.files:
+                cavMetrics.cache("uploadFile", True)
+                return st.st_size, self.files[key]
+        cavMetrics.cache("uploadFile", False)
+        return st.st_size, self.reading.do(key, lambda: self.read(path, key, st.st_size))
+
+    def read(self, path, key, size):
+        with open(path, "rb") as file:
+            keep = file.read(size)
+        digest = hashlib.sha256(keep).hexdigest()
+
+        with self.lock:
+            self.files[key] = digest
+            if digest not in self.blobs:
+                self.blobs[digest] = bytes(keep)
+                self.held += len(keep)
+                while self.held > self.maxBytes:
+                    self.held -= len(self.blobs.popitem(last=False)[1])
+        return digest
+
+    def chunks(self, path):
+        '''
+        Output (generator): File contents, from memory if kept, otherwise read from disk a chunk at a time.
+        '''
+        size, digest = self.info(path)
+        with self.lock:
+            data = self.blobs.get(digest) if digest else None
+        if data is not None:
+            yield data
+            return
+        with open(path, "rb") as file: # Closed as soon as the upload finishes or fails.
+            yield from iter(lambda: file.read(CHUNK), b"")
+
+    def prefetch(self, paths):
+        '''
+        Read and hash files in the background, so they are ready when their rows are uploaded. Only pass the next
+            few rows' files (Ex: paths[i + 1:i + 1 + PREFETCH]), so kept files aren't dropped before they're used.
+        '''
+        with self.lock:
+            paths = [p for p in paths if p and p not in self.queued]
+            self.queued.update(paths)
+            if paths and self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=1)
+        for path in paths:
+            self.pool.submit(self.tryInfo, path)
+
+    def tryInfo(self, path):
+        try:
+            self.info(path)
+        except OSError: # Reported when the row itself is uploaded.
+            pass
+
+    def close(self):
+        '''
+        Stop prefetching. Queued files are dropped, so a failed job doesn't wait for them at exit.
+        '''
+        with self.lock:
+            pool, self.pool = self.pool, None
+            self.queued.clear()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class multipartForm:
+    '''
+    multipart/form-data request body, streamed with a known length. Pass as data= with the contentType header.
+
+    Inputs:
+        fields (dict): Field name to value, or to (file name, path) for a file. None values are left out.
+        files (fileCache) [OPTIONAL]: Cache to read files through. Default: a new one.
+    '''
+    def __init__(self, fields, files=False):
+        self.files = files or fileCache()
+        self.boundary = uuid.uuid4().hex
+        self.contentType = f"multipart/form-data; boundary={self.boundary}"
+        self.parts = [] # (header bytes, value bytes or file path, length).
+        for name, value in fields.items():
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                filename, path = value
+                header = (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                    f'Content-Type: {mimetypes.guess_type(filename)[0] or "application/octet-stream"}\r\n\r\n').encode("utf-8")
+                self.parts.append((header, path, self.files.info(path)[0]))
+            else:
+                header = f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode("utf-8")
+                data = str(value).encode("utf-8")
+                self.parts.append((header, data, len(data)))
+        self.end = f"--{self.boundary}--\r\n".encode("utf-8")
+        self.body = None
+
+    def __len__(self):
+        return sum(len(h) + size + 2 for h, v, size in self.parts) + len(self.end)
+
+    def __iter__(self):
+        self.body = self.generate()
+        return self.body
+
+    def generate(self):
+        for header, value, size in self.parts:
+            yield header
+            if isinstance(value, bytes):
+                yield value
+            else:
+                yield from self.files.chunks(value)
+            yield b"\r\n"
+        yield self.end
 
-import requests
+    def close(self):
+        if self.body is not None:
+            self.body.close() # Closes any file still open, if the upload stopped part way.
 
 class add:
     def __init__(self, credentialsJSON=False):
         '''
-        Add entries to a user's milpacs. Class authenticates into forums in instance constructor. 
-        If doing bulk processing, use the same class instance for all additions.
+        Add entries to a user's milpacs. Uses the shared session from cavSession, so the forums
+        are only logged into once, no matter how many instances are created.
 
         Inputs:
-            credentialJSON (str) [OPTIONAL]: Location of credentials.json file if not in current working directory.
+            credentialsJSON (str) [OPTIONAL]: Location of credentials.json file if not in this script's folder.
         '''
-        self.s = requests.Session() # Requests session.
+        self.s = cavSession.deferredSession(credentialsJSON) # Shared, authenticated requests session. Logs in on first use.
+        self.hiddenToken = False 
+        self.files = fileCache() # Citation and uniform files, read once each.
 
-        try:
-            if credentialsJSON == False:
-                initDir = os.getcwd() # Get current working directory at file execution.
-                dname = os.path.dirname(os.path.abspath(__file__))
-                os.chdir(dname) # Change current working directory to this file's location
-                with open("credentials.json") as file: # External credentials file.
-                    c = json.load(file)
-                os.chdir(initDir) # Change working directory back to initDir.
-            else:
-                with open(credentialsJSON) as file:
-                    c = json.load(file)
-        except IOError: # File cannot be opened.
-            assert False, f"credentials.json file not found in {credentialsJSON or os.getcwd()}"
-        except ValueError: # File cannot be parsed.
-            assert False, "Error with formatting of credentials.json file."
-        
+    def post(self, url, fields):
+        '''
+        Post a multipart form, streaming any files from disk.
 
-        auth = {
-            "login": c["user"],
-            "register": 0,
-            "password": c["pass"],
-            "remember": 1
-        }
+        Inputs:
+            url (str): URL to post to.
+            fields (dict): See multipartForm.
 
-        self.s.post("https://7cav.us/login/login", data=auth, allow_redirects=False)
-        self.hiddenToken = False 
+        Output (requests.Response): Response, without following redirects.
+        '''
+        body = multipartForm(fields, self.files)
+        try:
+            return self.s.post(url, data=body, headers={"Content-Type": body.contentType}, allow_redirects=False)
+        finally:
+            body.close()
+
+    def prefetch(self, paths):
+        '''
+        Read the next few rows' citation or uniform files in the background. See fileCache.prefetch().
+        '''
+        self.files.prefetch(paths)
     
     def serviceRecord(self, milpacID, roster, text, date, citationFile=False):
         '''
@@ -65,36 +226,30 @@ class add:
         # Get, and set hidden token.
         hiddenToken = re.findall(
             r'_xfToken.*value..(.*)\"',
-            self.s.get(f"https://7cav.us/rosters/combat-roster.{roster}/service-record/add?uniqueid={milpacID}").text
+            self.s.get(f"{cavConfig.baseURL()}/rosters/combat-roster.{roster}/service-record/add?uniqueid={milpacID}").text
         )[0]
 
-        # Handle citation file
-        if citationFile == False:
-            citationTuple = (None)
-        else:
-            citationTuple = (citationFile.split('/')[-1], open(citationFile, "rb"))
-
-        # Multipart form data
+        # Multipart form data. Files are given by path, and streamed when posted.
         formData = {
-            "details_html": (None, f"<p>{text}</p>"),
-            "record_date":  (None, date),
-            "citation":     citationTuple,
-            "roster_id":    (None, int(roster)),
-            "relation_id":  (None, int(milpacID)),
-            "record_id":    (None, 0),
-            "_xfConfirm":   (None, 1),
-            "_xfToken":     (None, hiddenToken)
+            "details_html": f"<p>{text}</p>",
+            "record_date":  date,
+            "citation":     None if citationFile == False else (citationFile.split('/')[-1], citationFile),
+            "roster_id":    int(roster),
+            "relation_id":  int(milpacID),
+            "record_id":    0,
+            "_xfConfirm":   1,
+            "_xfToken":     hiddenToken
         }
 
         # Create service record entry.
-        post = self.s.post("https://7cav.us/rosters/service-record/save", files=formData, allow_redirects=False)
+        post = self.post(f"{cavConfig.baseURL()}/rosters/service-record/save", formData)
         
         # Handle function return.
         if post.status_code == 303:
-            print(f"Service Record entry created for: https://7cav.us/rosters/profile?uniqueid={milpacID} ({date})")
+            log.info(f"Service Record entry created for: {cavConfig.baseURL()}/rosters/profile?uniqueid={milpacID} ({date})", extra={"milpacID": milpacID, "date": date})
             return True
         else:
-            print(f"Entry not submitted. HTTP Error {post.status_code}")
+            log.error(f"Entry not submitted. HTTP Error {post.status_code}", extra={"milpacID": milpacID, "status": post.status_code})
             return False
     
     def award(self, milpacID, roster, award, date, citationFile=False, details=False):
@@ -111,7 +266,7 @@ class add:
         '''
         assert (len(date) == 10), f"Actual Length: {len(date)}\nValue: {date}" # Check for date to be formatted correctly.
 
-        awardForm = self.s.get(f"https://7cav.us/rosters/combat-roster.{roster}/awards/add?uniqueid={milpacID}").text
+        awardForm = self.s.get(f"{cavConfig.baseURL()}/rosters/combat-roster.{roster}/awards/add?uniqueid={milpacID}").text
         
         awardChecker = False
         for a in re.findall(r'option value="(\d+).*?>(.*?)<', awardForm): # For each possible award choice.
@@ -124,30 +279,30 @@ class add:
 
         # Multipart form data
         formData = {
-            "award_id":     (None, awardID),
-            "details_html": (None, f"<p>{details}</p>" if details != False else None),
-            "award_date":   (None, date),
-            "citation":     (None) if citationFile == False else (citationFile.split('/')[-1], open(citationFile, "rb")),
-            "roster_id":    (None, int(roster)),
-            "relation_id":  (None, int(milpacID)),
-            "record_id":    (None, 0),
-            "_xfConfirm":   (None, 1),
-            "_xfToken":     (None, re.findall(r'_xfToken.*value..(.*)\"',awardForm)[0])
+            "award_id":     awardID,
+            "details_html": f"<p>{details}</p>" if details != False else None,
+            "award_date":   date,
+            "citation":     None if citationFile == False else (citationFile.split('/')[-1], citationFile),
+            "roster_id":    int(roster),
+            "relation_id":  int(milpacID),
+            "record_id":    0,
+            "_xfConfirm":   1,
+            "_xfToken":     re.findall(r'_xfToken.*value..(.*)\"',awardForm)[0]
         }
 
         # Create service record entry.
-        post = self.s.post("https://7cav.us/rosters/awards/save", files=formData, allow_redirects=False)
+        post = self.post(f"{cavConfig.baseURL()}/rosters/awards/save", formData)
 
         # Handle function return.
         if post.status_code == 303:
-            print(f"Award created for: https://7cav.us/rosters/profile?uniqueid={milpacID} ({award} | {date})")
+            log.info(f"Award created for: {cavConfig.baseURL()}/rosters/profile?uniqueid={milpacID} ({award} | {date})", extra={"milpacID": milpacID, "award": award, "date": date})
             return True
         else:
-            print(f"Award not submitted. HTTP Error {post.status_code}")
+            log.error(f"Award not submitted. HTTP Error {post.status_code}", extra={"milpacID": milpacID, "status": post.status_code})
             return False
     
     def getAwards(self):
-        awardForm = self.s.get(f"https://7cav.us/rosters/4/awards/add?uniqueid=371").text
+        awardForm = self.s.get(f"{cavConfig.baseURL()}/rosters/4/awards/add?uniqueid=371").text
         return re.findall(r'option value="(\d+).*?>(.*?)<', awardForm)
 
     def uniform(self, milpacID, roster, uniformfile, deleteCurrent=True):
@@ -161,30 +316,28 @@ class add:
         '''
 
         formData = {
-            "uniform": (uniformfile.split('/')[-1], open(uniformfile, "rb")),
-            "delete": (None, 1 if deleteCurrent == True else 0),
-            "_xfConfirm": (None, 1),
-            "_xfToken": (None, re.findall(r'_xfToken.*value..(.*)\"',self.s.get(f"https://7cav.us/rosters/uniform?uniqueid={milpacID}").text)[0])
+            "uniform": (uniformfile.split('/')[-1], uniformfile),
+            "delete": 1 if deleteCurrent == True else 0,
+            "_xfConfirm": 1,
+            "_xfToken": re.findall(r'_xfToken.*value..(.*)\"',self.s.get(f"{cavConfig.baseURL()}/rosters/uniform?uniqueid={milpacID}").text)[0]
         }
 
         # Create service record entry.
-        post = self.s.post(f"https://7cav.us/rosters/uniform?uniqueid={milpacID}", files=formData, allow_redirects=False)
+        post = self.post(f"{cavConfig.baseURL()}/rosters/uniform?uniqueid={milpacID}", formData)
 
         # Handle function return.
         if post.status_code == 303:
-            print(f"Uniform uploaded for: https://7cav.us/rosters/profile?uniqueid={milpacID}")
+            log.info(f"Uniform uploaded for: {cavConfig.baseURL()}/rosters/profile?uniqueid={milpacID}", extra={"milpacID": milpacID})
             return True
         else:
-            print(f"Uniform not submitted. HTTP Error {post.status_code}")
+            log.error(f"Uniform not submitted. HTTP Error {post.status_code}", extra={"milpacID": milpacID, "status": post.status_code})
             return False
-   
-    def __del__(self):
-        self.s.close()
 
 class bulkAdd:
     def __init__(self):
         self.s = add()
     
+    @cavProfiler.profiled("bulkAdd.serviceRecords")
     def serviceRecords(self, csvFile):
         '''
         Add a large amount of service record entries from a .csv file.
@@ -203,13 +356,17 @@ class bulkAdd:
         with open(csvFile) as file:
             records = list(csv.reader(file))
 
-        for r in records:
-            assert (len(r) in (4,5)), f"Entry is wrong length, needs to be 4 or 5. Current length: {len(r)}. Row contents:\n{r}"
-            if len(r) == 4:
-                self.s.serviceRecord(r[0], r[1], r[2], r[3])
-            else:
-                self.s.serviceRecord(r[0], r[1], r[2], r[3], r[4])
-
+        citations = [r[4] if len(r) == 5 else None for r in records]
+        with self.s.files: # Citations are read in the background, a few rows ahead.
+            for i, r in enumerate(records):
+                assert (len(r) in (4,5)), f"Entry is wrong length, needs to be 4 or 5. Current length: {len(r)}. Row contents:\n{r}"
+                self.s.prefetch(citations[i + 1:i + 1 + PREFETCH])
+                if len(r) == 4:
+                    self.s.serviceRecord(r[0], r[1], r[2], r[3])
+                else:
+                    self.s.serviceRecord(r[0], r[1], r[2], r[3], r[4])
+
+    @cavProfiler.profiled("bulkAdd.awards")
     def awards(self, csvFile):
         '''
         Add a large amount of awards from a .csv file.
@@ -230,14 +387,18 @@ class bulkAdd:
         with open(csvFile) as file:
             awards = list(csv.reader(file))
 
-        for a in awards:
-            assert (len(a) in (5,6)), f"Entry is wrong length, needs to be 5 or 6. Current length: {len(a)}. Row contents:\n{a}"
-            citation = False if bool(a[4]) == False else a[4]
-            if len(a) == 5: # If award details not given.
-                self.s.award(a[0], a[1], a[2], a[3], citation)
-            else: # if award details is given.
-                self.s.award(a[0], a[1], a[2], a[3], citation, a[5])
+        citations = [a[4] if len(a) > 4 else None for a in awards]
+        with self.s.files:
+            for i, a in enumerate(awards):
+                assert (len(a) in (5,6)), f"Entry is wrong length, needs to be 5 or 6. Current length: {len(a)}. Row contents:\n{a}"
+                self.s.prefetch(citations[i + 1:i + 1 + PREFETCH])
+                citation = False if bool(a[4]) == False else a[4]
+                if len(a) == 5: # If award details not given.
+                    self.s.award(a[0], a[1], a[2], a[3], citation)
+                else: # if award details is given.
+                    self.s.award(a[0], a[1], a[2], a[3], citation, a[5])
     
+    @cavProfiler.profiled("bulkAdd.uniforms")
     def uniforms(self, csvFile):
         '''
         Add a large amount of uniforms from a .csv file.
@@ -254,11 +415,19 @@ class bulkAdd:
         with open(csvFile) as file:
             uniforms = list(csv.reader(file))
 
-        for u in uniforms:
-            assert (len(u) == 3), f"Entry is wrong length, needs to be 3. Current length {len(u)}. Row contents:\n{u}" # If the length of the row is too long, throw error.
-            self.s.uniform(u[0], u[1], u[2])
+        files = [u[2] if len(u) == 3 else None for u in uniforms]
+        with self.s.files:
+            for i, u in enumerate(uniforms):
+                assert (len(u) == 3), f"Entry is wrong length, needs to be 3. Current length {len(u)}. Row contents:\n{u}" # If the length of the row is too long, throw error.
+                self.s.prefetch(files[i + 1:i + 1 + PREFETCH])
+                self.s.uniform(u[0], u[1], u[2])
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1: # Non-interactive. Ex: python milpacEditor.py awards awards.csv --workers 4
+        import cav
+        cav.main(["import"] + sys.argv[1:])
+        sys.exit()
+
     choice = int(input("What type of bulk addition would you like to execute:\n1 - Service Records\n2 - Awards\n3 - Uniforms\nEnter a number: "))
 
     if choice == 1:
@@ -2,12 +2,39 @@
 
 # Scraper for milpacs data
 
+import copy
 import csv
-import json
-import re
 import datetime
+import functools
+import hashlib
+import os
+import re
+
+import cavConfig
+import cavMetrics
+import cavProfiler
+import cavSession
+
+log = cavMetrics.getLogger("milpacScraper")
+
+_parsed = cavSession.singleflight(maxsize=256, name="parse") # Parsed results of pages. Keys hold the page, so few are kept.
+
+_rankImages = None # Rank image to full rank name. Built once, by rankImages().
+
+PROFILE_LINK = re.compile(rb"profile\?uniqueid=(\d+)")
+
+MONTHS = {m: i for i, m in enumerate(("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
 
-import requests
+def shared(method):
+    '''
+    Decorator for parsing methods. The same page parsed the same way is parsed once, and every caller gets their own copy.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, self.html, getattr(self, "ID", None), args, tuple(sorted(kwargs.items())))
+        return copy.deepcopy(_parsed.do(key, lambda: method(self, *args, **kwargs)))
+    return wrapper
 
 
 class roster:
@@ -16,11 +43,12 @@ class roster:
 
     Input:
         ID (int): Roster ID to be scraped.
+        html (str) [OPTIONAL]: Already downloaded roster page. If given, the roster is not downloaded.
     '''
 
-    def __init__(self, ID=1):
+    def __init__(self, ID=1, html=False):
         self.ID = ID
-        self.html = requests.get(f"https://7cav.us/rosters?id={ID}").text
+        self.html = html if html != False else cavSession.fetchText(f"{cavConfig.baseURL()}/rosters?id={ID}")
     
     def getIDs(self):
         '''
@@ -52,9 +80,13 @@ class roster:
             5 (str): Position
         '''
         if rosterID != False: # If a rosterID is specified for this function, grab from that roster.
-            self.html = requests.get(f"https://7cav.us/rosters?id={rosterID}").text
+            self.html = cavSession.fetchText(f"{cavConfig.baseURL()}/rosters?id={rosterID}")
+        return self.parseInfo(removeSpecialCharacters, shaveRank)
 
-        match = re.findall(r"rosterListItem\"(.|\n\t)*src..(.*)\"(.|\n\t)*uniqueid=(\d*)..\n\t*(.*)\n(.|\t\n)*(.|\n\t)*rosterEnlisted..(.*)<(.|\n\t)*rosterPromo..(.*)<.*(.|\n\t)*rosterCustom...(.*)<", self.html)
+    @shared
+    def parseInfo(self, removeSpecialCharacters, shaveRank):
+        with cavMetrics.timer("parse", "roster"):
+            match = re.findall(r"rosterListItem\"(.|\n\t)*src..(.*)\"(.|\n\t)*uniqueid=(\d*)..\n\t*(.*)\n(.|\t\n)*(.|\n\t)*rosterEnlisted..(.*)<(.|\n\t)*rosterPromo..(.*)<.*(.|\n\t)*rosterCustom...(.*)<", self.html)
 
         output = []
         for m in match:
@@ -92,6 +124,7 @@ class roster:
 
         return re.findall(r'rosters\/\?id=(\d+)', self.html)
 
+    @cavProfiler.profiled("scrapeAllRosters")
     def scrapeAllRosters(self, toCSV=False, removeSpecialCharacters=False):
         '''
         Compile a list of all troopers on all rosters.
@@ -106,10 +139,10 @@ class roster:
             output += self.getInfo(i, removeSpecialCharacters=removeSpecialCharacters)
 
         if toCSV == True:
-            with open("rosters.csv", "w", newline="") as file:
+            with cavMetrics.timer("write", "csv"), open("rosters.csv", "w", newline="") as file:
                 wr = csv.writer(file)
                 wr.writerows(output)
-            print(f"Exported data for {len(output)} troopers.")
+            log.info(f"Exported data for {len(output)} troopers.", extra={"troopers": len(output), "file": "rosters.csv"})
         return output
 
 
@@ -119,11 +152,14 @@ class trooper:
 
         Input:
             ID (int): Milpac ID of trooper.
+            html (str) [OPTIONAL]: Already downloaded profile page. If given, the profile is not downloaded.
     '''
-    def __init__(self, ID):
+    def __init__(self, ID, html=False):
         
-        self.html = requests.get(f"https://7cav.us/rosters/profile?uniqueid={ID}").text
+        self.html = html if html != False else cavSession.fetchText(f"{cavConfig.baseURL()}/rosters/profile?uniqueid={ID}")
 
+    @shared
+    @cavMetrics.timed("parse", "profile")
     def information(self, removeSpecialCharacters=False, shaveRanks=False, dateTime=False):
         '''
         Get data listed in 'Information' block of the milpac roster.
@@ -168,13 +204,15 @@ class trooper:
             "name": name,
             "primary": re.findall(r'Primary Position.*\n\t*.*?>(.*)<', self.html)[0],
             "secondary": secondaries,
-            "enlisted": enlisted if dateTime == False else datetime.datetime.strptime(enlisted, "%b %d, %Y").date(),
-            "promoted": promoted if dateTime == False else datetime.datetime.strptime(promoted, "%b %d, %Y").date(),
+            "enlisted": enlisted if dateTime == False else parseDate(enlisted),
+            "promoted": promoted if dateTime == False else parseDate(promoted),
             "rank": re.findall(r'Rank.*\n\t*.*?>(.*)<', self.html)[0],
             "forumName": re.findall(r'Forum Account.{6}\n\t{1,}.*?">(.*?)<', self.html)[0],
             "forumID": int(re.findall(r'Forum Account.{6}\n\t{1,}.*\.(\d{1,})', self.html)[0])
         }
 
+    @shared
+    @cavMetrics.timed("parse", "serviceRecord")
     def serviceRecord(self, dateTime=False):
         '''
         Get all service record entries.
@@ -193,10 +231,12 @@ class trooper:
             del reg[0]
 
         if dateTime != False:
-            return [(datetime.datetime.strptime(i[0], "%b %d, %Y").date(), i[1]) for i in reg]
+            return [(parseDate(i[0]), i[1]) for i in reg]
         else:
             return reg
 
+    @shared
+    @cavMetrics.timed("parse", "awards")
     def awards(self, dateTime=False):
         '''
         Get all awards.
@@ -214,10 +254,122 @@ class trooper:
         reg = re.findall(r'awardDate..(.*)<.*\n.*awardTitle..(.*)<.*\n.*\n.*awardDetails..(.*)<', self.html)
 
         if dateTime != False:
-            return [(datetime.datetime.strptime(i[0], "%b %d, %Y").date(), i[1], i[2]) for i in reg]
+            return [(parseDate(i[0]), i[1], i[2]) for i in reg]
         else:
             return reg
 
+@functools.lru_cache(maxsize=16384)
+def parseDate(text):
+    '''
+    Convert a milpac date to a date. The same dates appear on many profiles, so results are cached.
+
+    Inputs:
+        text (str): Date as shown on milpacs. (Ex: Nov 11, 2020 or Nov 1, 2020)
+
+    Output (date): Date. Raises ValueError if text isn't a date.
+    '''
+    month = MONTHS.get(text[:3])
+    if month and text[3:4] == " ":
+        day, comma, year = text[4:].partition(", ")
+        if comma and day.isdigit() and year.isdigit():
+            return datetime.date(int(year), month, int(day))
+    return datetime.datetime.strptime(text, "%b %d, %Y").date() # Anything unusual, strptime decides.
+
+def troopers(IDs, workers=8):
+    '''
+    Fetch many troopers' profiles concurrently.
+
+    Inputs:
+        IDs (iterable): Milpac IDs of troopers.
+        workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+
+    Output (generator): (milpac ID, trooper) tuples, in the same order as IDs.
+    '''
+    urls = {f"{cavConfig.baseURL()}/rosters/profile?uniqueid={ID}": ID for ID in IDs}
+    for url, html in cavSession.fetchPages(cavSession.publicSession(), urls, workers):
+        yield urls[url], trooper(urls[url], html)
+
+def scanIDs(chunks):
+    '''
+    Find milpac IDs in a page arriving in pieces, without joining it or parsing rows.
+
+    Inputs:
+        chunks (iterable): Page as bytes, in any size pieces.
+
+    Output (generator): Milpac IDs (str), in page order, as soon as each is complete.
+    '''
+    tail = b""
+    for chunk in chunks:
+        data = tail + chunk
+        end = 0
+        for m in PROFILE_LINK.finditer(data):
+            if m.end() == len(data): # The ID may carry on in the next chunk.
+                break
+            yield m.group(1).decode()
+            end = m.end()
+        tail = data[max(end, len(data) - 32):] # Keeps any link cut off by the end of the chunk.
+    for m in PROFILE_LINK.finditer(tail):
+        yield m.group(1).decode()
+
+def streamIDs(rosterID=1, known=False):
+    '''
+    Get the milpac IDs on a roster while it downloads. Stop iterating to stop the download (Ex: itertools.islice).
+
+    Inputs:
+        rosterID (int) [OPTIONAL]: Roster ID. Default: 1
+        known (dict) [OPTIONAL]: Pass the same (at first empty) dict to every scan of a roster. After a complete scan
+            it holds the roster's IDs, page hash and caching headers, and "changed", which is False if the page was
+            the same as last time. An unchanged page is not downloaded again if the site supports conditional requests.
+
+    Output (generator): Milpac IDs (str), in roster order, without duplicates. Raises requests.HTTPError if the roster
+        page can't be fetched, so a failed fetch is never taken for an empty roster.
+    '''
+    headers = {}
+    if known:
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("lastModified"):
+            headers["If-Modified-Since"] = known["lastModified"]
+
+    r = cavSession.publicSession().get(f"{cavConfig.baseURL()}/rosters?id={rosterID}", headers=headers, stream=True)
+    try:
+        if r.status_code == 304 and known and "IDs" in known:
+            known["changed"] = False
+            yield from known["IDs"]
+            return
+        if r.status_code != 200: # Scanning an error page would find no IDs, as if the roster were empty.
+            r.raise_for_status()
+            import requests
+            raise requests.HTTPError(f"Unexpected status {r.status_code} for roster {rosterID}", response=r)
+
+        archive = None
+        if os.environ.get("CAV_ARCHIVE_DIR"): # Streamed pages skip the archive hook. See cavSession.archived().
+            import pageArchive
+            archive = pageArchive.fromEnvironment()
+        hash = hashlib.sha1()
+        page = [] # Chunks kept for the archive.
+        def chunks():
+            for chunk in r.iter_content(65536):
+                hash.update(chunk)
+                if archive is not None:
+                    page.append(chunk)
+                yield chunk
+
+        IDs = {}
+        for ID in scanIDs(chunks()):
+            if ID not in IDs:
+                IDs[ID] = None
+                yield ID
+
+        if archive is not None: # Only a complete page is archived.
+            archive.storeResponse(r, b"".join(page))
+        if known is not False: # Only a complete scan is remembered.
+            digest = hash.hexdigest()
+            known["changed"] = known.get("hash") != digest
+            known.update({"hash": digest, "IDs": list(IDs), "etag": r.headers.get("ETag"), "lastModified": r.headers.get("Last-Modified")})
+    finally:
+        r.close() # Early stop drops the connection instead of reading the rest.
+
 def stripRank(name, rankImage):
     '''
     Strip rank from trooper's name. Requires 'ranks.json' to be present in same folder as this script.
@@ -230,10 +382,18 @@ def stripRank(name, rankImage):
         name (str): Trooper's full name. (Ex: John Doe)
         rank (str): Full spelling of rank (Ex: Specialist)
     '''
-    with open("ranks.json") as file:
-        rConfig = json.load(file)
+    long = rankImages().get(rankImage)
+    if long is not None:
+        return {"name":name[len(long)+1:], "rank":long}
 
-    for c in rConfig:
-        if c["milpacImage"] == rankImage:
-            l = len(c["long"])
-            return {"name":name[l+1:], "rank":c["long"]}
+def rankImages():
+    '''
+    Output (dict): Rank image to full rank name, from ranks.json. Built once, so stripRank() is a dict lookup.
+    '''
+    global _rankImages
+    if _rankImages is None:
+        images = {}
+        for r in cavConfig.ranks():
+            images.setdefault(r["milpacImage"], r["long"])
+        _rankImages = images
+    return _rankImages
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
 import csv
-import datetime
 import json
 import os
 import re
 
+import cavMetrics
+import cavProfiler
 import milpacScraper
+import rankTimeline
+import serviceIntervals
+
+log = cavMetrics.getLogger("milpacsAuditor")
 
 
 class NCORibbon:
@@ -38,6 +43,43 @@ class NCORibbon:
         pass
 
 class EIBCIB:
+    # (Short name, award name, combat missions needed).
+    AWARDS = [
+        ("EIB",  "Expert Infantry Badge",           1),
+        ("CIB",  "Combat Infantry Badge",           5),
+        ("CIB2", "Combat Infantry Badge 2nd Award", 10),
+        ("CIB3", "Combat Infantry Badge 3rd Award", 15),
+        ("CIB4", "Combat Infantry Badge 4th Award", 20)
+    ]
+
+    def eligibleSince(self, serviceRecord):
+        '''
+        Work out which EIB/CIB awards a service record qualifies for, and when. Doesn't download anything.
+
+        Inputs:
+            serviceRecord (list): Output of milpacScraper.trooper().serviceRecord(), newest first.
+
+        Output (dict): Short name (Ex: CIB) to (award name, date str of the combat mission that qualified for it).
+        '''
+        missions = [s[0] for s in reversed(serviceRecord) if re.findall(r'Combat Mission', s[1])] # Combat Missions attended, oldest first.
+        return {short: (award, missions[count - 1]) for short, award, count in self.AWARDS if len(missions) >= count}
+
+    def missing(self, serviceRecord, awards):
+        '''
+        Awards eligible for but not awarded. Doesn't download anything.
+
+        Inputs:
+            serviceRecord (list): Output of milpacScraper.trooper().serviceRecord().
+            awards (list): Output of milpacScraper.trooper().awards().
+
+        Output: List of short names (Ex: ["CIB", "CIB2"]), or False if nothing is missing.
+        '''
+        awarded = [a[1] for a in awards] # List of all awards (name) that they received
+        eligibleNotAwarded = [short for short, (award, date) in self.eligibleSince(serviceRecord).items() if award not in awarded]
+
+        return eligibleNotAwarded if len(eligibleNotAwarded) != 0 else False
+
+    @cavMetrics.timed("audit", "EIBCIB")
     def checkTrooper(self, ID, checkEligible=False):
         '''
         Audit a trooper's milpacs for EIB/CIB quality
@@ -50,56 +92,27 @@ class EIBCIB:
             If the trooper has all the awards they are eligible for. Returns False
         '''
         trooper = milpacScraper.trooper(ID)
-        opCount = len([a[1] for a in trooper.serviceRecord() if re.findall(r'Combat Mission', a[1])]) # Amount of Combat Missions attended
-        awards = [a[1] for a in trooper.awards()] # List of all awards (name) that they received
-
-        # Get operation count
-        awards = {
-            "EIB": {
-                "awarded": True if "Expert Infantry Badge" in awards else False,
-                "eligible": True if opCount >= 1 else False
-            },
-            "CIB": {
-                "awarded": True if "Combat Infantry Badge" in awards else False,
-                "eligible": True if opCount >= 5 else False
-            },
-            "CIB2": {
-                "awarded": True if "Combat Infantry Badge 2nd Award" in awards else False,
-                "eligible": True if opCount >= 10 else False
-            },
-            "CIB3": {
-                "awarded": True if "Combat Infantry Badge 3rd Award" in awards else False,
-                "eligible": True if opCount >= 15 else False
-            },
-            "CIB4": {
-                "awarded": True if "Combat Infantry Badge 4th Award" in awards else False,
-                "eligible": True if opCount >= 20 else False
-            }
-        }
-
-        # Makes a list of awards the trooper is eligible for but has not yet received.
-        eligibleNotAwarded = [a for a in awards if (awards[a]["eligible"] is True) and (awards[a]["awarded"] is not True)]
-
-        return eligibleNotAwarded if len(eligibleNotAwarded) != 0 else False
+        return self.missing(trooper.serviceRecord(), trooper.awards())
 
+    @cavProfiler.profiled("EIBCIB.checkRoster")
     def checkRoster(self, rosterID):
-        milpacsIDs = [i[0] for i in milpacScraper.roster(rosterID).getInfo()]
+        milpacsIDs = list(milpacScraper.streamIDs(rosterID))
 
         results = []
         for m in milpacsIDs: # Go through each milpac ID.
             check = self.checkTrooper(m) # Perform check.
             if check != False: # If check turns up anything.
-                print(f"Error found for milpacID: {m} | {check}")
+                log.warning(f"Error found for milpacID: {m} | {check}", extra={"milpacID": m, "eligible": check})
                 results.append({ # Add it to the results list.
                     "milpacID": m,
                     "eligible": check
                     })
 
-        with open("EIBCIB.txt", "w", newline="") as file:
+        with cavMetrics.timer("write", "EIBCIB"), open("EIBCIB.txt", "w", newline="") as file:
             [file.write(f"MilpacID: {i}\n") for i in results]
 
-        print(f"{len(results)} Milpacs found in error.")
-        print(f"Output saved to {os.getcwd()}/EIBCIB.txt")
+        log.info(f"{len(results)} Milpacs found in error.", extra={"errors": len(results)})
+        log.info(f"Output saved to {os.getcwd()}/EIBCIB.txt", extra={"file": "EIBCIB.txt"})
         
         return results
 
@@ -108,53 +121,33 @@ class GCM:
     Checks to see if trooper is missing any GCMs (i.e. Has 1st, 3rd, and 4th. Therefore, missing 2nd)
     '''
 
-    def compileELOA(self, milpacID):
-        '''
-        Get a list of all days that trooper was on ELOA.
+    def compileELOA(self, milpacID, toJSON=True):
         '''
-        records = milpacScraper.trooper(milpacID).serviceRecord()[::-1] # Service record, in chronological order
-        
-        startTerms = [
-            "eloa",
-            "discharge",
-            "discharged",
-            "retire",
-            "retired"
-        ]
+        Get a list of all periods that trooper was on ELOA, discharged or retired.
 
-        endTerms = [
-            "re-en-stated",
-            "reenlisted",
-            "returned",
-            "retirement",
-            "boot",
-            "reinstated"
-        ]
+        Inputs:
+            milpacID (int): Milpac ID of trooper to check.
+            toJSON (bool) [OPTIONAL]: Also save the list to GCAudit.json. Default: True
 
+        Output (list): Ended periods, oldest first. Each a dict with startDate, startEntry, endDate, endEntry and
+            dateLen (int, days between start and end). For every trooper at once, use serviceIntervals.intervalIndex.
+        '''
         eloaHistory = []
-        termType = "findStart"
-
-        getDate = lambda x: datetime.datetime.strptime(x, "%b %d, %Y").date()
-        for r in records:
-            rec = r[1].lower() # Get service record entry, convert to all lowercase.
-            if termType == "findStart": # Search for any of the startTerms in the record.
-                if any(x in rec for x in startTerms):
-                    start = r
-                    termType = "findEnd"
-            elif termType == "findEnd": # Search for any of the endTerms in the record.
-                if any(x in rec for x in endTerms): # If an end term is found
-                    eloaHistory.append({
-                        "startDate": start[0],
-                        "startEntry": start[1],
-                        "endDate": r[0],
-                        "endEntry": r[1],
-                        "dateLen": "" #(getDate(r[0]) - getDate(start[0])).days()
-                    })
-                    termType = "findStart"
+        for s in serviceIntervals.spans(milpacScraper.trooper(milpacID).serviceRecord()):
+            if s["endDate"] is None: # Still away.
+                continue
+            eloaHistory.append({
+                "startDate": s["startDate"],
+                "startEntry": s["startEntry"],
+                "endDate": s["endDate"],
+                "endEntry": s["endEntry"],
+                "dateLen": serviceIntervals.toOrdinal(s["endDate"]) - serviceIntervals.toOrdinal(s["startDate"])
+            })
 
-        with open("GCAudit.json", "w") as file:
-            json.dump(eloaHistory, file, indent=4)
-                
+        if toJSON == True:
+            with open("GCAudit.json", "w") as file:
+                json.dump(eloaHistory, file, indent=4)
+        return eloaHistory
 
     def checkTrooper(self, milpacID):
         pass
@@ -178,65 +171,26 @@ class rankHistory:
             paygrade (str): Paygrade resulting from rank change.
             changeType (str): What type of rank change. Possible values:
                 Boot Camp
-                Current Rank
                 Promotion
                 Reduction
-        '''
+                Lateral
 
-        # Get paygrades.
-        with open("ranks.json") as file:
-            paygrades = [i["paygrade"] for i in json.load(file)]
-
-        # Get trooper's service record.
-        serviceRecord = milpacScraper.trooper(milpacID).serviceRecord()[::-1]
-
-        with open("SRReverse.json", "w") as file:
-            json.dump(serviceRecord, file, indent=4)
+        For every trooper at once, use rankTimeline.timeline.
+        '''
 
         promos = []
-
-        previousPay = "E-0"
-        for r in serviceRecord:
-            entry = r[1]
-            date = r[0]
-
-            srRank = re.findall(r"((E|W|O)-\d+)", entry)
-            if len(srRank) == 0: # If paygrade not found
-                continue
-
-            previousIndex = paygrades.index(previousPay)
-            currentIndex = paygrades.index(srRank[0][0])
-
-            if srRank == "": # If a SPC or CPL, 
-                pass
-            elif previousPay == "E-0": # Boot Camp
-                changeType = "Boot Camp"
-            elif previousIndex < currentIndex: # Promotion
-                changeType = "Promotion"
-            elif previousIndex > currentIndex: # Reduction
-                changeType = "Reduction"
-            else: # All others
-                if entry.lower().find("specialist") != -1: # If the record is a specialist.
-                    changeType = "Reduction"
-                elif entry.lower().find("corporal") != -1: # If the record is a corporal. 
-                    changeType = "Promotion"
-                else:
-                    print(f"Huh, something's weird\n{r}")
-                # return 0
-
+        for date, entry, paygrade, changeType in rankTimeline.rankChanges(milpacScraper.trooper(milpacID).serviceRecord()):
             promos.append({
                 "date": date,
                 "entry": entry,
-                "paygrade": srRank[0][0],
+                "paygrade": paygrade,
                 "changeType": changeType
             })
 
-            previousPay = srRank[0][0]
-            # previousRecord = entry
-
         return promos
 
 class NCOA:
+    @cavMetrics.timed("audit", "NCOA")
     def checkGraduating(self, milpacID):
         '''
         Check if an individual trooper has graduated NCOA. Checks for:
@@ -270,7 +224,7 @@ class NCOA:
                         "entry": s[1]
                     }
 
-        print(f"Checked Milpac ID: {milpacID}")
+        log.info(f"Checked Milpac ID: {milpacID}", extra={"milpacID": milpacID})
 
         return {
             "Old": old,
@@ -278,28 +232,31 @@ class NCOA:
             "Phase II": p2
         }
 
-    def checkRoster(self, rosterID):
+    @cavProfiler.profiled("NCOA.checkRoster")
+    def checkRoster(self, rosterID, roster=False):
         '''
         Checks all troopers in a roster for NCOA graduation with self.checkGraduating().
             returns dict with all of the audit report. Also saves audit report to a JSON file.
 
         Inputs:
             rosterID (int): ID number of roster to check.
+            roster (milpacScraper.roster) [OPTIONAL]: Already downloaded roster. Default: downloads it.
         '''
 
 
         # Check an entire roster for NCOA completion.
-        milpacIDs = [i[0] for i in milpacScraper.roster(rosterID).getInfo()]    
+        milpacIDs = [i[0] for i in roster.getInfo()] if roster else list(milpacScraper.streamIDs(rosterID))
 
         output = {}
         for m in milpacIDs:
             output[m] = self.checkGraduating(m)
 
-        with open("NCOACheck.json", "w") as file:
+        with cavMetrics.timer("write", "NCOA"), open("NCOACheck.json", "w") as file:
             json.dump(output, file, indent=4)
 
         return output
 
+    @cavProfiler.profiled("NCOA.pushCSV")
     def pushCSV(self, rosterID):
         '''
         Pushes result of self.checkRoster() to a .csv file for importing into a spreadsheet.
@@ -314,9 +271,10 @@ class NCOA:
         Inputs:
             rosterID (int): ID number of roster to check.
         '''
-        j = self.checkRoster(rosterID)
+        roster = milpacScraper.roster(rosterID) # Downloaded once, for both the check and the names.
+        j = self.checkRoster(rosterID, roster)
 
-        troopers = [[i[0], i[1], i[2]] for i in milpacScraper.roster(rosterID).getInfo(shaveRank=True)]
+        troopers = [[i[0], i[1], i[2]] for i in roster.getInfo(shaveRank=True)]
 
         for t in troopers:
             NCOA = j[t[0]]
@@ -329,8 +287,8 @@ class NCOA:
             wr = csv.writer(file, quoting=csv.QUOTE_ALL)
             wr.writerows(troopers)
 
-        print("Saved NCOA check to NCOACheck.csv")
-        print("Order of values are: Old NCOA, Phase I, Phase II")
+        log.info("Saved NCOA check to NCOACheck.csv", extra={"file": "NCOACheck.csv"})
+        log.info("Order of values are: Old NCOA, Phase I, Phase II")
 
 def ordinalIndicator(num):
     '''
@@ -362,5 +320,7 @@ def ordinalIndicator(num):
         "indicator": indicator
     }
 
-if __name__ == "__main__":
-    pass
+if __name__ == "__main__": # Ex: python milpacsAuditor.py ncoa --roster 1 --format csv --output ncoa.csv
+    import sys
+    import cav
+    cav.main(["audit"] + sys.argv[1:])
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Compressed archive of every fetched page, so pages can be re-parsed after a parser fix without touching the site.
+#
+# Pages are stored once per distinct content, named by their SHA-256, so a page unchanged between daily crawls
+# costs one manifest line, not another copy. The manifest records when each URL was fetched and which content it had.
+#
+# Layout:
+#   manifest.jsonl          One line per fetch: {"url", "time", "hash", "size"}
+#   objects/ab/abcd....gz   Page content, gzip compressed (.zst with zstandard installed)
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+import cavMetrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = cavMetrics.getLogger("pageArchive")
+
+_archives = {} # Archives already opened in this process, keyed by path.
+_lock = threading.Lock()
+
+# Pages never archived: private messages, account pages, and forms, which carry the session's _xfToken CSRF token.
+PRIVATE = re.compile(r"^/(conversations|account|login|logout)(/|$)|/(add|save|edit|insert|leave|uniform)/?$")
+
+
+class archive:
+    '''
+    Page archive in a folder. Safe to share between threads.
+
+    Inputs:
+        path (str): Archive folder. Created if missing.
+        compressor (str) [OPTIONAL]: zstd or gzip. Default: zstd if zstandard is installed, otherwise gzip.
+    '''
+    def __init__(self, path, compressor=False):
+        self.path = path
+        self.compressor = compressor or ("zstd" if zstandard else "gzip")
+        if self.compressor == "zstd" and zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package: pip install zstandard")
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        self.manifestPath = os.path.join(path, "manifest.jsonl")
+        self.lock = threading.Lock()
+        self.urls = {} # URL to [(time, hash, size)], oldest first.
+        self.load()
+
+    def load(self):
+        '''
+        Read the manifest. Only needed to pick up fetches archived by other processes since this one was created.
+        '''
+        self.urls = {}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        m = json.loads(line)
+                        self.urls.setdefault(m["url"], []).append((m["time"], m["hash"], m["size"]))
+        for snapshots in self.urls.values():
+            snapshots.sort()
+
+    def objectPath(self, hash, compressor=False):
+        extension = {"zstd": "zst", "gzip": "gz"}[compressor or self.compressor]
+        return os.path.join(self.path, "objects", hash[:2], f"{hash}.{extension}")
+
+    def find(self, hash):
+        # Objects keep the compressor they were written with, so an archive can hold both.
+        for compressor in ("zstd", "gzip"):
+            path = self.objectPath(hash, compressor)
+            if os.path.exists(path):
+                return path, compressor
+        return None, None
+
+    def store(self, url, content, fetched=False):
+        '''
+        Archive one fetch of a page.
+
+        Inputs:
+            url (str): Page URL.
+            content (bytes|str): Page content. Strings are stored as UTF-8.
+            fetched (float) [OPTIONAL]: When the page was fetched, as a UNIX time. Default: now.
+
+        Output (str): Content hash.
+        '''
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        hash = hashlib.sha256(content).hexdigest()
+        fetched = fetched or time.time()
+
+        new = self.find(hash)[0] is None
+        if new:
+            path = self.objectPath(hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.compressor == "zstd":
+                data = zstandard.ZstdCompressor(level=10).compress(content)
+            else:
+                data = gzip.compress(content, 9, mtime=0) # No timestamp, so equal pages compress identically.
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as file:
+                file.write(data)
+            os.replace(tmp, path)
+        cavMetrics.cache("archive", not new)
+
+        line = json.dumps({"url": url, "time": fetched, "hash": hash, "size": len(content)})
+        with self.lock:
+            with open(self.manifestPath, "a", encoding="utf-8") as file: # Appends of one line don't interleave between processes.
+                file.write(line + "\n")
+            snapshots = self.urls.setdefault(url, [])
+            snapshots.append((fetched, hash, len(content)))
+            if len(snapshots) > 1 and snapshots[-2][0] > fetched:
+                snapshots.sort()
+        return hash
+
+    def read(self, hash):
+        '''
+        Output (str): Content stored under a hash. Raises KeyError if it isn't in the archive.
+        '''
+        path, compressor = self.find(hash)
+        if path is None:
+            raise KeyError(hash)
+        with open(path, "rb") as file:
+            data = file.read()
+        if compressor == "zstd":
+            if zstandard is None:
+                raise ImportError("Reading .zst pages needs the zstandard package: pip install zstandard")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return data.decode("utf-8")
+
+    def snapshots(self, url):
+        '''
+        Output (list): (time, hash, size) of every archived fetch of a URL, oldest first.
+        '''
+        return list(self.urls.get(url, ()))
+
+    def get(self, url, at=False):
+        '''
+        Get an archived page.
+
+        Inputs:
+            url (str): Page URL.
+            at (float|datetime) [OPTIONAL]: Get the page as it was at this time. Default: latest.
+
+        Output (str|bool): Page content. False if the URL wasn't archived by then.
+        '''
+        at = timestamp(at) if at else float("inf")
+        found = False
+        for fetched, hash, size in self.urls.get(url, ()):
+            if fetched > at:
+                break
+            found = hash
+        return self.read(found) if found else False
+
+    def pages(self, match=False, since=False, until=False, latest=False):
+        '''
+        Stream archived pages, for bulk re-parsing. Pages are decompressed one at a time, so memory stays flat.
+
+        Inputs:
+            match (str) [OPTIONAL]: Only URLs matching this regular expression. (Ex: "rosters/profile")
+            since (float|datetime) [OPTIONAL]: Only fetches at or after this time.
+            until (float|datetime) [OPTIONAL]: Only fetches at or before this time.
+            latest (bool) [OPTIONAL]: Only the newest fetch of each URL in the time range. Default: False
+
+        Output (generator): (url, time, hash, content) tuples, by URL then time.
+        '''
+        pattern = re.compile(match) if match else None
+        low = timestamp(since) if since else float("-inf")
+        high = timestamp(until) if until else float("inf")
+        for url in sorted(self.urls):
+            if pattern and not pattern.search(url):
+                continue
+            snapshots = [s for s in self.urls[url] if low <= s[0] <= high]
+            for fetched, hash, size in (snapshots[-1:] if latest else snapshots):
+                yield url, fetched, hash, self.read(hash)
+
+    def stats(self):
+        '''
+        Output (dict): Fetches, URLs and distinct pages archived, with raw bytes fetched and bytes stored.
+        '''
+        hashes = {h: size for snapshots in self.urls.values() for _, h, size in snapshots}
+        stored = sum(os.path.getsize(path) for path in (self.find(h)[0] for h in hashes) if path)
+        raw = sum(size for snapshots in self.urls.values() for _, _, size in snapshots)
+        return {
+            "fetches": sum(len(s) for s in self.urls.values()),
+            "urls": len(self.urls),
+            "pages": len(hashes),
+            "rawBytes": raw,
+            "storedBytes": stored,
+            "ratio": stored / raw if raw else None
+        }
+
+    def hook(self, r, *args, **kwargs):
+        '''
+        requests response hook. Archives successful GETs of HTML pages. Streamed responses are left alone, as
+            archiving them would download the whole page before the caller reads it. Callers that stream a page
+            archive it with storeResponse() once they've read it all (Ex: milpacScraper.streamIDs()).
+        '''
+        if kwargs.get("stream"):
+            return
+        self.storeResponse(r)
+
+    def storeResponse(self, r, content=False):
+        '''
+        Archive a response if it is a successful GET of an HTML page, and not a private or form page (see PRIVATE).
+
+        Inputs:
+            r (requests.Response): Response.
+            content (bytes) [OPTIONAL]: Body, if already read from a streamed response. Default: r.content
+
+        Output (str|None): Content hash, or None if not archived.
+        '''
+        if PRIVATE.search(urllib.parse.urlsplit(r.url).path):
+            return None
+        if r.request.method == "GET" and r.status_code == 200 and "html" in r.headers.get("Content-Type", "text/html"):
+            return self.store(r.url, r.content if content == False else content)
+
+    def attach(self, s):
+        '''
+        Archive every page a requests session fetches.
+
+        Inputs:
+            s (requests.Session): Session to attach to.
+
+        Output (requests.Session): The same session.
+        '''
+        if self.hook not in s.hooks["response"]:
+            s.hooks["response"].append(self.hook)
+        return s
+
+
+def timestamp(t):
+    return t.timestamp() if hasattr(t, "timestamp") else float(t)
+
+
+def fromEnvironment():
+    '''
+    Get the archive named by the CAV_ARCHIVE_DIR environment variable, shared by the whole process.
+
+    Output (archive|None): Archive, or None if CAV_ARCHIVE_DIR isn't set.
+    '''
+    path = os.environ.get("CAV_ARCHIVE_DIR")
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _archives:
+            _archives[path] = archive(path)
+            log.info(f"Archiving fetched pages to {path}", extra={"archive": path})
+        return _archives[path]
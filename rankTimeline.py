@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# Unit-wide rank history. Builds every trooper's time in each paygrade in one pass over bulk service records,
+# as a columnar table for aggregate queries.
+
+import array
+import csv
+import datetime
+import re
+import statistics
+
+import cavConfig
+import cavMetrics
+import milpacScraper
+
+log = cavMetrics.getLogger("rankTimeline")
+
+PAYGRADE = re.compile(r"((E|W|O)-\d+)")
+COLUMNS = ("milpacID", "paygrade", "start", "end", "days", "changeType")
+
+_order = None # Paygrade to position in ranks.json, lowest first. Loaded once, by paygradeOrder().
+
+
+def paygradeOrder():
+    '''
+    Output (dict): Paygrade to its position, lowest first. (Ex: {"E-0": 0, "E-1": 1, ...})
+        Paygrades shared by two ranks (Specialist, Corporal) get the position of the first.
+    '''
+    global _order
+    if _order is None:
+        order = {}
+        for r in cavConfig.ranks():
+            order.setdefault(r["paygrade"], len(order))
+        _order = order
+    return _order
+
+
+def classify(previousPay, paygrade, entry, order):
+    '''
+    Work out what kind of rank change a service record entry is.
+
+    Inputs:
+        previousPay (str): Paygrade before the entry. "E-0" if none yet.
+        paygrade (str): Paygrade in the entry.
+        entry (str): Service record entry.
+        order (dict): Output of paygradeOrder().
+
+    Output (str): Boot Camp, Promotion, Reduction, or Lateral for other moves within a paygrade (Ex: Master Sergeant
+        to First Sergeant).
+    '''
+    if previousPay == "E-0":
+        return "Boot Camp"
+    if order[previousPay] < order[paygrade]:
+        return "Promotion"
+    if order[previousPay] > order[paygrade]:
+        return "Reduction"
+    if entry.lower().find("specialist") != -1: # Corporal to Specialist, same paygrade.
+        return "Reduction"
+    if entry.lower().find("corporal") != -1: # Specialist to Corporal, same paygrade.
+        return "Promotion"
+    return "Lateral"
+
+
+def rankChanges(serviceRecord, order=None):
+    '''
+    Find the rank changes in a service record.
+
+    Inputs:
+        serviceRecord (list): Output of milpacScraper.trooper().serviceRecord(), newest first.
+        order (dict) [OPTIONAL]: Output of paygradeOrder(). Default: loaded from ranks.json.
+
+    Output (list): Rank changes, oldest first. Each a tuple of (date str, entry, paygrade, changeType).
+    '''
+    order = order or paygradeOrder()
+    changes = []
+    previousPay = "E-0"
+    for date, entry in reversed(serviceRecord):
+        found = PAYGRADE.search(entry)
+        if found is None or found.group(1) not in order:
+            continue
+        paygrade = found.group(1)
+        changes.append((date, entry, paygrade, classify(previousPay, paygrade, entry, order)))
+        previousPay = paygrade
+    return changes
+
+
+class timeline:
+    '''
+    Columnar table of time in grade. One row per rank change on each trooper's service record, with these columns:
+        milpacID (array): Milpac ID.
+        paygrade (list): Paygrade held. (Ex: E-4)
+        start (array): Date the paygrade was reached, as a date ordinal.
+        end (array): Date the next rank change happened, as a date ordinal. 0 if still held.
+        days (array): Days in grade. For paygrades still held, days up to asOf.
+        changeType (list): How the paygrade was reached. See classify().
+
+    Input:
+        asOf (date) [OPTIONAL]: Date used to end paygrades still held. Default: today.
+    '''
+    def __init__(self, asOf=False):
+        self.asOf = (asOf or datetime.date.today()).toordinal()
+        self.milpacID = array.array("l")
+        self.paygrade = []
+        self.start = array.array("l")
+        self.end = array.array("l")
+        self.days = array.array("l")
+        self.changeType = []
+
+    def __len__(self):
+        return len(self.milpacID)
+
+    def add(self, milpacID, serviceRecord):
+        '''
+        Add one trooper's rank history.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            serviceRecord (list): Output of milpacScraper.trooper().serviceRecord(), newest first.
+        '''
+        changes = rankChanges(serviceRecord)
+        for i, (date, entry, paygrade, changeType) in enumerate(changes):
+            start = milpacScraper.parseDate(date).toordinal()
+            end = milpacScraper.parseDate(changes[i + 1][0]).toordinal() if i + 1 < len(changes) else 0
+            self.milpacID.append(int(milpacID))
+            self.paygrade.append(paygrade)
+            self.start.append(start)
+            self.end.append(end)
+            self.days.append((end or self.asOf) - start)
+            self.changeType.append(changeType)
+
+    @classmethod
+    def build(cls, records, asOf=False):
+        '''
+        Build a timeline from many service records.
+
+        Inputs:
+            records (iterable): (milpac ID, service record) tuples.
+            asOf (date) [OPTIONAL]: See timeline.
+
+        Output (timeline): Built timeline.
+        '''
+        t = cls(asOf)
+        with cavMetrics.timer("audit", "rankTimeline"):
+            for milpacID, serviceRecord in records:
+                t.add(milpacID, serviceRecord)
+        return t
+
+    @classmethod
+    def fromUnit(cls, rosterIDs=False, workers=8, asOf=False):
+        '''
+        Build a timeline for every trooper on the rosters, fetching their profiles concurrently.
+
+        Inputs:
+            rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+            workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+            asOf (date) [OPTIONAL]: See timeline.
+
+        Output (timeline): Built timeline.
+        '''
+        IDs = []
+        for rosterID in (rosterIDs or milpacScraper.roster().getRosters()):
+            IDs += milpacScraper.roster(rosterID).getIDs()
+        t = cls.build(((ID, tr.serviceRecord()) for ID, tr in milpacScraper.troopers(dict.fromkeys(IDs), workers)), asOf)
+        log.info(f"Built rank timeline of {len(t)} rows for {len(set(IDs))} troopers", extra={"rows": len(t), "troopers": len(set(IDs))})
+        return t
+
+    def row(self, i):
+        return {
+            "milpacID": self.milpacID[i],
+            "paygrade": self.paygrade[i],
+            "start": datetime.date.fromordinal(self.start[i]),
+            "end": datetime.date.fromordinal(self.end[i]) if self.end[i] else None,
+            "days": self.days[i],
+            "changeType": self.changeType[i]
+        }
+
+    def rows(self):
+        '''
+        Output (generator): Every row, as a dict of the columns. start and end are dates, end is None if still held.
+        '''
+        return (self.row(i) for i in range(len(self)))
+
+    def trooper(self, milpacID):
+        '''
+        Output (list): One trooper's rows, oldest first.
+        '''
+        return [self.row(i) for i, ID in enumerate(self.milpacID) if ID == int(milpacID)]
+
+    def timeInGrade(self, completed=True):
+        '''
+        Time in grade statistics per paygrade.
+
+        Inputs:
+            completed (bool) [OPTIONAL]: Only count time in paygrades that have since been left. Default: True
+                If False, paygrades still held count their days so far.
+
+        Output (dict): Paygrade, lowest first, to a dict of count, median, mean, min and max days.
+        '''
+        days = {}
+        for paygrade, d, end in zip(self.paygrade, self.days, self.end):
+            if end or completed == False:
+                days.setdefault(paygrade, []).append(d)
+        order = paygradeOrder()
+        return {p: {
+            "count": len(days[p]),
+            "median": statistics.median(days[p]),
+            "mean": statistics.mean(days[p]),
+            "min": min(days[p]),
+            "max": max(days[p])
+        } for p in sorted(days, key=lambda p: order[p])}
+
+    def changesPerMonth(self, changeType="Promotion", paygrade=False):
+        '''
+        Count rank changes per month.
+
+        Inputs:
+            changeType (str) [OPTIONAL]: Boot Camp, Promotion, Reduction or Lateral. Default: Promotion
+            paygrade (str) [OPTIONAL]: Only count changes to this paygrade. Default: all paygrades.
+
+        Output (dict): Month (Ex: "2020-11") to count, in order.
+        '''
+        months = {}
+        for start, t, p in zip(self.start, self.changeType, self.paygrade):
+            if t == changeType and (paygrade == False or p == paygrade):
+                d = datetime.date.fromordinal(start)
+                key = f"{d.year}-{d.month:02d}"
+                months[key] = months.get(key, 0) + 1
+        return dict(sorted(months.items()))
+
+    def current(self):
+        '''
+        Output (dict): Milpac ID to the row of the paygrade they currently hold.
+        '''
+        return {self.milpacID[i]: self.row(i) for i in range(len(self)) if self.end[i] == 0}
+
+    def toCSV(self, path):
+        '''
+        Write the table to a .csv file, dates as YYYY-MM-DD.
+        '''
+        with cavMetrics.timer("write", "csv"), open(path, "w", newline="") as file:
+            wr = csv.writer(file)
+            wr.writerow(COLUMNS)
+            for r in self.rows():
+                wr.writerow([r[c] if r[c] is not None else "" for c in COLUMNS])
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# Long running roster watcher. Polls every roster on a jittered schedule and sends an event for each promotion,
+# reduction, lateral rank change, new enlistee, transfer, removal and position change to one or more sinks.
+#
+# Example: python rosterWatcher.py --interval 300 --jsonl events.jsonl --sqlite events.db
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import random
+import sqlite3
+
+import cavConfig
+import cavMetrics
+import cavSession
+import milpacScraper
+import rankTimeline
+
+log = cavMetrics.getLogger("rosterWatcher")
+
+
+def rankPaygrades():
+    '''
+    Output (dict): Full rank name to its paygrade. (Ex: {"Corporal": "E-4", ...})
+    '''
+    return {r["long"]: r["paygrade"] for r in cavConfig.ranks()}
+
+
+def rankChange(old, new, paygrades):
+    '''
+    Work out what kind of rank change a roster shows, by the same rules as rankTimeline.classify(), so events agree
+        with rank timelines and audits (Ex: Specialist to Corporal is a promotion, Corporal to Specialist a reduction).
+
+    Inputs:
+        old (str): Full rank name before.
+        new (str): Full rank name now.
+        paygrades (dict): rankPaygrades().
+
+    Output (str): promotion, reduction or lateral. Ranks missing from ranks.json are lateral.
+    '''
+    if old not in paygrades or new not in paygrades:
+        return "lateral"
+    change = rankTimeline.classify(paygrades[old], paygrades[new], new, rankTimeline.paygradeOrder())
+    return "promotion" if change == "Boot Camp" else change.lower() # Boot Camp is any move up from E-0 (Reservist).
+
+
+def snapshot(rows):
+    '''
+    Output (dict): Milpac ID to rank, name, position and promoted date, from roster().getInfo(shaveRank=True) rows.
+    '''
+    return {r[0]: {"rank": r[1], "name": r[2], "position": r[5], "promoted": r[4]} for r in rows}
+
+
+def changes(old, new, ranks=False):
+    '''
+    Compare two states of the unit.
+
+    Inputs:
+        old (dict): Roster ID to snapshot(), as last seen.
+        new (dict): Roster ID to snapshot(), now. Rosters missing from new (Ex: fetch failed) are treated as unchanged.
+        ranks (dict) [OPTIONAL]: rankPaygrades(), to tell promotions from reductions. See rankChange().
+            Default: loaded from ranks.json.
+
+    Output (list): Events. Each a dict with type, milpacID, name and rosterID, plus from and to where something changed.
+        Types: enlisted, removed, transfer, promotion, reduction, lateral, position.
+    '''
+    ranks = ranks or rankPaygrades()
+    new = dict(old, **new)
+    before = {ID: (rosterID, t) for rosterID, troopers in old.items() for ID, t in troopers.items()}
+    after = {ID: (rosterID, t) for rosterID, troopers in new.items() for ID, t in troopers.items()}
+
+    events = []
+    def event(kind, ID, rosterID, t, **details):
+        events.append(dict({"type": kind, "milpacID": int(ID), "name": t["name"], "rosterID": int(rosterID)}, **details))
+
+    for ID, (rosterID, t) in after.items():
+        if ID not in before:
+            event("enlisted", ID, rosterID, t, rank=t["rank"], position=t["position"])
+            continue
+        oldRoster, o = before[ID]
+        if oldRoster != rosterID:
+            event("transfer", ID, rosterID, t, **{"from": int(oldRoster), "to": int(rosterID)})
+        if o["rank"] != t["rank"]:
+            event(rankChange(o["rank"], t["rank"], ranks), ID, rosterID, t, **{"from": o["rank"], "to": t["rank"]})
+        if o["position"] != t["position"]:
+            event("position", ID, rosterID, t, **{"from": o["position"], "to": t["position"]})
+    for ID, (rosterID, t) in before.items():
+        if ID not in after:
+            event("removed", ID, rosterID, t, rank=t["rank"])
+    return events
+
+
+class jsonlSink:
+    '''
+    Append events to a JSON lines file.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, events):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for e in events:
+                file.write(json.dumps(e) + "\n")
+
+
+class webhookSink:
+    '''
+    POST events as a JSON list to a URL.
+
+    Inputs:
+        url (str): Webhook URL.
+        timeout (float) [OPTIONAL]: Seconds to wait for the webhook. Default: 10
+    '''
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def emit(self, events):
+        cavSession.publicSession().post(self.url, json=events, timeout=self.timeout).raise_for_status()
+
+
+class sqliteSink:
+    '''
+    Queue events in a SQLite table, for other processes to claim. Rows start with handled = 0.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                time TEXT, type TEXT, milpacID INTEGER, rosterID INTEGER, event TEXT,
+                handled INTEGER DEFAULT 0)""")
+
+    def emit(self, events):
+        with sqlite3.connect(self.path) as db:
+            db.executemany("INSERT INTO events (time, type, milpacID, rosterID, event) VALUES (?, ?, ?, ?, ?)",
+                [(e["time"], e["type"], e["milpacID"], e["rosterID"], json.dumps(e)) for e in events])
+
+
+class watcher:
+    '''
+    Poll rosters and send change events to sinks.
+
+    Inputs:
+        sinks (list): Objects with an emit(events) method. (Ex: jsonlSink("events.jsonl"))
+        statePath (str) [OPTIONAL]: File keeping the last seen rosters, so a restart doesn't resend events.
+            Default: rosterWatch.json
+        rosterIDs (list) [OPTIONAL]: Rosters to watch. Default: every roster, re-read each poll.
+        interval (float) [OPTIONAL]: Average seconds between polls. Default: 300
+        jitter (float) [OPTIONAL]: Fraction the interval varies by, so polls don't land on the same second. Default: 0.2
+        workers (int) [OPTIONAL]: Rosters fetched at once. Default: 4
+    '''
+    def __init__(self, sinks, statePath="rosterWatch.json", rosterIDs=False, interval=300, jitter=0.2, workers=4):
+        self.sinks = sinks
+        self.statePath = statePath
+        self.rosterIDs = rosterIDs
+        self.interval = interval
+        self.jitter = jitter
+        self.workers = workers
+        self.ranks = rankPaygrades()
+        self.hashes = {} # Roster ID to hash of its last page.
+        self.state = None # Roster ID to snapshot(). None until a poll fetches every roster.
+        self.pending = {} # Sink class name to events it hasn't accepted yet. Retried every poll.
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.statePath) as file:
+                saved = json.load(file)
+        except (IOError, ValueError): # No state yet. The first poll sets the baseline.
+            return
+        self.hashes = saved["hashes"]
+        self.state = saved["state"]
+        self.pending = saved.get("pending", {})
+
+    def save(self):
+        tmp = f"{self.statePath}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump({"hashes": self.hashes, "state": self.state, "pending": self.pending}, file)
+        os.replace(tmp, self.statePath)
+
+    async def fetch(self, rosterID, limit):
+        async with limit:
+            try:
+                r = await asyncio.to_thread(cavSession.publicSession().get, f"{cavConfig.baseURL()}/rosters?id={rosterID}")
+                r.raise_for_status()
+                return rosterID, r.text
+            except Exception as e:
+                log.warning(f"Could not fetch roster {rosterID}: {e!r}", extra={"rosterID": rosterID, "error": repr(e)})
+                return rosterID, None
+
+    async def poll(self):
+        '''
+        Poll every roster once, and send any changes to the sinks.
+
+        Output (list): New events. Empty until the baseline is recorded, which needs a poll that fetches every roster.
+        '''
+        limit = asyncio.Semaphore(self.workers)
+        if self.rosterIDs:
+            rosterIDs = [str(r) for r in self.rosterIDs]
+            pages = {}
+        else: # The first roster's page lists every roster.
+            _, html = await self.fetch(1, limit)
+            if html is None:
+                return []
+            pages = {"1": html}
+            rosterIDs = milpacScraper.roster(1, html).getRosters()
+        pages.update({str(r): html for r, html in await asyncio.gather(*(self.fetch(r, limit) for r in rosterIDs if str(r) not in pages))})
+
+        new = {}
+        for rosterID in rosterIDs:
+            html = pages.get(rosterID)
+            if html is None:
+                continue
+            hash = hashlib.sha256(html.encode("utf-8")).hexdigest()
+            unchanged = self.hashes.get(rosterID) == hash
+            cavMetrics.cache("rosterPage", unchanged)
+            if unchanged and self.state is not None:
+                continue # Parsing and diffing only happens for rosters whose page changed.
+            self.hashes[rosterID] = hash
+            new[rosterID] = snapshot(milpacScraper.roster(rosterID, html).getInfo(shaveRank=True))
+
+        if self.state is None:
+            missing = [r for r in rosterIDs if pages.get(r) is None]
+            if missing: # A roster left out of the baseline would later be reported as all new enlistees.
+                log.warning(f"Baseline waits for rosters {', '.join(missing)}", extra={"rosters": missing})
+                return []
+            self.state = new
+            self.save()
+            log.info(f"Watching {len(new)} rosters", extra={"rosters": len(new)})
+            return []
+
+        events = changes(self.state, new, self.ranks) if new else []
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        for e in events:
+            e["time"] = now
+            cavMetrics.count("cav_roster_events_total", (("type", e["type"]),))
+        if events:
+            log.info(f"{len(events)} roster changes", extra={"events": len(events)})
+        await self.deliver(events)
+        self.state.update(new)
+        self.save()
+        return events
+
+    async def deliver(self, events):
+        '''
+        Send events to every sink, after any the sink failed to take before. Events a sink fails to take are kept,
+            and saved with the state, so an outage (Ex: webhook down) delays events instead of losing them.
+        '''
+        for sink in self.sinks:
+            name = type(sink).__name__
+            batch = self.pending.get(name, []) + events
+            if not batch:
+                continue
+            try:
+                await asyncio.to_thread(sink.emit, batch)
+                self.pending.pop(name, None)
+            except Exception as e:
+                self.pending[name] = batch
+                log.error(f"{name} failed, {len(batch)} events kept to retry: {e!r}", extra={"sink": name, "events": len(batch), "error": repr(e)})
+
+    async def run(self, polls=None):
+        '''
+        Poll until cancelled, or for a number of polls.
+
+        Inputs:
+            polls (int) [OPTIONAL]: Polls to run. Default: forever.
+        '''
+        done = 0
+        while polls is None or done < polls:
+            try:
+                await self.poll()
+            except Exception as e: # Keep watching through a bad poll.
+                log.exception(f"Poll failed: {e!r}")
+            done += 1
+            if polls is None or done < polls:
+                await asyncio.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch rosters and report changes.")
+    parser.add_argument("--interval", type=float, default=300, help="Average seconds between polls. Default: 300")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Fraction the interval varies by. Default: 0.2")
+    parser.add_argument("--roster", nargs="+", default=False, help="Roster IDs. Default: every roster.")
+    parser.add_argument("--state", default="rosterWatch.json", help="Where to keep the last seen rosters.")
+    parser.add_argument("--jsonl", help="Append events to this JSON lines file.")
+    parser.add_argument("--webhook", help="POST events to this URL.")
+    parser.add_argument("--sqlite", help="Queue events in this SQLite database.")
+    parser.add_argument("--polls", type=int, default=None, help="Stop after this many polls. Default: run forever.")
+    args = parser.parse_args()
+
+    sinks = []
+    if args.jsonl:
+        sinks.append(jsonlSink(args.jsonl))
+    if args.webhook:
+        sinks.append(webhookSink(args.webhook))
+    if args.sqlite:
+        sinks.append(sqliteSink(args.sqlite))
+    if sinks == []:
+        sinks.append(jsonlSink("rosterEvents.jsonl"))
+
+    try:
+        asyncio.run(watcher(sinks, args.state, args.roster, args.interval, args.jitter).run(args.polls))
+    except KeyboardInterrupt:
+        pass
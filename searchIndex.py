@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# Full text index over service records, awards and forum posts, for "who has an entry matching X" questions
+# across the whole unit without re-scraping.
+#
+# Query syntax: words and "quoted phrases", joined with AND (the default between terms), OR and NOT, grouped
+# with brackets. (Ex: "combat mission" AND NOT "operation red", ncoa AND ("phase ii" OR "phase 2"))
+
+import datetime
+import gc
+import pickle
+import re
+
+import cavMetrics
+import milpacScraper
+
+log = cavMetrics.getLogger("searchIndex")
+
+WORD = re.compile(r"[a-z0-9]+")
+QUERY_TOKEN = re.compile(r'"([^"]*)"|(\()|(\))|([^\s()"]+)')
+SOURCES = ("serviceRecord", "award", "post")
+
+
+def tokenize(text):
+    '''
+    Output (list): Lowercase words in text. Punctuation splits words, so "E-4" gives ["e", "4"].
+    '''
+    return WORD.findall(text.lower())
+
+
+class index:
+    '''
+    Inverted index with word positions, so phrases match exactly. Entries can be added at any time, and an entry
+        already in the index (same source, trooper, date and text) is not added twice, so re-scraping a trooper
+        only adds their new entries.
+
+    The same text appears on many troopers' records (Ex: "Combat Mission - Operation ..."), so each distinct text
+        is indexed once, and queries are answered per text before being expanded to documents.
+    '''
+    def __init__(self):
+        self.postings = {} # Word to {text number: [positions]}, in text order.
+        self.texts = [] # Per text: the text.
+        self.textNumbers = {} # Text to its text number.
+        self.textDocs = [] # Per text: document numbers with that text.
+        self.milpacIDs = [] # Per document: milpac ID, None if unknown.
+        self.dates = [] # Per document: date ordinal, 0 if unknown.
+        self.sources = [] # Per document: serviceRecord, award or post.
+        self.docTexts = [] # Per document: text number.
+        self.refs = [] # Per document: award name or post ID. None for service records.
+        self.seen = set() # (source, milpac ID, date ordinal, text number, ref) of every document, for skipping repeats.
+
+    def __len__(self):
+        return len(self.docTexts)
+
+    def add(self, source, milpacID, date, text, ref=None):
+        '''
+        Add one entry.
+
+        Inputs:
+            source (str): serviceRecord, award or post.
+            milpacID (int): Milpac ID the entry belongs to. None if unknown.
+            date (str|date): Date of entry (Ex: Nov 11, 2020). None if unknown.
+            text (str): Entry text.
+            ref (str) [OPTIONAL]: Award name or post ID.
+
+        Output (bool): True if added, False if it was already in the index.
+        '''
+        if isinstance(date, str):
+            date = milpacScraper.parseDate(date)
+        milpacID = int(milpacID) if milpacID is not None else None
+        date = date.toordinal() if date else 0
+
+        number = self.textNumbers.get(text)
+        if number is None: # New text. Index its words.
+            number = self.textNumbers[text] = len(self.texts)
+            self.texts.append(text)
+            self.textDocs.append([])
+            for position, word in enumerate(tokenize(text)):
+                self.postings.setdefault(word, {}).setdefault(number, []).append(position)
+
+        key = (source, milpacID, date, number, ref)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+
+        self.textDocs[number].append(len(self.docTexts))
+        self.milpacIDs.append(milpacID)
+        self.dates.append(date)
+        self.sources.append(source)
+        self.docTexts.append(number)
+        self.refs.append(ref)
+        return True
+
+    def addTrooper(self, milpacID, t):
+        '''
+        Add a trooper's service record and awards.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            t (milpacScraper.trooper): Trooper, with their profile downloaded.
+
+        Output (int): Amount of new entries added.
+        '''
+        added = 0
+        for date, entry in t.serviceRecord():
+            added += self.add("serviceRecord", milpacID, date, entry)
+        for date, award, details in t.awards():
+            added += self.add("award", milpacID, date, f"{award} {details}", award)
+        return added
+
+    def addPosts(self, posts, resolver=False):
+        '''
+        Add forum posts or conversation messages.
+
+        Inputs:
+            posts (list): Output of forumScraper.forum().posts() or conversations().parse().
+            resolver (memberResolver.resolver) [OPTIONAL]: Used to find each author's milpac ID. If False [DEFAULT],
+                posts are indexed without one.
+
+        Output (int): Amount of new posts added.
+        '''
+        added = 0
+        for p in posts:
+            milpacID = resolver.milpacID(p["Author"]) if resolver else None
+            added += self.add("post", milpacID, None, p["Content"], p["ID"])
+        return added
+
+    def update(self, milpacIDs, workers=8):
+        '''
+        Fetch troopers' profiles concurrently and add any new service record entries and awards.
+
+        Inputs:
+            milpacIDs (iterable): Milpac IDs.
+            workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+
+        Output (int): Amount of new entries added.
+        '''
+        added = 0
+        for milpacID, t in milpacScraper.troopers(milpacIDs, workers):
+            added += self.addTrooper(milpacID, t)
+        log.info(f"Indexed {added} new entries, {len(self)} total", extra={"added": added, "documents": len(self)})
+        return added
+
+    @classmethod
+    def fromUnit(cls, rosterIDs=False, workers=8):
+        '''
+        Build an index of every trooper on the rosters.
+
+        Inputs:
+            rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+            workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+        '''
+        IDs = []
+        for rosterID in (rosterIDs or milpacScraper.roster().getRosters()):
+            IDs += milpacScraper.roster(rosterID).getIDs()
+        i = cls()
+        i.update(dict.fromkeys(IDs), workers)
+        return i
+
+    def phrase(self, words):
+        '''
+        Output (set): Text numbers containing the words next to each other, in order.
+        '''
+        lists = [self.postings.get(w, {}) for w in words]
+        if not lists or not all(lists):
+            return set()
+        texts = set(min(lists, key=len)).intersection(*lists)
+        if len(words) == 1:
+            return texts
+        return {t for t in texts if any(all(p + i in lists[i][t] for i in range(1, len(lists))) for p in lists[0][t])}
+
+    def parse(self, tokens):
+        # expression: term (OR term)*
+        docs = self.parseTerm(tokens)
+        while tokens and tokens[0] == ("op", "OR"):
+            tokens.pop(0)
+            docs = docs | self.parseTerm(tokens)
+        return docs
+
+    def parseTerm(self, tokens):
+        # term: factor ((AND)? factor)*
+        docs = self.parseFactor(tokens)
+        while tokens and tokens[0] not in (("op", "OR"), ("close", ")")):
+            if tokens[0] == ("op", "AND"):
+                tokens.pop(0)
+            docs = docs & self.parseFactor(tokens)
+        return docs
+
+    def parseFactor(self, tokens):
+        # factor: NOT factor | ( expression ) | phrase
+        if tokens == []:
+            raise ValueError("Query ends early")
+        kind, value = tokens.pop(0)
+        if kind == "op" and value == "NOT":
+            return set(range(len(self.texts))) - self.parseFactor(tokens)
+        if kind == "open":
+            docs = self.parse(tokens)
+            if tokens[:1] != [("close", ")")]:
+                raise ValueError("Query is missing a )")
+            tokens.pop(0)
+            return docs
+        if kind == "words":
+            return self.phrase(value)
+        raise ValueError(f"Unexpected {value} in query")
+
+    def query(self, text):
+        '''
+        Output (set): Text numbers matching a query. See top of file for syntax. textDocs gives their documents.
+        '''
+        tokens = []
+        for phrase, opening, closing, word in QUERY_TOKEN.findall(text):
+            if opening:
+                tokens.append(("open", "("))
+            elif closing:
+                tokens.append(("close", ")"))
+            elif word in ("AND", "OR", "NOT"):
+                tokens.append(("op", word))
+            elif tokenize(phrase or word):
+                tokens.append(("words", tokenize(phrase or word)))
+        docs = self.parse(tokens)
+        if tokens:
+            raise ValueError(f"Unexpected {tokens[0][1]} in query")
+        return docs
+
+    def documents(self, text):
+        '''
+        Output (generator): Document numbers matching a query.
+        '''
+        for t in self.query(text):
+            yield from self.textDocs[t]
+
+    def search(self, text, source=False, since=False, until=False):
+        '''
+        Search the index.
+
+        Inputs:
+            text (str): Query. See top of file for syntax.
+            source (str) [OPTIONAL]: Only entries from serviceRecord, award or post. Default: all.
+            since (date) [OPTIONAL]: Only entries on or after this date.
+            until (date) [OPTIONAL]: Only entries on or before this date.
+
+        Output (list): Matching entries, newest first. Each a dict with milpacID, date (None if unknown), source,
+            text and ref.
+        '''
+        with cavMetrics.timer("search", "index"):
+            docs = list(self.documents(text))
+        low = since.toordinal() if since else 0
+        high = until.toordinal() if until else datetime.date.max.toordinal()
+        output = []
+        for d in sorted(docs, key=lambda d: -self.dates[d]):
+            if (source and self.sources[d] != source) or (since or until) and not low <= self.dates[d] <= high:
+                continue
+            output.append({
+                "milpacID": self.milpacIDs[d],
+                "date": datetime.date.fromordinal(self.dates[d]) if self.dates[d] else None,
+                "source": self.sources[d],
+                "text": self.texts[self.docTexts[d]],
+                "ref": self.refs[d]
+            })
+        return output
+
+    def troopers(self, text, source=False):
+        '''
+        Output (set): Milpac IDs with at least one entry matching a query.
+        '''
+        return {self.milpacIDs[d] for d in self.documents(text)
+            if self.milpacIDs[d] is not None and (source == False or self.sources[d] == source)}
+
+    def save(self, path):
+        '''
+        Save to a file, for reloading with load().
+        '''
+        state = {k: v for k, v in self.__dict__.items() if k not in ("seen", "textNumbers")} # Rebuilt on load.
+        with open(path, "wb") as file:
+            pickle.dump(state, file, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load an index saved with save().
+        '''
+        i = cls.__new__(cls)
+        gc.disable() # Loading makes many small objects. Collecting while it does only slows it down.
+        try:
+            with open(path, "rb") as file:
+                i.__dict__.update(pickle.load(file))
+        finally:
+            gc.enable()
+        i.textNumbers = {t: n for n, t in enumerate(i.texts)}
+        i.seen = set(zip(i.sources, i.milpacIDs, i.dates, i.docTexts, i.refs))
+        return i
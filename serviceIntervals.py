@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# ELOA, discharge and retirement spans from service records, for every trooper at once, in an index
+# answering "who was away on this date" and "how many days of active service".
+
+import array
+import datetime
+
+import cavMetrics
+import milpacScraper
+
+log = cavMetrics.getLogger("serviceIntervals")
+
+# Service record terms, lowercase, that start and end time away. Same terms GCM.compileELOA always used.
+START_TERMS = ("eloa", "discharge", "discharged", "retire", "retired")
+END_TERMS = ("re-en-stated", "reenlisted", "returned", "retirement", "boot", "reinstated")
+
+
+def kindOf(entry):
+    '''
+    Output (str): ELOA, Discharge or Retirement, for a lowercase service record entry that starts time away.
+    '''
+    if "eloa" in entry:
+        return "ELOA"
+    if "discharge" in entry:
+        return "Discharge"
+    return "Retirement"
+
+
+def spans(serviceRecord):
+    '''
+    Find time away in a service record.
+
+    Inputs:
+        serviceRecord (list): Output of milpacScraper.trooper().serviceRecord(), newest first.
+
+    Output (list): Spans, oldest first. Each a dict with the following keys:
+        kind (str): ELOA, Discharge or Retirement.
+        startDate (str): Date of the entry starting the span. (Ex: Nov 11, 2020)
+        startEntry (str): Entry starting the span.
+        endDate (str|None): Date of the entry ending the span. None if it hasn't ended.
+        endEntry (str|None): Entry ending the span. None if it hasn't ended.
+    '''
+    output = []
+    start = None
+    for date, entry in reversed(serviceRecord):
+        rec = entry.lower()
+        if start is None:
+            if any(x in rec for x in START_TERMS):
+                start = {"kind": kindOf(rec), "startDate": date, "startEntry": entry, "endDate": None, "endEntry": None}
+        elif any(x in rec for x in END_TERMS):
+            start["endDate"] = date
+            start["endEntry"] = entry
+            output.append(start)
+            start = None
+    if start is not None:
+        output.append(start)
+    return output
+
+
+def toOrdinal(date):
+    return milpacScraper.parseDate(date).toordinal()
+
+
+class intervalIndex:
+    '''
+    Index of time away for many troopers. Spans are kept in columns sorted by start date, read as an implicit
+        interval tree: each range of the columns is a subtree rooted at its middle span, which holds the latest end
+        date in the range. Date queries skip subtrees that ended too early or start too late, so they cost
+        O(log n + matches) however many spans are still open.
+
+    Input:
+        asOf (date) [OPTIONAL]: Date used to end spans that haven't ended yet. Default: today.
+    '''
+    def __init__(self, asOf=False):
+        self.asOf = (asOf or datetime.date.today()).toordinal()
+        self.pending = [] # (start, end, milpacID, kind, open) added since the columns were last built.
+        self.firstRecord = {} # Milpac ID to the date ordinal of their oldest service record entry.
+        self.starts = array.array("l")
+        self.ends = array.array("l")
+        self.maxEnds = array.array("l") # Latest end in the subtree rooted at each span. See tree().
+        self.milpacIDs = array.array("l")
+        self.kinds = []
+        self.opens = array.array("b") # 1 if the span hasn't ended. Its end is then asOf.
+        self.byTrooper = {} # Milpac ID to list of (start, end, kind, open), oldest first.
+
+    def __len__(self):
+        self.index()
+        return len(self.starts)
+
+    def add(self, milpacID, serviceRecord):
+        '''
+        Add one trooper's time away.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            serviceRecord (list): Output of milpacScraper.trooper().serviceRecord(), newest first.
+        '''
+        milpacID = int(milpacID)
+        if serviceRecord:
+            self.firstRecord[milpacID] = toOrdinal(serviceRecord[-1][0])
+        for s in spans(serviceRecord):
+            end = toOrdinal(s["endDate"]) if s["endDate"] else self.asOf
+            self.pending.append((toOrdinal(s["startDate"]), end, milpacID, s["kind"], int(s["endDate"] is None)))
+
+    def index(self):
+        if self.pending == []:
+            return
+        rows = sorted(list(zip(self.starts, self.ends, self.milpacIDs, self.kinds, self.opens)) + self.pending)
+        self.pending = []
+        self.starts = array.array("l", (r[0] for r in rows))
+        self.ends = array.array("l", (r[1] for r in rows))
+        self.milpacIDs = array.array("l", (r[2] for r in rows))
+        self.kinds = [r[3] for r in rows]
+        self.opens = array.array("b", (r[4] for r in rows))
+
+        self.maxEnds = array.array("l", self.ends)
+        self.tree(0, len(rows))
+
+        self.byTrooper = {}
+        for start, end, milpacID, kind, isOpen in rows:
+            self.byTrooper.setdefault(milpacID, []).append((start, end, kind, isOpen))
+
+    def tree(self, low, high):
+        '''
+        Fill maxEnds for the subtree of spans low to high (not included), rooted at the middle one.
+
+        Output (int): Latest end in the subtree. 0 if it is empty.
+        '''
+        if low >= high:
+            return 0
+        mid = (low + high) // 2
+        self.maxEnds[mid] = max(self.ends[mid], self.tree(low, mid), self.tree(mid + 1, high))
+        return self.maxEnds[mid]
+
+    @classmethod
+    def build(cls, records, asOf=False):
+        '''
+        Build an index from many service records.
+
+        Inputs:
+            records (iterable): (milpac ID, service record) tuples.
+            asOf (date) [OPTIONAL]: See intervalIndex.
+
+        Output (intervalIndex): Built index.
+        '''
+        i = cls(asOf)
+        with cavMetrics.timer("audit", "serviceIntervals"):
+            for milpacID, serviceRecord in records:
+                i.add(milpacID, serviceRecord)
+            i.index()
+        return i
+
+    @classmethod
+    def fromUnit(cls, rosterIDs=False, workers=8, asOf=False):
+        '''
+        Build an index for every trooper on the rosters, fetching their profiles concurrently.
+
+        Inputs:
+            rosterIDs (list) [OPTIONAL]: Rosters to include. Default: every roster.
+            workers (int) [OPTIONAL]: Profiles fetched at once. Default: 8
+            asOf (date) [OPTIONAL]: See intervalIndex.
+
+        Output (intervalIndex): Built index.
+        '''
+        IDs = []
+        for rosterID in (rosterIDs or milpacScraper.roster().getRosters()):
+            IDs += milpacScraper.roster(rosterID).getIDs()
+        i = cls.build(((ID, t.serviceRecord()) for ID, t in milpacScraper.troopers(dict.fromkeys(IDs), workers)), asOf)
+        log.info(f"Indexed {len(i)} spans for {len(i.firstRecord)} troopers", extra={"spans": len(i), "troopers": len(i.firstRecord)})
+        return i
+
+    def overlapping(self, start, end, kind=False):
+        '''
+        Find spans overlapping a date range.
+
+        Inputs:
+            start (date): First day of range.
+            end (date): Last day of range.
+            kind (str) [OPTIONAL]: Only spans of this kind (ELOA, Discharge or Retirement). Default: all kinds.
+
+        Output (list): (milpac ID, kind, start date, end date) tuples. End date is None if the span hasn't ended.
+        '''
+        self.index()
+        start, end = start.toordinal(), end.toordinal()
+        found = []
+        subtrees = [(0, len(self.starts))]
+        while subtrees:
+            low, high = subtrees.pop()
+            if low >= high:
+                continue
+            mid = (low + high) // 2
+            if self.maxEnds[mid] < start: # Everything in this subtree ended before the range.
+                continue
+            subtrees.append((low, mid))
+            if self.starts[mid] <= end: # Spans right of mid start later. Only look there if mid starts in time.
+                subtrees.append((mid + 1, high))
+                if self.ends[mid] >= start and (kind == False or self.kinds[mid] == kind):
+                    found.append(mid)
+        return [(
+            self.milpacIDs[i],
+            self.kinds[i],
+            datetime.date.fromordinal(self.starts[i]),
+            None if self.opens[i] else datetime.date.fromordinal(self.ends[i])
+        ) for i in sorted(found)]
+
+    def away(self, date, kind=False):
+        '''
+        Output (set): Milpac IDs of troopers away (on ELOA, discharged or retired) on a date. A span's end date
+            counts as back.
+        '''
+        return {r[0] for r in self.overlapping(date, date, kind) if r[3] is None or r[3] > date}
+
+    def awayDays(self, milpacID, start=False, end=False, kind=False):
+        '''
+        Days a trooper spent away.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            start (date) [OPTIONAL]: Only count days from this date. Default: all days.
+            end (date) [OPTIONAL]: Only count days before this date. Default: asOf.
+            kind (str) [OPTIONAL]: Only spans of this kind. Default: all kinds.
+
+        Output (int): Days away.
+        '''
+        self.index()
+        low = start.toordinal() if start else 0
+        high = end.toordinal() if end else self.asOf
+        total = 0
+        covered = low # Spans can overlap (ELOA then discharge). Only count each day once.
+        for s, e, k, _ in self.byTrooper.get(int(milpacID), []):
+            if kind and k != kind:
+                continue
+            s, e = max(s, covered), min(e, high)
+            if e > s:
+                total += e - s
+                covered = e
+        return total
+
+    def activeDays(self, milpacID, start=False, end=False):
+        '''
+        Days of active service: days since a trooper's first service record entry (or start), less days away.
+
+        Inputs:
+            milpacID (int): Milpac ID.
+            start (date) [OPTIONAL]: Only count days from this date. Default: their first service record entry.
+            end (date) [OPTIONAL]: Only count days before this date. Default: asOf.
+
+        Output (int|None): Days of active service. None if the trooper isn't in the index.
+        '''
+        milpacID = int(milpacID)
+        if milpacID not in self.firstRecord:
+            return None
+        low = max(start.toordinal(), self.firstRecord[milpacID]) if start else self.firstRecord[milpacID]
+        high = end.toordinal() if end else self.asOf
+        if high <= low:
+            return 0
+        return (high - low) - self.awayDays(milpacID, datetime.date.fromordinal(low), datetime.date.fromordinal(high))
+
+    def trooper(self, milpacID):
+        '''
+        Output (list): One trooper's spans, oldest first, as (kind, start date, end date, days) tuples.
+            End date is None if the span hasn't ended, and days are counted up to asOf.
+        '''
+        self.index()
+        return [(k, datetime.date.fromordinal(s), None if o else datetime.date.fromordinal(e), e - s)
+            for s, e, k, o in self.byTrooper.get(int(milpacID), [])]
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# Local stand-in for 7cav.us. Serves recorded or synthetic pages at the same URLs the scrapers use,
+# with configurable latency and error injection.
+#
+# Point the tools at it with: CAV_BASE_URL=http://127.0.0.1:8077
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fixturePages
+
+AWARDS = [(1, "Expert Infantry Badge"), (2, "Combat Infantry Badge"), (3, "Combat Infantry Badge 2nd Award"),
+    (4, "Good Conduct Medal"), (5, "NCO Professional Development Ribbon"), (6, "Purple Heart")]
+
+
+class standIn:
+    '''
+    Site state and routing for the stand-in server.
+
+    Inputs:
+        rosters (int) [OPTIONAL]: Amount of synthetic rosters. Default: 3
+        troopersPerRoster (int) [OPTIONAL]: Troopers on each synthetic roster. Default: 100
+        seed (int) [OPTIONAL]: Seed for synthetic data. Default: 0
+        fixtureDir (str) [OPTIONAL]: Folder of recorded pages (see fixturePages.recordPages). Recorded pages are served
+            instead of synthetic ones when present.
+        latency (float) [OPTIONAL]: Seconds added to every response. Default: 0
+        jitter (float) [OPTIONAL]: Up to this many extra random seconds added to every response. Default: 0
+        errorRate (float) [OPTIONAL]: Fraction of requests answered with errorCode instead of the page. Default: 0
+        errorCode (int) [OPTIONAL]: HTTP status used for injected errors. Default: 503
+        threadPages (int) [OPTIONAL]: Pages in every synthetic thread, conversation and forum. Default: 3
+    '''
+    def __init__(self, rosters=3, troopersPerRoster=100, seed=0, fixtureDir=False, latency=0, jitter=0,
+            errorRate=0, errorCode=503, threadPages=3):
+        self.unit = fixturePages.syntheticUnit(rosters, troopersPerRoster, seed)
+        self.troopers = {t["milpacID"]: t for r in self.unit.values() for t in r}
+        self.seed = seed
+        self.fixtureDir = fixtureDir
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorCode = errorCode
+        self.threadPages = threadPages
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {} # Request count per route.
+        self.posts = [] # Every form submitted, for checking what the tools sent.
+        self.webhooks = [] # JSON bodies posted to /_standin/webhook, for checking rosterWatcher's webhook sink.
+        self.nextConversation = 1000
+
+    def count(self, route):
+        with self.lock:
+            self.stats[route] = self.stats.get(route, 0) + 1
+
+    def recorded(self, path, query):
+        if self.fixtureDir == False:
+            return None
+        name = os.path.join(self.fixtureDir, fixturePages.fixtureName(path + (f"?{query}" if query else "")))
+        if os.path.exists(name):
+            with open(name, encoding="utf-8") as file:
+                return file.read()
+        return None
+
+    def get(self, path, query, cookies):
+        '''
+        Route a GET request.
+
+        Output (tuple): (status code, headers dict, body str)
+        '''
+        q = urllib.parse.parse_qs(query)
+        recorded = self.recorded(path, query)
+        if recorded is not None:
+            self.count("recorded")
+            return 200, {}, recorded
+
+        if path in ("/rosters", "/rosters/") and "id" in q:
+            self.count("roster")
+            rosterID = int(q["id"][0])
+            return 200, {}, fixturePages.rosterPage(rosterID, self.unit.get(rosterID, []), list(self.unit))
+
+        if path == "/rosters/profile":
+            self.count("profile")
+            t = self.troopers.get(int(q.get("uniqueid", [0])[0]))
+            if t is None:
+                return 404, {}, fixturePages.page("Error", "The requested profile could not be found.")
+            return 200, {}, fixturePages.profilePage(t)
+
+        m = re.match(r"^/forums/(\d+)/(?:page-(\d+))?$", path)
+        if m:
+            self.count("forum")
+            forumID, current = int(m.group(1)), int(m.group(2) or 1)
+            rng = random.Random(self.seed * 31 + forumID * 97 + current)
+            threads = [{
+                "ID": forumID * 10000 + (current - 1) * 20 + i,
+                "Author": rng.choice(list(self.troopers.values()))["forumName"] if self.troopers else "Doe.J",
+                "Title": f"Thread {i} on page {current}",
+                "Replies": rng.randrange(0, 300)
+            } for i in range(20)]
+            return 200, {}, fixturePages.threadListPage(forumID, threads, current, self.threadPages)
+
+        m = re.match(r"^/(threads|conversations)/(?:[^/]*\.)?(\d+)/(?:page-(\d+))?$", path)
+        if m:
+            kind = "post" if m.group(1) == "threads" else "message"
+            self.count(m.group(1))
+            current = int(m.group(3) or 1)
+            messages = fixturePages.syntheticMessages(kind, int(m.group(2)), current, seed=self.seed)
+            return 200, {}, fixturePages.messagePage(kind, messages, current, self.threadPages)
+
+        if re.match(r"^/rosters/[^/]+/awards/add$", path):
+            self.count("form")
+            return 200, {}, fixturePages.formPage(AWARDS)
+
+        if re.match(r"^/rosters/[^/]+/service-record/add$", path) or path == "/rosters/uniform" \
+                or path == "/conversations/add" or re.match(r"^/conversations/[^/]+/leave$", path):
+            self.count("form")
+            return 200, {}, fixturePages.formPage()
+
+        if path == "/":
+            self.count("index")
+            return 200, {}, fixturePages.page("Home", '<a href="rosters/?id=1">Rosters</a>')
+
+        if path == "/account/":
+            self.count("account")
+            loggedIn = "xf_user" in cookies
+            return 200, {}, fixturePages.page("Account", '<a href="logout/?_xfToken=standin">Log Out</a>' if loggedIn else "Log in")
+
+        self.count("missing")
+        return 404, {}, fixturePages.page("Error", "The requested page could not be found.")
+
+    def post(self, path, query, body):
+        '''
+        Route a POST request.
+
+        Output (tuple): (status code, headers dict, body str)
+        '''
+        with self.lock:
+            self.posts.append({"path": path, "query": query, "bytes": len(body)})
+
+        if path == "/_standin/webhook":
+            self.count("webhook")
+            with self.lock:
+                self.webhooks.append(json.loads(body))
+            return 204, {}, ""
+
+        if path == "/login/login":
+            self.count("login")
+            return 303, {"Location": "/", "Set-Cookie": ["xf_user=1%2Cstandin; Max-Age=2592000; Path=/", "xf_session=standin; Path=/"]}, ""
+
+        if path == "/conversations/insert":
+            self.count("conversationInsert")
+            with self.lock:
+                self.nextConversation += 1
+                ID = self.nextConversation
+            return 303, {"Location": f"/conversations/conversation.{ID}/"}, ""
+
+        if path in ("/rosters/service-record/save", "/rosters/awards/save", "/rosters/uniform") \
+                or re.match(r"^/conversations/[^/]+/(insert-reply|leave)$", path):
+            self.count("save")
+            return 303, {"Location": "/"}, ""
+
+        self.count("missing")
+        return 404, {}, ""
+
+
+class handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # Headers and body are written separately. Without this, keep-alive clients stall on delayed ACKs.
+    site = None # standIn instance, set by serve().
+
+    def log_message(self, format, *args): # Quiet. Use /_standin/stats instead.
+        pass
+
+    def respond(self, status, headers, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        for k, v in headers.items():
+            for value in (v if isinstance(v, list) else [v]):
+                self.send_header(k, value)
+        self.send_header("Content-Type", "text/html; charset=utf-8" if not body.startswith("{") else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def delay(self):
+        site = self.site
+        if site.latency or site.jitter:
+            time.sleep(site.latency + site.rng.uniform(0, site.jitter))
+        return site.errorRate and site.rng.random() < site.errorRate
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == "/_standin/stats":
+            return self.respond(200, {}, json.dumps({"requests": self.site.stats, "posts": len(self.site.posts)}))
+        if self.delay():
+            self.site.count("error")
+            return self.respond(self.site.errorCode, {}, fixturePages.page("Error", "Injected error."))
+        cookies = self.headers.get("Cookie", "")
+        self.respond(*self.site.get(parts.path, parts.query, cookies))
+
+    def do_POST(self):
+        parts = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.delay():
+            self.site.count("error")
+            return self.respond(self.site.errorCode, {}, "")
+        self.respond(*self.site.post(parts.path, parts.query, body))
+
+
+class quietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError): # Clients that stop reading early (Ex: streamIDs) are fine.
+            super().handle_error(request, client_address)
+
+
+def serve(site=None, host="127.0.0.1", port=0, background=True):
+    '''
+    Start the stand-in server.
+
+    Inputs:
+        site (standIn) [OPTIONAL]: Site to serve. A default standIn() if not given.
+        host (str) [OPTIONAL]: Address to bind. Default: 127.0.0.1
+        port (int) [OPTIONAL]: Port to bind. Default: 0 (any free port)
+        background (bool) [OPTIONAL]: Serve from a daemon thread and return immediately. Default: True
+
+    Output (ThreadingHTTPServer): Running server. Its base URL is f"http://{host}:{server.server_address[1]}".
+        Call server.shutdown() to stop a background server.
+    '''
+    site = site or standIn()
+    server = quietServer((host, port), type("boundHandler", (handler,), {"site": site}))
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for 7cav.us.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8077)
+    parser.add_argument("--rosters", type=int, default=3)
+    parser.add_argument("--troopers", type=int, default=100, help="Troopers per roster.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", default=False, help="Folder of recorded pages.")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to every response.")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many random seconds added to every response.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that get an error response.")
+    parser.add_argument("--error-code", type=int, default=503)
+    parser.add_argument("--pages", type=int, default=3, help="Pages in every forum, thread and conversation.")
+    args = parser.parse_args()
+
+    site = standIn(args.rosters, args.troopers, args.seed, args.fixtures, args.latency, args.jitter,
+        args.error_rate, args.error_code, args.pages)
+    print(f"Serving stand-in 7cav.us on http://{args.host}:{args.port}")
+    serve(site, args.host, args.port, background=False)
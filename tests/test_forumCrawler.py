@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# forumCrawler against standInServer.py. Run from the repo folder: python -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cavConfig
+import forumCrawler
+import standInServer
+
+
+class budgetTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.credentials = os.path.join(self.folder, "credentials.json")
+        with open(self.credentials, "w") as file:
+            json.dump({"user": "Doe.J", "pass": "standin"}, file)
+        self.environment = dict(os.environ)
+        os.environ["CAV_COOKIE_FILE"] = os.path.join(self.folder, "cookies.json")
+        self.baseURL = cavConfig.baseURL()
+        self.server = standInServer.serve(standInServer.standIn(threadPages=3))
+        cavConfig.setBaseURL(f"http://127.0.0.1:{self.server.server_address[1]}")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        cavConfig.setBaseURL(self.baseURL)
+        os.environ.clear()
+        os.environ.update(self.environment)
+        shutil.rmtree(self.folder)
+
+    def crawler(self, catchUp=False):
+        return forumCrawler.crawler([12], os.path.join(self.folder, "forumCrawl.json"), rate=1000, catchUp=catchUp,
+            credentialsJSON=self.credentials)
+
+    def test_deferredThreadsAreCrawledLater(self):
+        c = self.crawler()
+        c.crawl() # First sight of the forum only records reply counts.
+        # 20 changed threads on list page 1 and 5 quieter ones on page 2. The budget takes page 1, and the next scan
+        # stops at page 1, which has nothing new, so page 2's threads are only reached through the deferred state.
+        for ID, replies in c.replies.items():
+            n = ID - 12 * 10000
+            if n < 20:
+                c.replies[ID] = replies - 1
+            elif n < 25:
+                c.replies[ID] = replies + 1
+        c.save()
+
+        first = self.crawler().crawl(budget=20)
+        self.assertEqual(len(first), 20)
+        later = [t["threadID"] for t in self.crawler().crawl(budget=20)] # New crawler each cycle, as a new run.
+        self.assertEqual(sorted(later), [str(12 * 10000 + n) for n in range(20, 25)])
+        self.assertEqual(self.crawler().deferred, {})
+
+    def test_nothingLeftAfterUnlimitedCycle(self):
+        c = self.crawler(catchUp=True)
+        self.assertEqual(len(c.crawl()), 60)
+        self.assertEqual(c.crawl(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()